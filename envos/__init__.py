@@ -1,14 +1,21 @@
 from . import header
 from .config import Config
+from .gpath import RunContext
 from .model_generator import ModelGenerator, read_model  # Grid, KinematicModel
 from .obs import ObsSimulator, read_obsdata
+from .sweep import SweepRunner, read_sweep_index
+from .library import ObsLibrary
 from . import nconst as nc
 from . import tools
 from . import plot_tools
 from . import log
 from . import pvcor
+from . import pvfit
+from . import emulator
+from . import fitting
+from . import pvanalysis
 
-__all__ = ['Config', 'ModelGenerator', 'read_model', 'ObsSimulator', 'read_obsdata', 'nc', 'tools', 'plot_tools', 'log', 'pvcor']
+__all__ = ['Config', 'RunContext', 'ModelGenerator', 'read_model', 'ObsSimulator', 'read_obsdata', 'SweepRunner', 'read_sweep_index', 'ObsLibrary', 'nc', 'tools', 'plot_tools', 'log', 'pvcor', 'pvfit', 'emulator', 'fitting', 'pvanalysis']
 
 __version__ = '0.1.0'
 
@@ -71,18 +71,25 @@ class Config:
     cavangle_deg: float = 0
     inenv: str = "UCM" # {"UCM", "Simple"}
     outenv: str = None
-    disk: str = None
+    disk: str = None # {"exptail"} or a function Sigma(R)
     rot_ccw: bool = False
     # usr_density_func: Callable = None
 
     # RADMC-3D input
     nphot: int = 1e6
+    nphot_mode: str = "fixed" # {"fixed", "converge"}
+    nphot_tol: float = 0.01
+    nphot_max: int = 1e8
     f_dg: float = 0.01
     opac: str = "silicate"
     Lstar_Lsun: float = 1.0
     mfrac_H2: float = 0.74
     Rstar_Rsun: float = 1.0
-    # temp_mode: str = "mctherm"
+    temp_mode: str = "mctherm" # {"mctherm", "radeq"}
+    radeq_attenuation: bool = True
+    thermal_store: str = None
+    thermal_store_keys: list = None
+    thermal_store_tol: float = 0.03
     molname: str = "c18o"
     molabun: float = ""
     iline: int = 3
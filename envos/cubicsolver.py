@@ -112,3 +112,49 @@ def findG(a, b, c, d):
 # Helper function to return float value of h.
 def findH(g, f):
     return (g ** 2.0) / 4.0 + (f ** 3.0) / 27.0
+
+
+# Vectorized version of solve() for arrays of coefficients with a != 0.
+# Returns the real parts of the three roots stacked along the first axis,
+# in the same order as solve() returns them, so that a root selection made
+# on the scalar output can be reproduced element-wise.
+def solve_vectorized(a, b, c, d):
+    a, b, c, d = np.broadcast_arrays(
+        *[np.asarray(v, dtype=float) for v in (a, b, c, d)]
+    )
+    f = findF(a, b, c)
+    g = findG(a, b, c, d)
+    h = findH(g, f)
+    P = -b / (3.0 * a)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # All 3 roots are real (h <= 0): trigonometric form
+        i = np.sqrt(np.clip((g ** 2.0) / 4.0 - h, 0, None))
+        j = np.cbrt(i)
+        k = np.arccos(np.clip(-(g / (2 * i)), -1, 1))
+        M = np.cos(k / 3.0)
+        N = np.sqrt(3) * np.sin(k / 3.0)
+        x1_trig = 2 * j * M + P
+        x2_trig = -j * (M + N) + P
+        x3_trig = -j * (M - N) + P
+
+        # One real root and two complex roots (h > 0): Cardano form
+        sqrt_h = np.sqrt(np.clip(h, 0, None))
+        S = np.cbrt(-(g / 2.0) + sqrt_h)
+        U = np.cbrt(-(g / 2.0) - sqrt_h)
+        x1_card = (S + U) + P
+        x23_card = -(S + U) / 2 + P
+
+    trig = h <= 0
+    x1 = np.where(trig, x1_trig, x1_card)
+    x2 = np.where(trig, x2_trig, x23_card)
+    x3 = np.where(trig, x3_trig, x23_card)
+
+    # All 3 roots are real and equal
+    equal = (f == 0) & (g == 0) & (h == 0)
+    x_eq = -np.cbrt(d / a)
+    x1 = np.where(equal, x_eq, x1)
+    x2 = np.where(equal, x_eq, x2)
+    x3 = np.where(equal, x_eq, x3)
+
+    return np.stack([x1, x2, x3])
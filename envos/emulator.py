@@ -0,0 +1,313 @@
+import time
+import numpy as np
+from scipy import linalg, optimize
+
+from envos import pvcor, tools
+from envos.obs import PVmap
+from envos.pvfit import to_table
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Emulator of PV diagrams over physical parameters
+
+The library PV maps are interpolated onto a common (vkms, xau) grid and
+decomposed with PCA; the weight of each leading component is
+interpolated over the (normalized) parameters with its own Gaussian
+process, whose kernel is fitted by maximizing the marginal likelihood
+from several starting length scales. A prediction is the mean image
+plus the predicted weights times the components, a few small matrix
+products.
+
+The estimated error of a prediction is the rms pixel error expected from
+the GP variances of the weights plus the rms residual of the truncated
+PCA basis over the training maps. validate() also reports the errors of
+the mean map and of the nearest training map, which a working emulator
+should beat.
+"""
+
+
+class PVEmulator:
+    """
+    example
+    ------------
+    emu = PVEmulator(keys=["CR_au", "Ms_Msun"]).fit(library)
+    PV, err = emu.predict({"CR_au": 120, "Ms_Msun": 0.25}, return_error=True)
+    report = emu.validate(test_library)
+
+    library: an ObsLibrary, a DataFrame or a list of dicts as in pvfit.
+    n_components: maximum number of PCA components; the smallest number
+                  explaining var_frac of the variance is used.
+    log_keys: parameters interpolated in log10; by default all the
+              parameters that are positive in the library.
+    """
+
+    def __init__(
+        self,
+        keys,
+        n_components=20,
+        var_frac=0.9999,
+        log_keys=None,
+        xau=None,
+        vkms=None,
+    ):
+        self.keys = list(keys)
+        self.n_components = n_components
+        self.var_frac = var_frac
+        self.log_keys = log_keys
+        self.xau = xau
+        self.vkms = vkms
+
+    def fit(self, library):
+        t0 = time.perf_counter()
+        table = to_table(library)
+        if len(table) <= len(self.keys):
+            raise Exception("Too few library PV maps to train the emulator")
+        pvs = [tools.read_pickle(pv) if isinstance(pv, str) else pv for pv in table["PV"]]
+        self.template = pvs[0]
+        self.xau = pvs[0].xau if self.xau is None else np.asarray(self.xau)
+        self.vkms = pvs[0].vkms if self.vkms is None else np.asarray(self.vkms)
+
+        ims = self.regrid(pvs)
+        X = ims.reshape(len(ims), -1)
+        self.mean = X.mean(axis=0)
+        U, S, Vt = linalg.svd(X - self.mean, full_matrices=False)
+        frac = np.cumsum(S ** 2) / np.sum(S ** 2)
+        n = min(self.n_components, int(np.searchsorted(frac, self.var_frac)) + 1)
+        self.components = Vt[:n]
+        W = U[:, :n] * S[:n]
+        resid = X - self.mean - W @ self.components
+        self.trunc_rms = np.sqrt(np.mean(resid ** 2))
+
+        points = table[self.keys].to_numpy(dtype=float)
+        if self.log_keys is None:
+            self.log_keys = [k for k, p in zip(self.keys, points.T) if np.all(p > 0)]
+        self._log = np.array([k in self.log_keys for k in self.keys])
+        u = self._transform(points, init=True)
+
+        self.u = u
+        self.W = W
+        self.w_scale = W.std(axis=0)
+        self.w_scale[self.w_scale == 0] = 1
+        self.gps = [GaussianProcess().fit(u, w[:, np.newaxis]) for w in (W / self.w_scale).T]
+        self.length = np.array([gp.length for gp in self.gps])
+
+        # A length scale at the lower bound makes the GP revert to the mean
+        # between the training points; one at the upper bound only means
+        # that the weight does not depend on that parameter.
+        length_min = np.array([gp.length_min for gp in self.gps])
+        collapsed = np.any(self.length <= length_min * 1.01, axis=1)
+        if np.any(collapsed):
+            var = S[:n] ** 2 / np.sum(S ** 2)
+            logger.warning(
+                f"PV emulator: GP of components {list(np.where(collapsed)[0])} "
+                f"({np.sum(var[collapsed]):.3g} of the variance) have a length "
+                "scale at the lower bound (half the spacing of the library "
+                "points) and revert to the mean between them; the library "
+                "may be too sparse for these parameters"
+            )
+        logger.info(
+            f"PV emulator: {len(pvs)} maps, {n} components "
+            f"(truncation rms {self.trunc_rms:.3g}), GP length scales of the "
+            f"leading component {dict(zip(self.keys, np.round(self.length[0], 3)))}, "
+            f"trained in {time.perf_counter() - t0:.2f} s"
+        )
+        return self
+
+    def regrid(self, pvs):
+        """
+        PV maps on the emulator grid, (n, nv, nx).
+        """
+        ims = np.empty((len(pvs), len(self.vkms), len(self.xau)))
+        matrices = {}
+        for i, pv in enumerate(pvs):
+            key = (pv.vkms.tobytes(), pv.xau.tobytes())
+            if key not in matrices:
+                matrices[key] = (
+                    pvcor.spline_matrix(pv.vkms, self.vkms),
+                    pvcor.spline_matrix(pv.xau, self.xau),
+                )
+            Mv, Mx = matrices[key]
+            ims[i] = Mv @ pv.Ipv @ Mx.T
+        return ims
+
+    def predict_array(self, points):
+        """
+        points: (n, len(keys)) parameters.
+        Returns images (n, nv, nx) and their estimated rms errors (n,).
+        """
+        u = self._transform(np.atleast_2d(np.asarray(points, dtype=float)))
+        w = np.empty((len(u), len(self.gps)))
+        var = np.empty_like(w)
+        for j, gp in enumerate(self.gps):
+            mean, var[:, j] = gp.predict(u)
+            w[:, j] = mean[:, 0]
+        ims = self.mean + (w * self.w_scale) @ self.components
+        npix = self.components.shape[1]
+        gp_mse = var * self.w_scale ** 2
+        err = np.sqrt(np.sum(gp_mse, axis=1) / npix + self.trunc_rms ** 2)
+        return ims.reshape(-1, len(self.vkms), len(self.xau)), err
+
+    def predict(self, params, return_error=False):
+        """
+        params: dict of the parameters (scalars or arrays of one length).
+        Returns a PVmap, or a list of PVmaps for arrays.
+        """
+        values = [np.atleast_1d(params[k]).astype(float) for k in self.keys]
+        ims, err = self.predict_array(np.stack(np.broadcast_arrays(*values), axis=-1))
+        pvs = [self._make_pv(im) for im in ims]
+        if np.ndim(params[self.keys[0]]) == 0:
+            pvs, err = pvs[0], err[0]
+        return (pvs, err) if return_error else pvs
+
+    def validate(self, library, method="ZNCC", threshold=0):
+        """
+        Compare the predictions with held-out simulated PV maps.
+        Returns a table of the parameters, the true rms error, the
+        estimated error and the score (pvcor) of each prediction, and the
+        rms errors of the mean map and of the nearest training map (in
+        the normalized parameters). A warning is logged when the
+        predictions are not better than the nearest training maps, e.g.
+        when the GPs collapsed to the mean map.
+        """
+        table = to_table(library)
+        pvs = [tools.read_pickle(pv) if isinstance(pv, str) else pv for pv in table["PV"]]
+        points = table[self.keys].to_numpy(dtype=float)
+        t0 = time.perf_counter()
+        ims, err = self.predict_array(points)
+        dt = time.perf_counter() - t0
+
+        truth = self.regrid(pvs)
+        report = table[self.keys].copy()
+        report["rms_error"] = np.sqrt(np.mean((ims - truth) ** 2, axis=(1, 2)))
+        report["est_error"] = err
+        report["mean_error"] = np.sqrt(
+            np.mean((self.mean.reshape(truth.shape[1:]) - truth) ** 2, axis=(1, 2))
+        )
+        u = self._transform(points)
+        inn = np.argmin(np.sum((u[:, np.newaxis] - self.u) ** 2, axis=-1), axis=1)
+        nn = (self.mean + self.W[inn] @ self.components).reshape(truth.shape)
+        report["nn_error"] = np.sqrt(np.mean((nn - truth) ** 2, axis=(1, 2)))
+        report["score"] = [
+            pvcor.PreparedPV(pv, threshold=threshold, xau=self.xau, vkms=self.vkms)
+            .correlate(self._make_pv(im), method=method)
+            for pv, im in zip(pvs, ims)
+        ]
+        logger.info(
+            f"PV emulator validation: {len(pvs)} maps, prediction "
+            f"{dt / len(pvs) * 1e3:.3g} ms per map, median rms error "
+            f"{np.median(report['rms_error']):.3g} (estimated "
+            f"{np.median(report['est_error']):.3g}), median {method} "
+            f"{np.median(report['score']):.4g}"
+        )
+        if np.median(report["rms_error"]) >= np.median(report["nn_error"]):
+            logger.warning(
+                "PV emulator is not better than the nearest training map: "
+                f"median rms error {np.median(report['rms_error']):.3g}, "
+                f"nearest map {np.median(report['nn_error']):.3g}, "
+                f"mean map {np.median(report['mean_error']):.3g}"
+            )
+        return report
+
+    def _transform(self, points, init=False):
+        x = np.array(points, dtype=float)
+        x[:, self._log] = np.log10(np.abs(x[:, self._log]))
+        if init:
+            self.x_min = x.min(axis=0)
+            self.x_range = np.where(np.ptp(x, axis=0) > 0, np.ptp(x, axis=0), 1)
+        return (x - self.x_min) / self.x_range
+
+    def _make_pv(self, im):
+        PV = PVmap(
+            Ipv=im,
+            xau=self.xau.copy(),
+            vkms=self.vkms.copy(),
+            dpc=self.template.dpc,
+            pangle_deg=self.template.pangle_deg,
+            poffset_au=self.template.poffset_au,
+            unit_I=self.template.unit_I,
+        )
+        PV.add_convolution_info(
+            self.template.beam_maj_au,
+            self.template.beam_min_au,
+            self.template.vreso_kms,
+            self.template.beam_pa_deg,
+        )
+        return PV
+
+
+class GaussianProcess:
+    """
+    GP regression with a squared-exponential kernel with a length scale
+    per input dimension; the length scales, amplitude and noise maximize
+    the marginal likelihood (summed over the outputs, which share the
+    kernel), from several isotropic starting length scales.
+    """
+
+    length_bounds = (1e-3, 1e2)
+    amp_bounds = (1e-2, 1e2)
+    noise_bounds = (1e-10, 1e-1)
+
+    def fit(self, x, y, length0=(0.1, 0.3, 1.0)):
+        self.x = x
+        ndim = x.shape[1]
+        # Length scales much shorter than the spacing of the points along
+        # a dimension decouple the rows of a grid, a spurious maximum of
+        # the likelihood; half the median spacing is the lower bound.
+        self.length_min = np.maximum(
+            [0.5 * _median_spacing(xi) for xi in x.T], self.length_bounds[0]
+        )
+        bounds = [(np.log(lmin), np.log(self.length_bounds[1])) for lmin in self.length_min] + [
+            np.log(self.amp_bounds),
+            np.log(self.noise_bounds),
+        ]
+        best = None
+        for l0 in length0:
+            l0 = np.maximum(l0, self.length_min)
+            p0 = np.concatenate([np.log(l0), [0.0, np.log(1e-4)]])
+            res = optimize.minimize(
+                self._neg_log_likelihood, p0, args=(x, y), method="L-BFGS-B", bounds=bounds
+            )
+            if best is None or res.fun < best.fun:
+                best = res
+        self._set_params(best.x)
+        K = self._kernel(x, x) + self.noise * np.eye(len(x))
+        self.cho = linalg.cho_factor(K, lower=True)
+        self.alpha = linalg.cho_solve(self.cho, y)
+        return self
+    def predict(self, x):
+        """
+        Returns the mean (n, n_output) and the variance (n,), the same
+        for all outputs.
+        """
+        Ks = self._kernel(x, self.x)
+        mean = Ks @ self.alpha
+        v = linalg.cho_solve(self.cho, Ks.T)
+        var = self.amp - np.sum(Ks * v.T, axis=1)
+        return mean, np.maximum(var, 0)
+
+    def _set_params(self, p):
+        ndim = len(p) - 2
+        self.length = np.exp(p[:ndim])
+        self.amp = np.exp(p[ndim])
+        self.noise = np.exp(p[ndim + 1])
+
+    def _kernel(self, x1, x2):
+        d = (x1[:, np.newaxis, :] - x2[np.newaxis, :, :]) / self.length
+        return self.amp * np.exp(-0.5 * np.sum(d ** 2, axis=-1))
+
+    def _neg_log_likelihood(self, p, x, y):
+        self._set_params(p)
+        K = self._kernel(x, x) + self.noise * np.eye(len(x))
+        try:
+            cho = linalg.cho_factor(K, lower=True)
+        except linalg.LinAlgError:
+            return 1e300
+        logdet = 2 * np.sum(np.log(np.diag(cho[0])))
+        return 0.5 * np.sum(y * linalg.cho_solve(cho, y)) + 0.5 * y.shape[1] * logdet
+
+
+def _median_spacing(x):
+    dx = np.diff(np.unique(x))
+    return np.median(dx) if len(dx) else 1.0
@@ -0,0 +1,400 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import optimize
+
+from envos import pvcor, tools, sweep
+from envos.grid import make_grid_from_config
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Fitting model parameters to an observed PV diagram
+
+CachedObjective wraps a forward model (the envos pipeline run by
+sweep._run_point, or any function of the parameters returning a PVmap,
+e.g. PVEmulator.predict) as a loss: 1 - ZNCC or SSD against the observed
+PV map (pvcor.PreparedPV). Parameters are rounded to `digits` significant
+digits, and every evaluation is kept in fit_dir/evaluations.jsonl with
+the rounded parameters as the key, so points revisited by an optimizer
+or by a resumed run are not recomputed. A batch of points is evaluated
+in a process pool.
+
+    minimize(objective, x0, bounds)       : scipy.optimize.minimize or
+                                            differential_evolution
+    EnsembleSampler(objective, bounds)    : affine-invariant ensemble MCMC
+                                            with checkpoint/resume
+
+The optimizers and the sampler work on the fit parameters, which are the
+log10 of the parameters in log_keys and the parameters themselves
+otherwise.
+"""
+
+EVAL_FILENAME = "evaluations.jsonl"
+DERIVATIVE_FREE = ("Nelder-Mead", "Powell", "COBYLA", "COBYQA")
+
+
+class CachedObjective:
+    """
+    example
+    ------------
+    obj = CachedObjective(PV_obs, ["CR_au", "Ms_Msun"], config=config,
+                          log_keys=["CR_au", "Ms_Msun"], n_proc=8,
+                          range_xau=[-500, 500])
+    res = minimize(obj, {"CR_au": 100, "Ms_Msun": 0.3},
+                   {"CR_au": (30, 300), "Ms_Msun": (0.1, 1)})
+    """
+
+    def __init__(
+        self,
+        PV_obs,
+        keys,
+        config=None,
+        forward=None,
+        method="ZNCC",
+        threshold=0,
+        range_xau=[],
+        range_vkms=[],
+        log_keys=(),
+        digits=6,
+        fit_dir="./fit",
+        n_proc=1,
+        pangle_deg=0,
+        stages=sweep.STAGES,
+    ):
+        if (config is None) == (forward is None):
+            raise Exception("Give either config or forward")
+        if method not in ("ZNCC", "SSD"):
+            raise Exception("Unknown method type.")
+        self.keys = list(keys)
+        self.config = config
+        self.forward = forward
+        self.method = method
+        self.log = np.array([k in log_keys for k in self.keys])
+        self.digits = digits
+        self.fit_dir = os.path.abspath(fit_dir)
+        self.eval_path = os.path.join(self.fit_dir, EVAL_FILENAME)
+        self.n_proc = n_proc
+        self.pangle_deg = pangle_deg
+        self.stages = tuple(stages)
+        self.ref = pvcor.PreparedPV(
+            PV_obs, threshold=threshold, range_xau=range_xau, range_vkms=range_vkms
+        )
+        self.n_call = 0
+        self.n_hit = 0
+        self._grid = None
+        os.makedirs(self.fit_dir, exist_ok=True)
+        self.cache = {}
+        for record in self.read_evaluations():
+            self.cache[self._get_key(record["params"])] = record
+
+    def __call__(self, x):
+        return float(self.evaluate(np.atleast_2d(x))[0])
+
+    def evaluate(self, X):
+        """
+        Losses of the fit-parameter vectors X (n, len(keys)). Points not
+        in the cache are computed together, in parallel.
+        """
+        params_list = [self.to_params(x) for x in np.atleast_2d(X)]
+        keys = [self._get_key(p) for p in params_list]
+        self.n_call += len(keys)
+        new = {}
+        for key, params in zip(keys, params_list):
+            if key not in self.cache and key not in new:
+                new[key] = dict(zip(self.keys, key))
+        self.n_hit += len(keys) - len(new)
+
+        for key, record in zip(new, self._compute(list(new.values()))):
+            self.cache[key] = record
+            with open(self.eval_path, "a") as f:
+                f.write(json.dumps(record, default=sweep._json_default) + "\n")
+        return np.array([self.cache[key]["loss"] for key in keys])
+
+    def to_params(self, x):
+        x = np.array(x, dtype=float)
+        x[self.log] = 10 ** x[self.log]
+        return {k: float(v) for k, v in zip(self.keys, x)}
+
+    def to_x(self, params):
+        x = np.array([params[k] for k in self.keys], dtype=float)
+        x[self.log] = np.log10(np.abs(x[self.log]))
+        return x
+
+    def read_evaluations(self):
+        if not os.path.isfile(self.eval_path):
+            return []
+        with open(self.eval_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def table(self):
+        """
+        All evaluations (with those of previous runs) sorted by the loss.
+        """
+        table = pd.json_normalize(list(self.cache.values()))
+        table.columns = [c.replace("params.", "") for c in table.columns]
+        return table.sort_values("loss").reset_index(drop=True)
+
+    def calc_loss(self, PV):
+        return _calc_loss(self.ref, self.method, PV)
+
+    def _get_key(self, params):
+        return tuple(float(f"{params[k]:.{self.digits}g}") for k in self.keys)
+
+    def _compute(self, params_list):
+        if len(params_list) == 0:
+            return []
+        if self.forward is not None:
+            records = self._run_forwards(params_list)
+        else:
+            records = self._run_pipeline(params_list)
+        for r in records:
+            logger.info(f"Evaluated {r['params']}: loss = {r['loss']:.6g}")
+        return records
+
+    def _run_forwards(self, params_list):
+        n = len(params_list)
+        args = ([self.forward] * n, [self.ref] * n, [self.method] * n, params_list)
+        if self.n_proc <= 1 or n == 1:
+            return list(map(_run_forward, *args))
+        with ProcessPoolExecutor(min(self.n_proc, n)) as executor:
+            return list(executor.map(_run_forward, *args))
+
+    def _run_pipeline(self, params_list):
+        if self._grid is None:
+            self._grid = make_grid_from_config(self.config)
+        # Numbered after the existing point directories: failed points and
+        # runs with other digits are not in the cache but keep their dirs
+        start = _next_point_index(self.fit_dir)
+        common = (self.config, self.fit_dir, self.stages, self.pangle_deg, False)
+        args = [(start + i, p) + common for i, p in enumerate(params_list)]
+        if self.n_proc <= 1 or len(args) == 1:
+            sweep._init_worker(self._grid)
+            points = [sweep._run_point(*a) for a in args]
+        else:
+            n_proc = min(self.n_proc, len(args))
+            with ProcessPoolExecutor(
+                n_proc, initializer=sweep._init_worker, initargs=(self._grid,)
+            ) as executor:
+                points = list(executor.map(sweep._run_point, *zip(*args)))
+
+        records = []
+        for params, point in zip(params_list, points):
+            record = {"params": params, "loss": np.inf, "dir": point["dir"]}
+            if point["status"] == "done":
+                record["PV"] = point["PV"]
+                record["loss"] = self.calc_loss(tools.read_pickle(point["PV"]))
+            else:
+                record["error"] = point["error"]
+            records.append(record)
+        return records
+
+
+def _next_point_index(fit_dir):
+    indices = [
+        int(name[6:])
+        for name in os.listdir(fit_dir)
+        if name.startswith("point_") and name[6:].isdigit()
+    ]
+    return max(indices, default=-1) + 1
+
+
+def _calc_loss(ref, method, PV):
+    score = ref.correlate(PV, method=method)
+    loss = 1 - score if method == "ZNCC" else score
+    return loss if np.isfinite(loss) else np.inf
+
+
+def _run_forward(forward, ref, method, params):
+    try:
+        return {"params": params, "loss": _calc_loss(ref, method, forward(params))}
+    except Exception as e:
+        return {"params": params, "loss": np.inf, "error": f"{type(e).__name__}: {e}"}
+
+
+def minimize(objective, x0, bounds, method="Nelder-Mead", **kwargs):
+    """
+    Minimize a CachedObjective from x0 (dict) within bounds (dict of
+    (min, max)). method is a scipy.optimize.minimize method or
+    "differential_evolution", whose populations are evaluated as batches.
+    Returns the scipy result with the best parameters as `params`.
+
+    Gradient-based methods get, unless jac is given, a forward-difference
+    gradient whose steps (rel_step * max(1, |x|)) are far above the
+    rounding of the cache keys, evaluated as one batch; rel_step
+    defaults to 10**(3 - digits).
+    """
+    lo = objective.to_x({k: bounds[k][0] for k in objective.keys})
+    hi = objective.to_x({k: bounds[k][1] for k in objective.keys})
+    xbounds = list(zip(np.minimum(lo, hi), np.maximum(lo, hi)))
+
+    if method == "differential_evolution":
+        res = optimize.differential_evolution(
+            lambda X: objective.evaluate(X.T),
+            xbounds,
+            x0=objective.to_x(x0),
+            vectorized=True,
+            updating="deferred",
+            **kwargs,
+        )
+    else:
+        rel_step = kwargs.pop("rel_step", 10.0 ** (3 - objective.digits))
+        if method not in DERIVATIVE_FREE and "jac" not in kwargs:
+            kwargs["jac"] = lambda x: _calc_gradient(objective, x, xbounds, rel_step)
+        res = optimize.minimize(
+            objective, objective.to_x(x0), method=method, bounds=xbounds, **kwargs
+        )
+    res.params = objective.to_params(res.x)
+    logger.info(
+        f"Best fit {res.params}: loss = {res.fun:.6g} "
+        f"({objective.n_call} calls, {objective.n_hit} cached)"
+    )
+    return res
+
+
+def _calc_gradient(objective, x, xbounds, rel_step):
+    h = rel_step * np.maximum(1, np.abs(x))
+    hi = np.array([b[1] for b in xbounds])
+    h = np.where(x + h > hi, -h, h)
+    X = np.vstack([x, x + np.diag(h)])
+    f = objective.evaluate(X)
+    return (f[1:] - f[0]) / h
+
+
+class EnsembleSampler:
+    """
+    Affine-invariant ensemble sampler (stretch move of Goodman & Weare
+    2010, as in emcee) of exp(-loss / temperature) with a uniform prior
+    within bounds in the fit parameters. The walkers are updated in two
+    halves, each half being one parallel batch of the objective.
+
+    example
+    ------------
+    sampler = EnsembleSampler(obj, bounds, n_walkers=16, temperature=1e-3)
+    chain, log_prob = sampler.run(1000)      # resumes from the checkpoint
+    """
+
+    def __init__(
+        self,
+        objective,
+        bounds,
+        n_walkers=16,
+        temperature=1.0,
+        a=2.0,
+        checkpoint="chain.npz",
+        checkpoint_every=10,
+        seed=None,
+    ):
+        self.objective = objective
+        self.ndim = len(objective.keys)
+        if n_walkers < 2 * self.ndim or n_walkers % 2:
+            raise Exception("n_walkers must be even and at least twice the dimension")
+        lo = objective.to_x({k: bounds[k][0] for k in objective.keys})
+        hi = objective.to_x({k: bounds[k][1] for k in objective.keys})
+        self.lo, self.hi = np.minimum(lo, hi), np.maximum(lo, hi)
+        self.n_walkers = n_walkers
+        self.temperature = temperature
+        self.a = a
+        self.checkpoint = os.path.join(objective.fit_dir, checkpoint)
+        self.checkpoint_every = checkpoint_every
+        self.rng = np.random.default_rng(seed)
+        self.chain = np.empty((0, n_walkers, self.ndim))
+        self.log_prob = np.empty((0, n_walkers))
+        self.n_accepted = 0
+        if os.path.isfile(self.checkpoint):
+            self.read_checkpoint()
+
+    def calc_log_prob(self, X):
+        inside = np.all((self.lo <= X) & (X <= self.hi), axis=1)
+        lp = np.full(len(X), -np.inf)
+        if np.any(inside):
+            lp[inside] = -self.objective.evaluate(X[inside]) / self.temperature
+        return lp
+
+    def run(self, n_steps, p0=None):
+        """
+        Run until the chain has n_steps steps. Without a checkpoint, the
+        walkers start from p0 (dict) with a small scatter, or uniformly
+        within the bounds.
+        """
+        if len(self.chain) != 0:
+            X, lp = self.chain[-1].copy(), self.log_prob[-1].copy()
+            logger.info(f"Resuming the ensemble sampler at step {len(self.chain)}")
+        else:
+            X = self._init_walkers(p0)
+            lp = self.calc_log_prob(X)
+
+        half = self.n_walkers // 2
+        steps, lps = [], []
+        for step in range(len(self.chain), n_steps):
+            for active, other in ((slice(0, half), slice(half, None)),
+                                  (slice(half, None), slice(0, half))):
+                z = ((self.a - 1) * self.rng.random(half) + 1) ** 2 / self.a
+                partners = X[other][self.rng.integers(half, size=half)]
+                Y = partners + z[:, np.newaxis] * (X[active] - partners)
+                lp_new = self.calc_log_prob(Y)
+                with np.errstate(invalid="ignore"):
+                    log_ratio = (self.ndim - 1) * np.log(z) + lp_new - lp[active]
+                accept = np.log(self.rng.random(half)) < log_ratio
+                X[active] = np.where(accept[:, np.newaxis], Y, X[active])
+                lp[active] = np.where(accept, lp_new, lp[active])
+                self.n_accepted += np.sum(accept)
+            steps.append(X.copy())
+            lps.append(lp.copy())
+
+            if (step + 1) % self.checkpoint_every == 0 or step + 1 == n_steps:
+                self.chain = np.concatenate([self.chain, steps])
+                self.log_prob = np.concatenate([self.log_prob, lps])
+                steps, lps = [], []
+                self.save_checkpoint()
+                logger.info(
+                    f"Ensemble sampler: step {step + 1}/{n_steps}, acceptance "
+                    f"{self.n_accepted / self.chain.size * self.ndim:.2f}, "
+                    f"best {self.get_best()}"
+                )
+        return self.chain, self.log_prob
+
+    def get_best(self):
+        i = np.unravel_index(np.argmax(self.log_prob), self.log_prob.shape)
+        return self.objective.to_params(self.chain[i])
+
+    def get_samples(self, burn=0, thin=1):
+        """
+        Samples in the physical parameters as a DataFrame.
+        """
+        X = self.chain[burn::thin].reshape(-1, self.ndim).copy()
+        X[:, self.objective.log] = 10 ** X[:, self.objective.log]
+        return pd.DataFrame(X, columns=self.objective.keys)
+
+    def save_checkpoint(self):
+        tmp = self.checkpoint + ".tmp.npz"
+        np.savez(
+            tmp,
+            chain=self.chain,
+            log_prob=self.log_prob,
+            n_accepted=self.n_accepted,
+            rng_state=json.dumps(self.rng.bit_generator.state),
+        )
+        os.replace(tmp, self.checkpoint)
+
+    def read_checkpoint(self):
+        with np.load(self.checkpoint) as npz:
+            if npz["chain"].shape[1:] != (self.n_walkers, self.ndim):
+                raise Exception(f"Checkpoint {self.checkpoint} has another shape")
+            self.chain = npz["chain"]
+            self.log_prob = npz["log_prob"]
+            self.n_accepted = int(npz["n_accepted"])
+            self.rng.bit_generator.state = json.loads(str(npz["rng_state"]))
+
+    def _init_walkers(self, p0):
+        if p0 is None:
+            return self.lo + (self.hi - self.lo) * self.rng.random(
+                (self.n_walkers, self.ndim)
+            )
+        x0 = self.objective.to_x(p0)
+        scale = 1e-2 * (self.hi - self.lo)
+        X = x0 + scale * self.rng.standard_normal((self.n_walkers, self.ndim))
+        return np.clip(X, self.lo, self.hi)
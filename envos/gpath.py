@@ -1,4 +1,6 @@
 import os
+from contextlib import contextmanager
+from dataclasses import dataclass
 
 
 def joinpath(basepath, relpath):
@@ -86,3 +88,77 @@ run_dir = joinpath("./", "run")
 radmc_dir = joinpath(run_dir, "radmc")
 fig_dir = joinpath(run_dir, "fig")
 logfile = joinpath(run_dir, "log.dat")
+
+
+##############################################################################
+"""
+Run context
+
+The module-level paths above are process-wide. A RunContext holds the
+same directories for one pipeline, so that several pipelines can run
+concurrently in one interpreter (threads, asyncio). Classes that take
+a `context` argument only use the directories of their context; when
+none is given, it is made from the config or from the globals above.
+"""
+
+
+@dataclass
+class RunContext:
+    run_dir: str = None
+    radmc_dir: str = None
+    fig_dir: str = None
+    storage_dir: str = None
+    logfile: str = None
+
+    def __post_init__(self):
+        if self.run_dir is None:
+            self.run_dir = run_dir
+            self.radmc_dir = self.radmc_dir or radmc_dir
+            self.fig_dir = self.fig_dir or fig_dir
+            self.logfile = self.logfile or logfile
+        self.run_dir = os.path.abspath(self.run_dir)
+        self.radmc_dir = self.radmc_dir or joinpath(self.run_dir, "radmc")
+        self.fig_dir = self.fig_dir or joinpath(self.run_dir, "fig")
+        self.logfile = self.logfile or joinpath(self.run_dir, "log.dat")
+        self.storage_dir = self.storage_dir or storage_dir
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            run_dir=config.run_dir,
+            radmc_dir=config.radmc_dir,
+            fig_dir=config.fig_dir,
+            storage_dir=config.storage_dir,
+            logfile=config.logfile,
+        )
+
+    def make_dirs(self, run=False, radmc=False, fig=False):
+        for flag, path in ((run, self.run_dir), (radmc, self.radmc_dir), (fig, self.fig_dir)):
+            if flag:
+                os.makedirs(path, exist_ok=True)
+
+
+@contextmanager
+def keep_global_dirs():
+    """
+    Restores the module-level paths and the log file handlers on exit,
+    e.g. around a Config made for a single point of a sweep, whose
+    __post_init__ sets them.
+    """
+    global storage_dir, run_dir, radmc_dir, fig_dir, logfile
+    from envos import log
+
+    saved = (storage_dir, run_dir, radmc_dir, fig_dir, logfile, log.enable_saving)
+    try:
+        yield
+    finally:
+        storage_dir, run_dir, radmc_dir, fig_dir, logfile, log.enable_saving = saved
+        log.update_file_handler_for_all_loggers()
+
+
+def get_context(context=None, config=None):
+    if context is not None:
+        return context
+    if config is not None:
+        return RunContext.from_config(config)
+    return RunContext()
@@ -1,3 +1,4 @@
+from functools import cached_property
 import numpy as np
 import envos.nconst as nc
 from envos.log import set_logger
@@ -5,6 +6,16 @@ logger = set_logger(__name__)
 
 
 class Grid:
+    """
+    Spherical-polar grid.
+
+    The 3D coordinate arrays (rr, tt, pp, R, z) are computed on first
+    access and cached. They are read-only broadcast views of the 1D axes
+    (R and z of the meridional plane), so they cost almost no memory.
+    """
+
+    DERIVED = ("rr", "tt", "pp", "R", "z")
+
     def __init__(
         self,
         ri_ax=None,
@@ -42,8 +53,6 @@ class Grid:
             return None
 
         self.set_cellcenter_axes()
-        self.set_meshgrid()
-        self.set_cylyndrical_coord()
         self.show_grid_info()
 
     def set_cellcenter_axes(self):
@@ -51,13 +60,37 @@ class Grid:
         self.tc_ax = 0.5 * (self.ti_ax[0:-1] + self.ti_ax[1:])
         self.pc_ax = 0.5 * (self.pi_ax[0:-1] + self.pi_ax[1:])
 
-    def set_meshgrid(self):
-        axes = (self.rc_ax, self.tc_ax, self.pc_ax)
-        self.rr, self.tt, self.pp = np.meshgrid(*axes, indexing="ij")
+    @property
+    def shape(self):
+        return (len(self.rc_ax), len(self.tc_ax), len(self.pc_ax))
+
+    @cached_property
+    def rr(self):
+        return np.broadcast_to(self.rc_ax[:, np.newaxis, np.newaxis], self.shape)
+
+    @cached_property
+    def tt(self):
+        return np.broadcast_to(self.tc_ax[np.newaxis, :, np.newaxis], self.shape)
 
-    def set_cylyndrical_coord(self):
-        self.R = self.rr * np.sin(self.tt)
-        self.z = self.rr * np.cos(self.tt)
+    @cached_property
+    def pp(self):
+        return np.broadcast_to(self.pc_ax[np.newaxis, np.newaxis, :], self.shape)
+
+    @cached_property
+    def R(self):
+        R = self.rc_ax[:, np.newaxis] * np.sin(self.tc_ax)
+        return broadcast_phi(R, len(self.pc_ax))
+
+    @cached_property
+    def z(self):
+        z = self.rc_ax[:, np.newaxis] * np.cos(self.tc_ax)
+        return broadcast_phi(z, len(self.pc_ax))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in self.DERIVED:
+            state.pop(name, None)
+        return state
 
     def calc_interface_coord(
         self,
@@ -101,6 +134,28 @@ class Grid:
         logger.info("")
 
 
+def make_grid_from_config(config):
+    return Grid(
+        config.ri_ax, config.ti_ax, config.pi_ax,
+        rau_lim=[config.rau_in, config.rau_out],
+        theta_lim=[config.theta_in, config.theta_out],
+        phi_lim=[config.phi_in, config.phi_out],
+        nr=config.nr,
+        ntheta=config.ntheta,
+        nphi=config.nphi,
+        dr_to_r=config.dr_to_r,
+        aspect_ratio=config.aspect_ratio,
+        logr=config.logr,
+    )
+
+
+def calc_cell_volume(ri_ax, ti_ax, pi_ax):
+    dr3 = np.diff(ri_ax ** 3) / 3
+    dmu = -np.diff(np.cos(ti_ax))
+    dphi = np.diff(pi_ax)
+    return dr3[:, np.newaxis, np.newaxis] * dmu[:, np.newaxis] * dphi
+
+
 def get_interface_coord(
     rau_lim=None,
     theta_lim=(0, np.pi / 2),
@@ -130,3 +185,125 @@ def get_interface_coord(
 
     return ri_ax, ti_ax, pi_ax
 
+
+
+"""
+Axisymmetric fields
+
+An axisymmetric field is stored once as a (nr, ntheta, 1) array and is
+exposed as a read-only (nr, ntheta, nphi) view made by np.broadcast_to.
+Such a view has a zero stride in phi, which is how it is recognized.
+"""
+
+
+def broadcast_phi(value, nphi):
+    value = np.asarray(value)
+    if value.ndim == 2:
+        value = value[:, :, np.newaxis]
+    return np.broadcast_to(value, value.shape[:2] + (nphi,))
+
+
+def is_axisymmetric(value):
+    return (
+        isinstance(value, np.ndarray)
+        and value.ndim == 3
+        and (value.shape[2] == 1 or value.strides[2] == 0)
+    )
+
+
+def to_compact(value):
+    if is_axisymmetric(value):
+        return value[:, :, :1]
+    return value
+
+
+def zeros_field(shape):
+    """
+    Read-only zero field of the given shape without allocating it.
+    """
+    return np.broadcast_to(np.zeros(1), shape)
+
+
+def expand_like(value, ref):
+    if is_axisymmetric(ref):
+        return broadcast_phi(value, ref.shape[2])
+    return value
+
+
+class FieldSampler:
+    """
+    Bilinear interpolation of fields on the (r, theta) cell centers of a
+    grid, with linear extrapolation outside, as RegularGridInterpolator
+    with fill_value=None.
+
+    example
+    ------------
+    sampler = FieldSampler(grid.rc_ax, grid.tc_ax, vr[:, :, 0], vt[:, :, 0])
+    vr_p, vt_p = sampler(points)       # points: (..., 2) array of (r, theta)
+    rho_p = sampler(points, rhogas)    # other fields on the same axes
+
+    The cell index is computed directly when the axis is log-uniform
+    (r) or uniform (theta), and by bisection otherwise. The index and
+    weights are shared by all fields sampled in one call.
+    """
+
+    def __init__(self, r_ax, t_ax, *fields):
+        self.r_ax = np.asarray(r_ax, dtype=float)
+        self.t_ax = np.asarray(t_ax, dtype=float)
+        self.fields = [np.asarray(f) for f in fields]
+        self._r_lookup = self._make_lookup(self.r_ax, log=True)
+        self._t_lookup = self._make_lookup(self.t_ax, log=False)
+
+    @staticmethod
+    def _make_lookup(ax, log):
+        if len(ax) < 2:
+            raise Exception("FieldSampler needs at least two points per axis")
+        for islog in ((True, False) if log else (False,)):
+            if islog and ax[0] <= 0:
+                continue
+            u = np.log(ax) if islog else ax
+            du = np.diff(u)
+            if np.allclose(du, du[0], rtol=1e-8, atol=0):
+                return islog, u[0], (u[-1] - u[0]) / (len(ax) - 1)
+        return None
+
+    @staticmethod
+    def _find_index(x, ax, lookup):
+        n = len(ax)
+        if lookup is None:
+            i = np.clip(np.searchsorted(ax, x, side="right") - 1, 0, n - 2)
+        else:
+            islog, u0, du = lookup
+            with np.errstate(divide="ignore", invalid="ignore"):
+                u = (np.log(x) if islog else x) - u0
+            u = np.nan_to_num(u / du, nan=0, posinf=n, neginf=-1)
+            i = np.clip(np.floor(u), 0, n - 2).astype(int)
+            # Round-off at cell boundaries
+            i = i - ((i > 0) & (x < ax[i]))
+            i = i + ((i < n - 2) & (x >= ax[i + 1]))
+        w = (x - ax[i]) / (ax[i + 1] - ax[i])
+        return i, w
+
+    def locate(self, points):
+        points = np.asarray(points, dtype=float)
+        i, wr = self._find_index(points[..., 0], self.r_ax, self._r_lookup)
+        j, wt = self._find_index(points[..., 1], self.t_ax, self._t_lookup)
+        return i, j, wr, wt
+
+    def __call__(self, points, *fields):
+        """
+        Returns the values of the given fields (the fields of the sampler
+        by default) at the points: one array for one field, otherwise a
+        list. Trailing axes of a field (e.g. phi) are kept.
+        """
+        fields = [np.asarray(f) for f in fields] or self.fields
+        i, j, wr, wt = self.locate(points)
+        values = []
+        for f in fields:
+            ext = (np.newaxis,) * (f.ndim - 2)
+            a, b = wr[(...,) + ext], wt[(...,) + ext]
+            values.append(
+                (1 - a) * ((1 - b) * f[i, j] + b * f[i, j + 1])
+                + a * ((1 - b) * f[i + 1, j] + b * f[i + 1, j + 1])
+            )
+        return values[0] if len(values) == 1 else values
@@ -0,0 +1,279 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from envos.obs import PVmap, ObsData3D
+from envos.thermal_store import calc_param_distance
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Library of model PV maps and cubes on disk
+
+An ObsLibrary keeps the images of a model grid in a directory:
+
+    <library_dir>/
+        index.jsonl              : one record per image (id, params, location)
+        axes_<group>.npz         : axes shared by a group of images
+        <kind>_<group>_XXXXX.npy : chunk of up to chunk_size images of a group
+
+Images with the same kind ("PV" or "cube"), shape and axes form a group
+and are stored in chunks, which are read as memory maps: a PVmap (or
+ObsData3D) is loaded as a view of its chunk, and many images of a group
+as one array, without unpickling anything. By default a chunk holds as
+many images as fit in CHUNK_BYTES (at most 256), so a chunk of large
+cubes is not mostly empty. The data of an image is
+written before its record is appended to the index, so the library can
+be read while a sweep is adding to it. There should be a single writer.
+"""
+
+INDEX_FILENAME = "index.jsonl"
+CHUNK_BYTES = 64 * 2 ** 20
+KINDS = {
+    "PV": (PVmap, "Ipv", ("vkms", "xau")),
+    "cube": (ObsData3D, "Ippv", ("xau", "yau", "vkms")),
+}
+
+
+class ObsLibrary:
+    """
+    example
+    ------------
+    lib = ObsLibrary("./library")
+    lib.add(PV, {"CR_au": 100, "Ms_Msun": 0.3})
+    table = lib.query(CR_au=(50, 200), Ms_Msun=0.3)
+    nearest = lib.nearest({"CR_au": 120, "Ms_Msun": 0.25}, k=4)
+    PV = lib.get(nearest["id"].iloc[0])
+    Ipv = lib.get_array(table["id"])        # (n, nv, nx)
+    """
+
+    def __init__(self, library_dir, chunk_size=None):
+        self.library_dir = os.path.abspath(library_dir)
+        self.index_path = os.path.join(self.library_dir, INDEX_FILENAME)
+        self.chunk_size = chunk_size
+        self._records = {}
+        self._group_last = {}
+        self._axes = {}
+        self._chunks = {}
+        self._index_pos = 0
+        os.makedirs(self.library_dir, exist_ok=True)
+        self.refresh()
+
+    def __len__(self):
+        return len(self._records)
+
+    def refresh(self):
+        """
+        Read the records appended to the index since the last call.
+        """
+        if not os.path.isfile(self.index_path):
+            return
+        with open(self.index_path) as f:
+            f.seek(self._index_pos)
+            lines = f.readlines()
+        for line in lines:
+            if not line.endswith("\n"):
+                break
+            self._index_pos += len(line.encode())
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            self._records[record["id"]] = record
+            self._group_last[record["group"]] = record
+
+    def add(self, obsdata, params):
+        """
+        Store a PVmap or ObsData3D with its parameters; returns its id.
+        """
+        kind = _get_kind(obsdata)
+        _, data_name, axis_names = KINDS[kind]
+        data = np.asarray(getattr(obsdata, data_name))
+        axes = {k: np.asarray(getattr(obsdata, k), dtype=float) for k in axis_names}
+        group = _get_group(kind, data, axes)
+
+        self.refresh()
+        last = self._group_last.get(group)
+        if last is None:
+            np.savez(self._axes_path(group), **axes)
+            filename, slot = f"{kind}_{group}_00000.npy", 0
+        else:
+            # The next slot of the last chunk, whatever chunk_size it was
+            # written with, or a new chunk
+            filename, slot = last["file"], last["slot"] + 1
+            if slot == len(self._get_chunk(filename)):
+                number = int(filename[-9:-4]) + 1
+                filename, slot = f"{kind}_{group}_{number:05d}.npy", 0
+        path = os.path.join(self.library_dir, filename)
+        if slot == 0:
+            chunk_size = self.chunk_size or int(
+                np.clip(CHUNK_BYTES // max(data.nbytes, 1), 1, 256)
+            )
+            np.lib.format.open_memmap(
+                path, mode="w+", dtype=data.dtype, shape=(chunk_size,) + data.shape
+            ).flush()
+            self._chunks.pop(filename, None)
+        chunk = np.load(path, mmap_mode="r+")
+        chunk[slot] = data
+        chunk.flush()
+        del chunk
+
+        record = {
+            "id": len(self._records),
+            "kind": kind,
+            "params": {k: _to_json(v) for k, v in params.items()},
+            "group": group,
+            "file": filename,
+            "slot": slot,
+            "meta": _get_meta(obsdata, data_name, axis_names),
+        }
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.refresh()
+        return record["id"]
+
+    def table(self, kind=None):
+        """
+        DataFrame of id, kind, group and parameters of all images.
+        """
+        self.refresh()
+        rows = [
+            {"id": r["id"], "kind": r["kind"], "group": r["group"], **r["params"]}
+            for r in self._records.values()
+            if kind is None or r["kind"] == kind
+        ]
+        return pd.DataFrame(rows)
+
+    def query(self, kind=None, **conditions):
+        """
+        Images whose parameters satisfy all conditions: a (min, max) tuple
+        is an inclusive range, any other value must be matched.
+        """
+        table = self.table(kind)
+        if len(table) == 0:
+            return table
+        sel = np.ones(len(table), dtype=bool)
+        for k, cond in conditions.items():
+            if k not in table:
+                return table.iloc[:0]
+            col = table[k]
+            if isinstance(cond, tuple):
+                sel &= (cond[0] <= col) & (col <= cond[1])
+            elif isinstance(cond, str):
+                sel &= col == cond
+            else:
+                sel &= np.isclose(col, cond, rtol=1e-10, atol=0)
+        return table[sel].reset_index(drop=True)
+
+    def nearest(self, params, k=1, kind=None):
+        """
+        The k images nearest to params, by the relative parameter distance
+        of thermal_store. Only images that have all keys of params count.
+        """
+        table = self.table(kind)
+        keys = list(params.keys())
+        if len(table) == 0 or any(key not in table for key in keys):
+            return table.iloc[:0]
+        table = table.dropna(subset=keys)
+        x = np.array([[float(params[key]) for key in keys]])
+        xs = table[keys].to_numpy(dtype=float)
+        dist = calc_param_distance(x, xs)
+        order = np.argsort(dist, kind="stable")[:k]
+        table = table.iloc[order].copy()
+        table["distance"] = dist[order]
+        return table.reset_index(drop=True)
+
+    def get(self, ident, copy=False):
+        """
+        The PVmap or ObsData3D of an id. Its data is a read-only view of
+        the memory-mapped chunk unless copy=True.
+        """
+        record = self._get_record(ident)
+        cls, data_name, _ = KINDS[record["kind"]]
+        data = self._get_chunk(record["file"])[record["slot"]]
+        obsdata = cls()
+        setattr(obsdata, data_name, np.array(data) if copy else data)
+        for k, v in self._get_axes(record["group"]).items():
+            setattr(obsdata, k, v.copy())
+        for k, v in record["meta"].items():
+            setattr(obsdata, k, v)
+        return obsdata
+
+    def get_array(self, idents):
+        """
+        Data of many images of one group as an array (n, ...).
+        """
+        records = [self._get_record(i) for i in idents]
+        if len(records) == 0:
+            return np.array([])
+        if len(set(r["group"] for r in records)) != 1:
+            raise Exception("Images have different shapes or axes")
+        shape = self._get_chunk(records[0]["file"]).shape[1:]
+        out = np.empty((len(records),) + shape)
+        files = np.array([r["file"] for r in records])
+        slots = np.array([r["slot"] for r in records])
+        for filename in np.unique(files):
+            sel = files == filename
+            out[sel] = self._get_chunk(filename)[slots[sel]]
+        return out
+
+    def get_axes(self, ident):
+        return self._get_axes(self._get_record(ident)["group"])
+
+    def _get_record(self, ident):
+        ident = int(ident)
+        if ident not in self._records:
+            self.refresh()
+        if ident not in self._records:
+            raise Exception(f"No image with id {ident} in {self.library_dir}")
+        return self._records[ident]
+
+    def _get_chunk(self, filename):
+        if filename not in self._chunks:
+            path = os.path.join(self.library_dir, filename)
+            self._chunks[filename] = np.load(path, mmap_mode="r")
+        return self._chunks[filename]
+
+    def _get_axes(self, group):
+        if group not in self._axes:
+            with np.load(self._axes_path(group)) as npz:
+                self._axes[group] = {k: npz[k] for k in npz.files}
+        return self._axes[group]
+
+    def _axes_path(self, group):
+        return os.path.join(self.library_dir, f"axes_{group}.npz")
+
+
+def _get_kind(obsdata):
+    for kind, (cls, _, _) in KINDS.items():
+        if isinstance(obsdata, cls):
+            return kind
+    raise Exception(f"Unknown obsdata type: {type(obsdata).__name__}")
+
+
+def _get_group(kind, data, axes):
+    h = hashlib.sha1(f"{kind}|{data.shape}|{data.dtype}".encode())
+    for v in axes.values():
+        h.update(v.tobytes())
+    return h.hexdigest()[:12]
+
+
+def _get_meta(obsdata, data_name, axis_names):
+    # Scalar attributes (dpc, beam, obs info...) are kept in the index
+    meta = {}
+    for k, v in vars(obsdata).items():
+        if k in axis_names or k == data_name:
+            continue
+        if isinstance(v, np.generic):
+            v = v.item()
+        if v is None or isinstance(v, (bool, int, float, str)):
+            meta[k] = v
+    return meta
+
+
+def _to_json(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
@@ -0,0 +1,110 @@
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from envos import gpath
+from envos.radmc3d import RadmcController
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+
+def split_cores(n_core, n_run, threads_per_run=None):
+    """
+    Split a core budget into (threads per mctherm run, concurrent runs).
+    By default as many runs as possible are concurrent, since one
+    radmc3d mctherm scales sublinearly with setthreads.
+    """
+    if threads_per_run is None:
+        n_concurrent = max(1, min(n_run, n_core))
+        threads_per_run = max(1, n_core // n_concurrent)
+    else:
+        n_concurrent = max(1, min(n_run, n_core // threads_per_run))
+    return threads_per_run, n_concurrent
+
+
+class McthermFarm:
+    """
+    Run mctherm for many prepared models concurrently on one node.
+
+    example
+    ------------
+    farm = McthermFarm(config, n_core=64, farm_dir="./farm")
+    records = farm.run(models)
+
+    Every model gets its own radmc directory (farm_dir/run_XXXXX).
+    n_core is split between `radmc3d mctherm setthreads` and the number
+    of radmc3d processes running at once (see split_cores). The
+    temperatures are set back into the models with set_gas_temperature.
+    """
+
+    def __init__(
+        self,
+        config,
+        n_core=None,
+        threads_per_run=None,
+        farm_dir="./mctherm_farm",
+        context=None,
+    ):
+        self.config = config
+        self.n_core = n_core or os.cpu_count()
+        self.threads_per_run = threads_per_run
+        self.farm_dir = os.path.abspath(farm_dir)
+        self.context = gpath.get_context(context, config)
+
+    def run(self, models, configs=None):
+        """
+        models: list of models with gas density set.
+        configs: optional list of Configs, one per model (e.g. different
+                 stellar luminosities); the farm's config by default.
+        Returns one record per model with its status and run time.
+        """
+        if configs is None:
+            configs = [self.config] * len(models)
+        if len(configs) != len(models):
+            raise Exception(
+                f"Number of configs ({len(configs)}) differs from "
+                f"the number of models ({len(models)})"
+            )
+        threads, n_concurrent = split_cores(
+            self.n_core, len(models), self.threads_per_run
+        )
+        logger.info(
+            f"mctherm farm: {len(models)} models, {n_concurrent} concurrent runs "
+            f"x {threads} threads ({self.n_core} cores)"
+        )
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(n_concurrent) as executor:
+            futures = [
+                executor.submit(self._run_one, i, model, conf, threads)
+                for i, (model, conf) in enumerate(zip(models, configs))
+            ]
+            records = [fut.result() for fut in as_completed(futures)]
+        records.sort(key=lambda r: r["index"])
+
+        self.wall_time = time.perf_counter() - t0
+        n_done = sum(r["status"] == "done" for r in records)
+        logger.info(
+            f"mctherm farm: {n_done}/{len(models)} done in {self.wall_time:.1f} s"
+        )
+        return records
+
+    def _run_one(self, i, model, config, n_thread):
+        radmc_dir = os.path.join(self.farm_dir, f"run_{i:05d}")
+        record = {"index": i, "radmc_dir": radmc_dir, "n_thread": n_thread}
+        t0 = time.perf_counter()
+        try:
+            radmc = RadmcController(
+                config=config, radmc_dir=radmc_dir, context=self.context
+            )
+            radmc.n_thread = n_thread
+            model.set_gas_temperature(radmc.calc_gas_temperature(model))
+            record["status"] = "done"
+        except Exception as e:
+            record["status"] = "failed"
+            record["error"] = f"{type(e).__name__}: {e}"
+            logger.error(traceback.format_exc())
+        record["time"] = time.perf_counter() - t0
+        return record
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from envos.models import (
     CircumstellarModel,
@@ -5,18 +6,23 @@ from envos.models import (
     SimpleBallisticInnerEnvelope,
     TerebeyOuterEnvelope,
     ExptailDisk,
+    SigmaProfileDisk,
 )
 from envos.radmc3d import RadmcController
+from envos.radeq import calc_radeq_temperature
+from envos.thermal_store import ThermalStore
 from envos.log import set_logger
-from envos.grid import Grid
+from envos.grid import Grid, make_grid_from_config, broadcast_phi, is_axisymmetric, to_compact
 from envos.physical_params import PhysicalParameters
-from envos import tools
+from envos import tools, gpath
+from envos.model_io import read_model_dir
 logger = set_logger(__name__)
 
 
 class ModelGenerator:
     # def __init__(self, filepath=None, grid=None, ppar=None):
-    def __init__(self, config=None):
+    def __init__(self, config=None, grid=None, context=None):
+        self.context = gpath.get_context(context, config)
         self.grid = None
         self.ppar = None
         self.inenv = None
@@ -25,24 +31,16 @@ class ModelGenerator:
         self.model = CircumstellarModel()
 
         if config is not None:
-            self.init_from_config(config)
+            self.init_from_config(config, grid=grid)
+        elif grid is not None:
+            self.set_grid(grid=grid)
 
-    def init_from_config(self, config):
+    def init_from_config(self, config, grid=None):
         self.config = config
 
         try:
-            grid = Grid(
-                config.ri_ax, config.ti_ax, config.pi_ax,
-                rau_lim=[config.rau_in, config.rau_out],
-                theta_lim=[config.theta_in, config.theta_out],
-                phi_lim=[config.phi_in, config.phi_out],
-                nr=config.nr,
-                ntheta=config.ntheta,
-                nphi=config.nphi,
-                dr_to_r=config.dr_to_r,
-                aspect_ratio=config.aspect_ratio,
-                logr=config.logr,
-            )
+            if grid is None:
+                grid = make_grid_from_config(config)
             self.set_grid(grid=grid)
         except Exception as e:
             logger.info("Failed to generate grid.")
@@ -122,7 +120,7 @@ class ModelGenerator:
 
 
 
-    def calc_kinematic_structure(self, smoothing_TSC=True):
+    def calc_kinematic_structure(self, smoothing_TSC=True, n_thread=1, chunksize=None):
 
         ### Set grid
         #if grid is not None:
@@ -153,48 +151,43 @@ class ModelGenerator:
         self.set_disk(self.disk)
 
         ### Make kmodel
-        zeros = np.zeros_like(self.grid.rr)
-        rho = np.copy(zeros)
-        vr = np.copy(zeros)
-        vt = np.copy(zeros)
-        vp = np.copy(zeros)
         keys = ("rho", "vr", "vt", "vp")
         ismodel = lambda x: all(hasattr(x, k) for k in keys)
+        inenv = self.inenv if ismodel(self.inenv) else None
+        outenv = self.outenv if ismodel(self.outenv) else None
+        disk = self.disk if ismodel(self.disk) else None
+        components = [m for m in (inenv, outenv, disk) if m is not None]
 
-        if ismodel(self.inenv):
+        # If every component is axisymmetric, merge on (nr, ntheta, 1)
+        # arrays and broadcast in phi only at the end.
+        axisym = all(is_axisymmetric(m.rho) for m in components)
+        rr = self.grid.rr[:, :, :1] if axisym else self.grid.rr
+
+        if inenv is not None:
             logger.info("Setting inner envelop")
-            cond = rho < self.inenv.rho
-            rho[cond] = self.inenv.rho[cond]
-            vr[cond] = self.inenv.vr[cond]
-            vt[cond] = self.inenv.vt[cond]
-            vp[cond] = self.inenv.vp[cond]
-            self.model.set_mu0(self.inenv.mu0)
-
-        if ismodel(self.outenv):
+            self.model.set_mu0(inenv.mu0)
+        if outenv is not None:
             logger.info("Setting outer envelop")
-            if smoothing_TSC:
-                fac = np.exp(-(0.3*self.outenv.rin_lim/self.grid.rr)**2 )
-                rho += (self.outenv.rho - rho )* fac * np.where(rho!=0, 1, 0)
-                vr += (self.outenv.vr - vr) * fac
-                vt += (self.outenv.vt - vt) * fac
-                vp += (self.outenv.vp - vp) * fac
-
-            else:
-                cond1 = rho < self.outenv.rho
-                cond2 = self.grid.rr > 1/5* self.outenv.rin_lim
-                cond = cond1 & cond2
-                rho[cond] = self.outenv.rho[cond]
-                vr[cond] = self.outenv.vr[cond]
-                vt[cond] = self.outenv.vt[cond]
-                vp[cond] = self.outenv.vp[cond]
-
-        if ismodel(self.disk):
+        if disk is not None:
             logger.info("Setting disk")
-            cond = rho < self.disk.rho
-            rho[cond] = self.disk.rho[cond]
-            vr[cond] = self.disk.vr[cond]
-            vt[cond] = self.disk.vt[cond]
-            vp[cond] = self.disk.vp[cond]
+
+        # Closed-form trajectories hold only when the inner envelope is alone
+        only_inenv = outenv is None and disk is None
+        self.model.set_orbit(getattr(inenv, "orbit", None) if only_inenv else None)
+
+        rho, vr, vt, vp = merge_components(
+            rr,
+            inenv=inenv,
+            outenv=outenv,
+            disk=disk,
+            smoothing_TSC=smoothing_TSC,
+            n_thread=n_thread,
+            chunksize=chunksize,
+        )
+
+        if axisym:
+            nphi = self.grid.rr.shape[2]
+            rho, vr, vt, vp = [broadcast_phi(v, nphi) for v in (rho, vr, vt, vp)]
 
         logger.info("Calculated kinematic structure")
         #if grid is not None:
@@ -242,6 +235,7 @@ class ModelGenerator:
                 self.ppar.cs,
                 self.ppar.Omega,
                 self.ppar.cavangle,
+                storage_dir=self.context.storage_dir,
             )
         else:
             raise Exception("Unknown outenv type")
@@ -262,35 +256,157 @@ class ModelGenerator:
                 meanmolw=self.ppar.meanmolw,
                 index=-1.0,
             )
+        elif callable(disk):
+            self.disk = SigmaProfileDisk(
+                self.grid,
+                self.ppar.Ms,
+                disk,
+                Td=30,
+                meanmolw=self.ppar.meanmolw,
+            )
         else:
             raise Exception("Unknown disk type")
 
-    def calc_thermal_structure(self):
-        logger.info("Calculating thermal structure")
-        # conf = self.radmc_config
-        radmc = RadmcController(config=self.config)
-        radmc.clean_radmc_dir()
-
-        radmc.set_model(self.model)
-        radmc.set_mctherm_inpfiles()
-        radmc.run_mctherm()
+    def calc_thermal_structure(self, temp_mode=None):
+        """
+        temp_mode: "mctherm" (RADMC-3D Monte Carlo) or "radeq"
+        (semi-analytic radiative equilibrium, see envos.radeq).
+        Defaults to config.temp_mode.
+        """
+        temp_mode = temp_mode or self.config.temp_mode
+        if temp_mode == "mctherm" and self.config.thermal_store is not None:
+            self.calc_thermal_structure_with_store()
+        elif temp_mode == "mctherm":
+            self.calc_thermal_structure_mctherm()
+        elif temp_mode == "radeq":
+            self.calc_thermal_structure_radeq()
+        else:
+            raise Exception(f"Unknown temp_mode: {temp_mode}")
+
+    def calc_thermal_structure_radeq(self):
+        logger.info("Calculating thermal structure (radiative equilibrium)")
+        self.model.set_gas_temperature(self.calc_radeq_temperature())
+
+    def calc_radeq_temperature(self):
+        conf = self.config
+        return calc_radeq_temperature(
+            self.model,
+            Lstar_Lsun=conf.Lstar_Lsun,
+            Rstar_Rsun=conf.Rstar_Rsun,
+            opac=conf.opac,
+            f_dg=conf.f_dg,
+            attenuation=conf.radeq_attenuation,
+            storage_dir=self.context.storage_dir,
+        )
 
-        rho = radmc.get_gas_density()
-        if not np.allclose(rho, self.model.rhogas, rtol=1e-07, atol=1e-20):
-            logger.error(
-                "Input value mismatches with that read by radmc3d: gas density"
-            )
-            raise Exception
+    def calc_thermal_structure_with_store(self):
+        """
+        mctherm, warm-started from the temperatures stored in
+        config.thermal_store (see envos.thermal_store).
+        """
+        store = ThermalStore(
+            self.config.thermal_store,
+            keys=self.config.thermal_store_keys,
+            tol=self.config.thermal_store_tol,
+        )
+        self.thermal_decision = store.calc_temperature(self)
 
-        Tgas = radmc.get_gas_temperature()
+    def calc_thermal_structure_mctherm(self, nphot=None):
+        logger.info("Calculating thermal structure")
+        # conf = self.radmc_config
+        radmc = RadmcController(config=self.config, context=self.context)
+        if nphot is not None:
+            radmc.nphot = nphot
+        Tgas = radmc.calc_gas_temperature(self.model)
+        self.mctherm_convergence = radmc.convergence
         self.model.set_gas_temperature(Tgas)
 
     def get_model(self):
         return self.model
 
 
-def read_model(path):
-    if ".pkl" in path:
+def merge_components(
+    rr,
+    inenv=None,
+    outenv=None,
+    disk=None,
+    smoothing_TSC=True,
+    n_thread=1,
+    chunksize=None,
+):
+    """
+    Compose rho, vr, vt, vp of the inner envelope, outer envelope and disk
+    on a grid of the shape of rr.
+
+    The output arrays are the only full-size allocations: the grid is
+    processed in chunks along r, and each chunk is blended in place with
+    chunk-sized temporaries. With n_thread >= 2, chunks are evaluated in
+    a thread pool (NumPy releases the GIL in the ufuncs used here).
+    """
+    keys = ("rho", "vr", "vt", "vp")
+    shape = rr.shape
+    out = [np.zeros(shape) for _ in keys]
+    getf = lambda m: [
+        np.broadcast_to(to_compact(getattr(m, k)), shape) for k in keys
+    ]
+    f_in = getf(inenv) if inenv is not None else None
+    f_out = getf(outenv) if outenv is not None else None
+    f_disk = getf(disk) if disk is not None else None
+    if outenv is not None:
+        rin_lim = np.broadcast_to(to_compact(outenv.rin_lim), shape)
+
+    if chunksize is None:
+        chunksize = max(1, 2 ** 18 // int(np.prod(shape[1:])))
+    slices = [slice(i, i + chunksize) for i in range(0, shape[0], chunksize)]
+
+    def overwrite_where_denser(o, f, cond=None):
+        _cond = o[0] < f[0]
+        if cond is not None:
+            _cond &= cond
+        for _o, _f in zip(o, f):
+            np.copyto(_o, _f, where=_cond)
+
+    def merge_chunk(sl):
+        o = [v[sl] for v in out]
+        if f_in is not None:
+            overwrite_where_denser(o, [v[sl] for v in f_in])
+
+        if f_out is not None:
+            f = [v[sl] for v in f_out]
+            if smoothing_TSC:
+                fac = 0.3 * rin_lim[sl]
+                fac /= rr[sl]
+                np.square(fac, out=fac)
+                np.negative(fac, out=fac)
+                np.exp(fac, out=fac)
+                buf = np.empty_like(fac)
+                for i, (_o, _f) in enumerate(zip(o, f)):
+                    np.subtract(_f, _o, out=buf)
+                    buf *= fac
+                    if i == 0:
+                        buf *= o[0] != 0
+                    _o += buf
+            else:
+                overwrite_where_denser(o, f, rr[sl] > 1 / 5 * rin_lim[sl])
+
+        if f_disk is not None:
+            overwrite_where_denser(o, [v[sl] for v in f_disk])
+
+    if n_thread >= 2:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(n_thread) as executor:
+            list(executor.map(merge_chunk, slices))
+    else:
+        for sl in slices:
+            merge_chunk(sl)
+
+    return out
+
+
+def read_model(path, lazy=True):
+    if os.path.isdir(path):
+        return read_model_dir(path, lazy=lazy)
+    elif ".pkl" in path:
         return tools.read_pickle(path)
     else:
         raise Exception("Still constructing...Sorry")
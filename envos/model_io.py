@@ -0,0 +1,207 @@
+import os
+import json
+import numpy as np
+
+from envos import tools
+from envos.grid import Grid, broadcast_phi, is_axisymmetric
+from envos.models import CircumstellarModel
+from envos.physical_params import PhysicalParameters
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Directory-based model format
+
+    <dirpath>/
+        meta.json     : format version, scalar attributes, ppar, field list
+        grid.npz      : interface axes of the grid (ri_ax, ti_ax, pi_ax)
+        <field>.npy   : one array per field (memory-mapped when read)
+        <field>.npz   : same, when saved with compress=True
+
+Axisymmetric (phi-broadcast) fields are saved as (nr, ntheta, 1) arrays
+and broadcast again when read. Fields are read only when accessed.
+"""
+
+FORMAT_NAME = "envos-model"
+FORMAT_VERSION = 1
+META_FILENAME = "meta.json"
+GRID_FILENAME = "grid.npz"
+GRID_ATTRS = ("rc_ax", "tc_ax", "pc_ax", "ri_ax", "ti_ax", "pi_ax")
+DERIVED = Grid.DERIVED + ("vR", "vz")
+SCALAR_TYPES = (bool, int, float, str, type(None))
+
+
+def save_model_dir(model, dirpath, compress=False):
+    os.makedirs(dirpath, exist_ok=True)
+    if isinstance(model, LazyCircumstellarModel):
+        model.load_all()
+
+    meta = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "class": model.__class__.__name__,
+        "attrs": {},
+        "fields": {},
+        "ppar": None,
+    }
+
+    grid = getattr(model, "grid", None)
+    if grid is not None or getattr(model, "ri_ax", None) is not None:
+        src = grid if grid is not None else model
+        np.savez(
+            os.path.join(dirpath, GRID_FILENAME),
+            ri_ax=src.ri_ax,
+            ti_ax=src.ti_ax,
+            pi_ax=src.pi_ax,
+        )
+
+    ppar = getattr(model, "ppar", None)
+    if ppar is not None:
+        meta["ppar"] = {
+            k: _to_builtin(v)
+            for k, v in vars(ppar).items()
+            if isinstance(_to_builtin(v), SCALAR_TYPES)
+        }
+
+    for name, value in vars(model).items():
+        if name in ("grid", "ppar") + GRID_ATTRS + DERIVED:
+            continue
+        if name.startswith("_"):
+            continue
+        if isinstance(value, np.ndarray) and value.ndim >= 1:
+            meta["fields"][name] = _save_field(dirpath, name, value, compress)
+        elif isinstance(_to_builtin(value), SCALAR_TYPES):
+            meta["attrs"][name] = _to_builtin(value)
+        else:
+            logger.warning(f"Skipped saving attribute {name} of type {type(value)}")
+
+    with open(os.path.join(dirpath, META_FILENAME), "w") as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"Saved : {dirpath}")
+
+
+def _save_field(dirpath, name, value, compress):
+    axisym = _is_constant_in_phi(value)
+    data = np.ascontiguousarray(value[:, :, :1] if axisym else value)
+    if compress:
+        filename = name + ".npz"
+        np.savez_compressed(os.path.join(dirpath, filename), data=data)
+    else:
+        filename = name + ".npy"
+        np.save(os.path.join(dirpath, filename), data)
+    return {
+        "file": filename,
+        "shape": list(value.shape),
+        "dtype": str(value.dtype),
+        "axisymmetric": bool(axisym),
+    }
+
+
+def _is_constant_in_phi(value):
+    # Also catches axisymmetric fields expanded by pickling
+    if value.ndim != 3 or value.shape[2] == 1:
+        return False
+    if is_axisymmetric(value):
+        return True
+    ref = value[:, :, :1]
+    return bool(np.all((value == ref) | (np.isnan(value) & np.isnan(ref))))
+
+
+def _to_builtin(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def read_model_dir(dirpath, lazy=True):
+    with open(os.path.join(dirpath, META_FILENAME)) as f:
+        meta = json.load(f)
+    if meta.get("format") != FORMAT_NAME:
+        raise Exception(f"Not an envos model directory: {dirpath}")
+
+    model = LazyCircumstellarModel()
+    model.__dict__.update(meta["attrs"])
+
+    if meta["ppar"] is not None:
+        ppar = PhysicalParameters.__new__(PhysicalParameters)
+        ppar.__dict__.update(meta["ppar"])
+        model.ppar = ppar
+
+    gridpath = os.path.join(dirpath, GRID_FILENAME)
+    if os.path.isfile(gridpath):
+        with np.load(gridpath) as axes:
+            ri_ax, ti_ax, pi_ax = axes["ri_ax"], axes["ti_ax"], axes["pi_ax"]
+        model.ri_ax, model.ti_ax, model.pi_ax = ri_ax, ti_ax, pi_ax
+        model.rc_ax = tools.make_array_center(ri_ax)
+        model.tc_ax = tools.make_array_center(ti_ax)
+        model.pc_ax = tools.make_array_center(pi_ax)
+        model.add_lazy_field("grid", lambda: Grid(ri_ax, ti_ax, pi_ax))
+
+    for name, info in meta["fields"].items():
+        model.add_lazy_field(name, _field_loader(dirpath, info))
+
+    if not lazy:
+        model.load_all()
+    return model
+
+
+def _field_loader(dirpath, info):
+    def load():
+        path = os.path.join(dirpath, info["file"])
+        if info["file"].endswith(".npz"):
+            with np.load(path) as npz:
+                data = npz["data"]
+        else:
+            data = np.load(path, mmap_mode="r")
+        if info["axisymmetric"]:
+            data = broadcast_phi(data, info["shape"][2])
+        return data
+
+    return load
+
+
+def convert_pickle(pklpath, dirpath=None, compress=False):
+    """
+    Convert a model saved with save_pickle into the directory format.
+    """
+    if dirpath is None:
+        dirpath = os.path.splitext(pklpath)[0]
+    model = tools.read_pickle(pklpath)
+    save_model_dir(model, dirpath, compress=compress)
+    return dirpath
+
+
+class LazyCircumstellarModel(CircumstellarModel):
+    """
+    CircumstellarModel whose fields are read from disk on first access.
+    """
+
+    def add_lazy_field(self, name, loader):
+        lazy = self.__dict__.setdefault("_lazy_fields", {})
+        lazy[name] = loader
+        self.__dict__.pop(name, None)
+
+    def load_all(self):
+        for name in list(self.__dict__.get("_lazy_fields", {})):
+            getattr(self, name)
+
+    def __getattribute__(self, name):
+        lazy = object.__getattribute__(self, "__dict__").get("_lazy_fields")
+        if lazy and name in lazy:
+            value = lazy.pop(name)()
+            object.__setattr__(self, name, value)
+            return value
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name, value):
+        lazy = self.__dict__.get("_lazy_fields")
+        if lazy:
+            lazy.pop(name, None)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        self.load_all()
+        state = super().__getstate__()
+        state.pop("_lazy_fields", None)
+        return state
@@ -7,32 +7,104 @@ from dataclasses import dataclass
 from typing import Callable, Any
 from envos import tools, cubicsolver, tsc
 from .nconst import G, kB, amu, au
-from .gpath import run_dir
+from . import gpath
 from .log import set_logger
 from . import tools
+from .grid import broadcast_phi, to_compact, expand_like, zeros_field
 
 logger = set_logger(__name__)
 
+def _grid_property(name):
+    # Coordinates are taken from the shared grid. A value set explicitly
+    # (e.g. by models pickled before grids were shared) takes precedence.
+    def getter(self):
+        if name in self.__dict__:
+            return self.__dict__[name]
+        grid = getattr(self, "grid", None)
+        return getattr(grid, name) if grid is not None else None
+
+    def setter(self, value):
+        self.__dict__[name] = value
+
+    return property(getter, setter)
+
+
 class ModelBase:
+    rr = _grid_property("rr")
+    tt = _grid_property("tt")
+    pp = _grid_property("pp")
+    R = _grid_property("R")
+    z = _grid_property("z")
+
     def read_grid(self, grid):
-        for k, v in grid.__dict__.items():
-            setattr(self, k, v)
+        self.grid = grid
+        for k in ("ri_ax", "ti_ax", "pi_ax", "rc_ax", "tc_ax", "pc_ax"):
+            setattr(self, k, getattr(grid, k))
+
+    def calc_cylindrical_velocity(self):
+        vr = to_compact(self.vr)
+        vt = to_compact(self.vt)
+        tt = self.tt[:, :, :1] if vr.shape[2] == 1 else self.tt
+        vR = expand_like(vr * np.sin(tt) + vt * np.cos(tt), self.vr)
+        vz = expand_like(vr * np.cos(tt) - vt * np.sin(tt), self.vr)
+        return vR, vz
+
+    def _get_cylindrical_velocity(self):
+        # Cached until vr or vt is replaced
+        cache = self.__dict__.get("_vcyl")
+        if cache is None or cache[0] is not self.vr or cache[1] is not self.vt:
+            cache = (self.vr, self.vt, *self.calc_cylindrical_velocity())
+            self.__dict__["_vcyl"] = cache
+        return cache[2:]
+
+    @property
+    def vR(self):
+        return self._get_cylindrical_velocity()[0]
+
+    @property
+    def vz(self):
+        return self._get_cylindrical_velocity()[1]
 
     def set_cylindrical_velocity(self):
-        self.vR = self.vr * np.sin(self.tt) + self.vt * np.cos(self.tt)
-        self.vz = self.vr * np.cos(self.tt) - self.vt * np.sin(self.tt)
+        self.__dict__.pop("_vcyl", None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_vcyl", None)
+        return state
+
+    def __setstate__(self, state):
+        # vR and vz of older pickles are recomputed from vr and vt
+        state.pop("vR", None)
+        state.pop("vz", None)
+        self.__dict__.update(state)
 
-    def save_pickle(self, filename, filepath=None):
+    def get_meridional_meshgrid(self):
+        return self.rr[:, :, :1], self.tt[:, :, :1]
+
+    def broadcast_fields(self, *names):
+        nphi = len(self.pc_ax)
+        for name in names:
+            setattr(self, name, broadcast_phi(getattr(self, name), nphi))
+
+    def save_pickle(self, filename, filepath=None, context=None):
         if filepath is None:
-            filepath = os.path.join(run_dir, filename)
+            filepath = os.path.join(gpath.get_context(context).run_dir, filename)
         dirpath = os.path.dirname(filepath)
         os.makedirs(dirpath, exist_ok=True)
         pd.to_pickle(self, filepath)
         logger.info(f"Saved : {filepath}")
 
-    def read_pickle(self, filename=None, filepath=None):
+    def save_dir(self, dirname="model", dirpath=None, compress=False, context=None):
+        from envos.model_io import save_model_dir
+
+        if dirpath is None:
+            dirpath = os.path.join(gpath.get_context(context).run_dir, dirname)
+        save_model_dir(self, dirpath, compress=compress)
+
+    def read_pickle(self, filename=None, filepath=None, context=None):
         if (filename is not None) and (filepath is None):
-            filepath = os.path.join(run_dir, filename)
+            filepath = os.path.join(gpath.get_context(context).run_dir, filename)
         tools.setattr_from_pickle(self, filepath)
 
 @dataclass
@@ -41,11 +113,6 @@ class CircumstellarModel(ModelBase):
     rc_ax: np.ndarray = None
     tc_ax: np.ndarray = None
     pc_ax: np.ndarray = None
-    rr: np.ndarray = None
-    tt: np.ndarray = None
-    pp: np.ndarray = None
-    R: np.ndarray = None
-    z: np.ndarray = None
     ppar: Any = None
     rhogas: np.ndarray = None
     rhodust: np.ndarray = None
@@ -57,6 +124,7 @@ class CircumstellarModel(ModelBase):
     f_dg: float = None
     molname: str = None
     radmcdir: str = None
+    orbit: str = None  # "UCM" or "Simple" when the whole flow follows that envelope
     filepath: str = None
 
     def __post_init__(self):
@@ -96,7 +164,7 @@ class CircumstellarModel(ModelBase):
         self.f_dg = f_dg
 
         if hasattr(self, "rhogas"):
-            self.rhodust = self.rhogas * f_dg
+            self.rhodust = expand_like(to_compact(self.rhogas) * f_dg, self.rhogas)
 
     def set_molname(self, molname):
         self.molname = molname
@@ -107,8 +175,13 @@ class CircumstellarModel(ModelBase):
     def set_mu0(self, mu0):
         self.mu0 = mu0
 
+    def set_orbit(self, orbit):
+        self.orbit = orbit
+
 
 class CassenMoosmanInnerEnvelope(ModelBase):
+    orbit = "UCM"
+
     def __init__(self, grid, Mdot, CR, Ms, cavangle=0):
         self.rho = None
         self.vr = None
@@ -117,22 +190,23 @@ class CassenMoosmanInnerEnvelope(ModelBase):
         self.mu0 = None
         self.read_grid(grid)
         self.calc_kinematic_structure(Mdot, CR, Ms, cavangle)
+        self.broadcast_fields("rho", "vr", "vt", "vp", "mu0")
         #self.set_cylindrical_velocity()
 
     def calc_kinematic_structure(self, Mdot, CR, Ms, cavangle):
-        csol = np.frompyfunc(self._sol_with_cubic, 2, 1)
-        zeta = CR / self.rr
-        self.mu0 = csol(np.cos(self.tt), zeta).astype(float)
+        rr, tt = self.get_meridional_meshgrid()
+        zeta = CR / rr
+        self.mu0 = solve_mu0(np.cos(tt), zeta)
         sin0 = np.sqrt(1 - self.mu0 ** 2)
-        sin = np.sin(self.tt)
+        sin = np.sin(tt)
         mu_to_mu0 = 1 - zeta * sin0 ** 2
-        v0 = np.sqrt(G * Ms / self.rr)
+        v0 = np.sqrt(G * Ms / rr)
         self.vr = -v0 * np.sqrt(1 + mu_to_mu0)
         self.vt = v0 * zeta * sin0 ** 2 * \
             self.mu0 / sin * np.sqrt(1 + mu_to_mu0)
-        self.vp = v0 * sin0 ** 2 / np.sin(self.tt) * np.sqrt(zeta)
+        self.vp = v0 * sin0 ** 2 / np.sin(tt) * np.sqrt(zeta)
         P2 = 1 - 3 / 2 * sin0 ** 2
-        rho = -Mdot / (4 * np.pi * self.rr ** 2 *
+        rho = -Mdot / (4 * np.pi * rr ** 2 *
                        self.vr * (1 + 2 * zeta * P2))
         cavmask = np.array(self.mu0 <= np.cos(cavangle), dtype=float)
         self.rho = rho * cavmask
@@ -144,7 +218,23 @@ class CassenMoosmanInnerEnvelope(ModelBase):
         return sols[0] if len(sols) != 0 else np.nan
 
 
+def solve_mu0(mu, zeta):
+    """
+    Solve zeta*mu0^3 + (1-zeta)*mu0 - mu = 0 for whole arrays.
+    Picks the same root as CassenMoosmanInnerEnvelope._sol_with_cubic.
+    """
+    roots = np.round(
+        cubicsolver.solve_vectorized(zeta, 0, 1 - zeta, -np.asarray(mu)), 8
+    )
+    valid = (0 <= roots) & (roots <= 1)
+    first = np.argmax(valid, axis=0)[np.newaxis]
+    mu0 = np.take_along_axis(roots, first, axis=0)[0]
+    return np.where(valid.any(axis=0), mu0, np.nan)
+
+
 class SimpleBallisticInnerEnvelope(ModelBase):
+    orbit = "Simple"
+
     def __init__(self, grid, Mdot, CR, M, cavangle=0):
         self.rho = None
         self.vr = None
@@ -153,54 +243,84 @@ class SimpleBallisticInnerEnvelope(ModelBase):
         self.mu0 = None
         self.read_grid(grid)
         self.calc_kinematic_structure(Mdot, CR, M, cavangle)
+        self.broadcast_fields("rho", "vr", "vt", "vp", "mu0")
         #self.set_cylindrical_velocity()
 
     def calc_kinematic_structure(self, Mdot, CR, M, cavangle):
-        vff = np.sqrt(2 * G * M / self.rr)
+        rr, tt = self.get_meridional_meshgrid()
+        vff = np.sqrt(2 * G * M / rr)
         CB = CR / 2
-        rho_prof = Mdot / (4 * np.pi * self.rr ** 2 * vff)
+        rho_prof = Mdot / (4 * np.pi * rr ** 2 * vff)
         mu_cav = np.cos(cavangle)
-        cavmask = np.array(np.cos(self.tt) <= mu_cav, dtype=float)
-        cbmask = np.array(self.rr >= CB, dtype=float)
+        cavmask = np.array(np.cos(tt) <= mu_cav, dtype=float)
+        cbmask = np.array(rr >= CB, dtype=float)
         self.rho = rho_prof * cbmask * cavmask
-        self.vr = -vff * np.sqrt((1 - CB / self.rr).clip(0))
-        self.vt = np.zeros_like(self.rr)
-        self.vp = vff / np.sqrt(self.rr / CB)
-        self.mu0 = np.cos(self.tt)
+        self.vr = -vff * np.sqrt((1 - CB / rr).clip(0))
+        self.vt = np.zeros_like(rr)
+        self.vp = vff / np.sqrt(rr / CB)
+        self.mu0 = np.cos(tt)
 
 
 class TerebeyOuterEnvelope(ModelBase):
-    def __init__(self, grid, t, cs, Omega, cavangle=0):
+    def __init__(self, grid, t, cs, Omega, cavangle=0, storage_dir=None):
+        self.storage_dir = storage_dir
         self.rho = None
         self.vr = None
         self.vt = None
         self.vp = None
         self.read_grid(grid)
         self.calc_kinematic_structure(t, cs, Omega, cavangle)
+        self.broadcast_fields("rho", "vr", "vt", "vp")
         self.rin_lim = cs * Omega ** 2 * t ** 3
 
     def calc_kinematic_structure(self, t, cs, Omega, cavangle):
-        res = tsc.get_tsc(self.rc_ax, self.tc_ax, t, cs, Omega, mode="read")
-        cavmask = np.array(self.tt >= cavangle, dtype=float)
+        rr, tt = self.get_meridional_meshgrid()
+        res = tsc.get_tsc(
+            self.rc_ax, self.tc_ax, t, cs, Omega, mode="read",
+            storage_dir=self.storage_dir,
+        )
+        cavmask = np.array(tt >= cavangle, dtype=float)
         self.rho = res["rho"][:, :, np.newaxis] * cavmask
         self.vr = res["vr"][:, :, np.newaxis]
         self.vt = res["vt"][:, :, np.newaxis]
         self.vp = res["vp"][:, :, np.newaxis]
         self.Delta = res["Delta"]
-        P2 = 1 - 3 / 2 * np.sin(self.tt) ** 2
+        P2 = 1 - 3 / 2 * np.sin(tt) ** 2
         # updated 2021/7/14
         #self.rin_lim = cs * Omega ** 2 * t ** 3 * 0.4 / (1 + self.Delta * P2)
         self.rin_lim = cs * Omega ** 2 * t ** 3 * 0.4 / (1 + self.Delta * P2)
 
 class Disk(ModelBase):
     def calc_kinematic_structure_from_Sigma(self, Sigma, Ms, cs_disk):
-        OmegaK = np.sqrt(G * Ms / self.R ** 3)
-        H = cs_disk / OmegaK
-        rho0 = Sigma / (np.sqrt(2 * np.pi) * H)
-        self.rho = rho0 * np.exp(-0.5 * (self.z / H) ** 2)
-        self.vr = np.zeros_like(self.rho)
-        self.vt = np.zeros_like(self.rho)
-        self.vp = OmegaK * self.R
+        """
+        Sigma is an array or a function Sigma(R) evaluated on the
+        meridional plane. Only the meridional plane is computed, and
+        vr = vt = 0 are zero-stride views, not allocated arrays.
+        """
+        R = self.R[:, :, :1]
+        z = self.z[:, :, :1]
+        if callable(Sigma):
+            Sigma = Sigma(R)
+        Sigma = to_compact(np.asarray(Sigma))
+        if Sigma.ndim == 3 and Sigma.shape[2] != 1:
+            R, z = self.R, self.z
+        self.rho, self.vp = calc_disk_structure(R, z, Sigma, Ms, cs_disk)
+        self.broadcast_fields("rho", "vp")
+        self.vr = zeros_field(self.rho.shape)
+        self.vt = zeros_field(self.rho.shape)
+
+
+def calc_disk_structure(R, z, Sigma, Ms, cs_disk):
+    """
+    Density and rotation velocity of a vertically isothermal Keplerian disk.
+    Inputs are broadcast against each other.
+    """
+    OmegaK = np.sqrt(G * Ms / R ** 3)
+    H = cs_disk / OmegaK
+    rho0 = Sigma / (np.sqrt(2 * np.pi) * H)
+    rho = rho0 * np.exp(-0.5 * (z / H) ** 2)
+    vp = OmegaK * R
+    return rho, vp
 
 
 class ExptailDisk(Disk):
@@ -220,6 +340,23 @@ class ExptailDisk(Disk):
 
     def get_Sigma(self, Mdisk, Rd, ind):
         Sigma0 = Mdisk / (2 * np.pi * Rd ** 2) / (1 - 2 / np.e)
-        power = (self.R / au) ** ind
-        exptail = np.exp(-((self.R / Rd) ** (2 + ind)))
+        R = self.R[:, :, :1]
+        power = (R / au) ** ind
+        exptail = np.exp(-((R / Rd) ** (2 + ind)))
         return Sigma0 * power * exptail
+
+
+class SigmaProfileDisk(Disk):
+    """
+    Disk with a user-supplied surface density profile Sigma(R) [g cm^-2],
+    where R is in cm.
+    """
+
+    def __init__(self, grid, Ms, Sigma_func, Td=30, meanmolw=2.3):
+        self.rho = None
+        self.vr = None
+        self.vt = None
+        self.vp = None
+        self.read_grid(grid)
+        cs_disk = np.sqrt(kB * Td / (meanmolw * amu))
+        self.calc_kinematic_structure_from_Sigma(Sigma_func, Ms, cs_disk)
@@ -67,10 +67,11 @@ class ObsSimulator:
     """
 
     def __init__(
-        self, config=None, radmcdir=None, dpc=None, n_thread=1
+        self, config=None, radmcdir=None, dpc=None, n_thread=1, context=None
     ):
 
-        self.radmc_dir = radmcdir or gpath.radmc_dir
+        self.context = gpath.get_context(context, config)
+        self.radmc_dir = radmcdir or self.context.radmc_dir
         self.dpc = dpc
         self.n_thread = n_thread
         #self.view = False
@@ -117,7 +118,9 @@ class ObsSimulator:
         logger.info("Setting model for observation")
         if conf is None:
             conf = self.config
-        radmc = RadmcController(config = conf)
+        radmc = RadmcController(
+            config=conf, radmc_dir=self.radmc_dir, context=self.context
+        )
         radmc.clean_radmc_dir()
         radmc.set_model(model)
         radmc.set_temperature(model.Tgas)
@@ -233,6 +236,7 @@ class ObsSimulator:
         self.data_cont = rmci.readImage(fname=f"{self.radmc_dir}/image.out")
         self.data_cont.freq0 = nc.c / (lam * 1e4)
         odat = Image(radmcdata=self.data_cont, datatype="continum")
+        odat.context = self.context
 
         if self.conv:
             odat.Ipp = self.convolver(odat.Ipp)
@@ -353,6 +357,7 @@ class ObsSimulator:
         self.data.dpc = self.dpc
         self.data.freq0 = self.mol.freq[iline - 1]
         odat = ObsData3D(datatype="line")
+        odat.context = self.context
         odat.read(radmcdata=self.data)
         odat.add_obs_info(
             iline=iline,
@@ -554,15 +559,23 @@ class BaseObsData:
 #        for k, v in cls.__dict__.items():
 #            setattr(self, k, v)
 
-    def save_instance(self, filename="obsdata.pkl", filepath=None):
+    def get_run_dir(self, context=None):
+        """
+        run_dir of the given context, of the ObsSimulator that made this
+        data, or the global one.
+        """
+        context = context or getattr(self, "context", None)
+        return gpath.get_context(context).run_dir
+
+    def save_instance(self, filename="obsdata.pkl", filepath=None, context=None):
         if filepath is None:
-            filepath = os.path.join(gpath.run_dir, filename)
+            filepath = os.path.join(self.get_run_dir(context), filename)
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         pd.to_pickle(self, filepath)
 
-    def save_fits(self, filename="obsdata.fits", dpc=None, filepath=None):
+    def save_fits(self, filename="obsdata.fits", dpc=None, filepath=None, context=None):
         if filepath is None:
-            filepath = os.path.join(gpath.run_dir, filename)
+            filepath = os.path.join(self.get_run_dir(context), filename)
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
         if os.path.exists(filepath):
@@ -664,7 +677,7 @@ class ObsData3D(BaseObsData):
             Ipp /= np.max(Ipp)
         return Ipp
 
-    def get_PV_map(self, pangle_deg=0, poffset_au=0, Inorm="max", save=False):
+    def get_PV_map(self, pangle_deg=0, poffset_au=0, Inorm="max", save=False, context=None):
         if self.Ippv.shape[1] > 1:
             posline = self.position_line(
                 self.xau, PA_deg=pangle_deg, poffset_au=poffset_au
@@ -696,6 +709,7 @@ class ObsData3D(BaseObsData):
                 posang=self.posang
             )
         PV.normalize(Inorm)
+        PV.context = context or getattr(self, "context", None)
         if save:
             PV.save_fitsfile()
         # self.PV_list.append(PV)
@@ -861,14 +875,14 @@ class PVmap(BaseObsData):
             self.Ipv = self.Ipv[jmin:jmax, :]
             self.vkms = self.vkms[jmin:jmax]
 
-    def save_fitsfile(self, filename="PVimage.fits", filepath=None):
+    def save_fitsfile(self, filename="PVimage.fits", filepath=None, context=None):
         """
         save the obsdata as a fitsfile
         see IAU manual for variables used in fits:
              https://fits.gsfc.nasa.gov/standard40/fits_standard40aa-le.pdf
         """
         if filepath is None:
-            filepath = os.path.join(gpath.run_dir, filename)
+            filepath = os.path.join(self.get_run_dir(context), filename)
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
         Np = len(self.xau)
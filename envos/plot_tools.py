@@ -1,6 +1,6 @@
 import os
 import numpy as np
-from scipy import interpolate, integrate, optimize
+from scipy import interpolate, integrate, optimize, sparse, spatial
 import matplotlib.patches
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredAuxTransformBox
 import matplotlib
@@ -16,7 +16,8 @@ from . import gpath
 from . import nconst as nc
 from . import log
 from . import streamline
-from . import tools
+from .grid import FieldSampler
+from .pvanalysis import calc_mass, get_coord_ipeak, get_coord_vmax
 # from myplot import mpl_setting, color
 
 logger = log.set_logger(__name__)
@@ -36,6 +37,7 @@ def plot_density_map(
     r0=None,
     streams=False, #True,
     trajectries=False, #True,
+    context=None,
 ):
 
     lvs = np.linspace(-19, -16, 100)
@@ -66,10 +68,10 @@ def plot_density_map(
     if streams:
         add_streams(model, rlim, r0=r0, use_mu0=hasattr(model, "mu0"))
 
-    savefig("density.pdf")
+    savefig("density.pdf", context=context)
 
 
-def plot_midplane_density_profile(model):
+def plot_midplane_density_profile(model, context=None):
     index_mid = np.argmin(np.abs( model.tc_ax - np.pi/2))
     plt.plot(model.rc_ax/nc.au, model.rhogas[:, index_mid, 0])
     #plt.xlim(np.min(model.rc_ax/nc.au), np.max(model.rc_ax/nc.au))
@@ -79,9 +81,9 @@ def plot_midplane_density_profile(model):
     plt.yscale("log")
     plt.xlabel("Distance from Star [au]")
     plt.ylabel("Gas Density [g cm$^{-3}$]")
-    savefig("dens_prof.pdf")
+    savefig("dens_prof.pdf", context=context)
 
-def plot_midplane_temperature_profile(model):
+def plot_midplane_temperature_profile(model, context=None):
     index_mid = np.argmin(np.abs( model.tc_ax - np.pi/2))
     plt.plot(model.rc_ax/nc.au, model.Tgas[:, index_mid, 0])
     #plt.xlim(10, 1000)
@@ -90,9 +92,9 @@ def plot_midplane_temperature_profile(model):
     plt.yscale("log")
     plt.xlabel("Distance from Star [au]")
     plt.ylabel("Temperature [K]")
-    savefig("T_prof.pdf")
+    savefig("T_prof.pdf", context=context)
 
-def plot_midplane_velocity_profile(model, rlim=400, ylim=(-0.5,3)):
+def plot_midplane_velocity_profile(model, rlim=400, ylim=(-0.5,3), context=None):
     index_mid = np.argmin(np.abs( model.tc_ax - np.pi/2))
     cav = np.where(model.rhogas != 0, 1, 0)[:,index_mid, 0]
     plt.plot(model.rc_ax/nc.au, -model.vr[:, index_mid, 0]*cav/1e5, label=r"$- v_r$", ls="-")
@@ -105,9 +107,9 @@ def plot_midplane_velocity_profile(model, rlim=400, ylim=(-0.5,3)):
     plt.xlabel("Distance from Star [au]")
     plt.ylabel("Velocity [km s$^{-1}$]")
     plt.legend()
-    savefig("v_prof.pdf")
+    savefig("v_prof.pdf", context=context)
 
-def plot_midplane_density_velocity_profile(model, rlim=1000):
+def plot_midplane_density_velocity_profile(model, rlim=1000, context=None):
     index_mid = np.argmin(np.abs( model.tc_ax - np.pi/2))
     plt.plot(model.rc_ax/nc.au, model.rhogas[:, index_mid, 0], ls="-", c="dimgray", label=r"$\rho$")
     plt.xlim(10, rlim)
@@ -128,9 +130,9 @@ def plot_midplane_density_velocity_profile(model, rlim=1000):
     plt.legend(handlelength=3)
     plt.minorticks_on()
 
-    savefig("v_dens_prof.pdf")
+    savefig("v_dens_prof.pdf", context=context)
 
-def plot_midplane_velocity_map(model, rlim=300):
+def plot_midplane_velocity_map(model, rlim=300, context=None):
     rax = model.rc_ax
     tax = model.tc_ax
     pax = model.pc_ax if len(model.pc_ax) != 1 else np.linspace(-np.pi, np.pi, 91)
@@ -170,7 +172,7 @@ def plot_midplane_velocity_map(model, rlim=300):
     cbar = plt.colorbar(img, ticks=ticks, pad=0.02)
     cbar.set_label(r'$V_{\rm LOS}$ [km s$^{-1}$]')
     cbar.ax.minorticks_off()
-    savefig("v_los.pdf")
+    savefig("v_los.pdf", context=context)
 
 def plot_temperature_map(
     m,
@@ -178,6 +180,7 @@ def plot_temperature_map(
     r0=None,
     streams=False, #True,
     trajectries=False, #True,
+    context=None,
 ):
     lvs = np.linspace(10, 100, 10)
     T = m.Tgas
@@ -223,11 +226,12 @@ def plot_temperature_map(
         #add_streams(m, rlim, mu0)
         add_streams(m, rlim, r0=r0, use_mu0=hasattr(m, "mu0"))
 
-    savefig("gtemp.pdf")
+    savefig("gtemp.pdf", context=context)
 
 
-def plot_opacity():
-    wav, kabs, kscat = np.loadtxt("./run/radmc/dustkappa_MRN20.inp",  skiprows=3, unpack=True)
+def plot_opacity(context=None):
+    filepath = os.path.join(gpath.get_context(context).radmc_dir, "dustkappa_MRN20.inp")
+    wav, kabs, kscat = np.loadtxt(filepath,  skiprows=3, unpack=True)
     plt.plot(wav, kabs, c="k", lw=3)
     ax = plt.gca()
     ax.minorticks_on()
@@ -240,13 +244,14 @@ def plot_opacity():
 
     plt.xlabel(r"Wavelength [$\mu$m]")
     plt.ylabel(r"Absorption Opacity [cm$^{2}$ g$^{-1}$]")
-    savefig("opac.pdf")
+    savefig("opac.pdf", context=context)
 
 def plot_mom0_map(
     obsdata,
     pangle_deg=None,
     poffset_au=None,
     n_lv=100,
+    context=None,
 ):
     def position_line(length, pangle_deg, poffset_au=0):
         line = np.linspace(-length/2, length/2, 10)
@@ -299,19 +304,16 @@ def plot_mom0_map(
             obsdata.beam_pa_deg,
         )
 
-    savefig("mom0map.pdf")
+    savefig("mom0map.pdf", context=context)
 
 
-def plot_lineprofile(obsdata):
+def plot_lineprofile(obsdata, context=None):
     lp = integrate.simps(
         integrate.simps(obsdata.Ippv, obsdata.xau, axis=2), obsdata.yau, axis=1
     )
     plt.plot(obsdata.vkms, lp)
 
-    filepath = os.path.join(gpath.fig_dir, "line.pdf")
-    print("saved ", filepath)
-    plt.savefig(filepath)
-    plt.clf()
+    savefig("line.pdf", context=context)
 
 
 def plot_pvdiagram(
@@ -333,7 +335,8 @@ def plot_pvdiagram(
     show_beam=True,
     discrete=True,
     refpv=None,
-    out="pvdiagrams.pdf"
+    out="pvdiagrams.pdf",
+    context=None,
 ):
     Ipv = PV.Ipv
     xau = PV.xau
@@ -408,7 +411,7 @@ def plot_pvdiagram(
         # ax2.set_xlim([xas[0], xas[-1]])
         ax2.set_xlim(np.array(ax.get_xlim()) / PV.dpc)
 
-    savefig(out)
+    savefig(out, context=context)
 
 
 """
@@ -444,20 +447,9 @@ def add_streams(model, rlim, r0=None, use_mu0=False):
     newgrid = np.stack(
         [np.sqrt(xx ** 2 + yy ** 2), np.arctan2(xx, yy)], axis=-1
     )
-    vR = interpolate.interpn(
-        (model.rc_ax / nc.au, model.tc_ax),
-        model.vR[:, :, 0],
-        newgrid,
-        bounds_error=False,
-        fill_value=None,
-    )
-    vz = interpolate.interpn(
-        (model.rc_ax / nc.au, model.tc_ax),
-        model.vz[:, :, 0],
-        newgrid,
-        bounds_error=False,
-        fill_value=None,
-    )
+    vR, vz = FieldSampler(
+        model.rc_ax / nc.au, model.tc_ax, model.vR[:, :, 0], model.vz[:, :, 0]
+    )(newgrid)
     if use_mu0:
         r0arg = np.argmin( np.abs(r0 * nc.au - model.rc_ax) )
         mu0_arr = model.mu0[r0arg, :, 0]
@@ -476,14 +468,14 @@ def add_trajectries(km):
     #start_points = [(r0, th0) for th0 in np.radians(np.linspace(0, 90, 10))]
     start_points = [(r0, th0) for th0 in np.radians([89.9, 85, 80, 75, 70, 65, 60, 55, 50, 44.9])]
     t_eval = np.arange(1e3, 1e6, 100) *  nc.year
-    sls = streamline.calc_streamlines(
-        km.rc_ax,
-        km.tc_ax,
-        km.vr[:, :, 0],
-        km.vt[:, :, 0],
+    sls = streamline.calc_streamlines_from_model(
+        km,
+        [],
+        [],
         start_points,
         method="RK23",
         t_eval=t_eval,
+        batch=True,
     )
     for sl in sls:
         plt.plot(
@@ -493,29 +485,112 @@ def add_trajectries(km):
 
 
 def vertical_integral(value_rt, R_rt, z_rt, R_ax, z_ax, log=False):
-    points = np.stack((R_rt.ravel(), z_rt.ravel()), axis=-1)
-    npoints = np.stack(np.meshgrid(R_ax, z_ax), axis=-1)
-    if log:
-        fltr = np.logical_and.reduce(
-            (
-                [np.all(np.isfinite(a)) for a in np.log10(points)],
-                np.isfinite(np.log10(value_rt)),
-            )
+    return VerticalIntegrator(R_rt, z_rt, R_ax, z_ax, log=log)(value_rt)
+
+
+class VerticalIntegrator:
+    """
+    Integral along z of fields on the (r, theta) grid, after linear
+    interpolation onto the mesh (R_ax, z_ax) as interpolate.griddata.
+
+    example
+    ------------
+    integ = VerticalIntegrator.from_grid(grid, R_ax, z_ax)
+    sigma = integ(rhogas)                # (nR,)
+    sigmas = integ(np.array(rho_list))   # many fields: (nfield, nR)
+
+    The Delaunay triangulation and the barycentric weights are computed
+    once and stored as a sparse matrix from the grid points to the mesh;
+    together with the Simpson weights along z_ax, a linear integral is
+    one sparse matrix product. With log=True the interpolation is done in
+    log10 of R, z and the field, and grid points where the logarithm is
+    not finite are left out by renormalizing the weights.
+    """
+
+    def __init__(self, R_rt, z_rt, R_ax, z_ax, log=False):
+        self.src_shape = np.shape(R_rt)
+        self.R_ax = np.asarray(R_ax)
+        self.z_ax = np.asarray(z_ax)
+        self.log = log
+        points = np.stack((np.ravel(R_rt), np.ravel(z_rt)), axis=-1)
+        npoints = np.stack(np.meshgrid(self.R_ax, self.z_ax), axis=-1).reshape(-1, 2)
+        if log:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                points = np.log10(points)
+                npoints = np.log10(npoints)
+        use = np.all(np.isfinite(points), axis=1)
+        inside = np.all(np.isfinite(npoints), axis=1)
+
+        tri = spatial.Delaunay(points[use])
+        simplex = np.full(len(npoints), -1)
+        simplex[inside] = tri.find_simplex(npoints[inside])
+        inside = simplex >= 0
+        T = tri.transform[simplex[inside]]
+        b = np.einsum("nij,nj->ni", T[:, :2], npoints[inside] - T[:, 2])
+        bary = np.column_stack((b, 1 - b.sum(axis=1)))
+        cols = np.flatnonzero(use)[tri.simplices[simplex[inside]]]
+        rows = np.repeat(np.flatnonzero(inside), 3)
+        self.inside = inside
+        self.matrix = sparse.csr_matrix(
+            (bary.ravel(), (rows, cols.ravel())), shape=(len(npoints), len(points))
         )
-        fltr = fltr.ravel()
-        v = value_rt.ravel()
-        ret = 10 ** interpolate.griddata(
-            np.log10(points[fltr]),
-            np.log10(v[fltr]),
-            np.log10(npoints),
-            method="linear",
-        )
-    else:
-        ret = interpolate.griddata(
-            points, value_rt.ravel(), npoints, method="linear"
+
+        # Simpson weights along z for every R: N(R_i) = sum_j w_j f(R_i, z_j)
+        nR, nz = len(self.R_ax), len(self.z_ax)
+        self.z_weights = integrate.simpson(np.eye(nz), x=self.z_ax, axis=-1)
+        integ = sparse.csr_matrix(
+            (
+                np.repeat(self.z_weights, nR),
+                (np.tile(np.arange(nR), nz), np.arange(nz * nR)),
+            ),
+            shape=(nR, nz * nR),
         )
-    s = np.array([integrate.simps(r, z_ax) for r in np.nan_to_num(ret)])
-    return s
+        self.integ_matrix = (integ @ self.matrix).tocsr()
+
+    @classmethod
+    def from_grid(cls, grid, R_ax, z_ax, log=False):
+        return cls(grid.R[:, :, 0], grid.z[:, :, 0], R_ax, z_ax, log=log)
+
+    def remap(self, value):
+        """
+        Fields (..., nr, ntheta) on the mesh, (..., nz, nR); NaN outside
+        the grid.
+        """
+        v = self._flatten(value)
+        if self.log:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                logv = np.log10(v)
+                valid = np.isfinite(logv)
+                ret = 10 ** (
+                    (self.matrix @ np.where(valid, logv, 0).T)
+                    / (self.matrix @ valid.T.astype(float))
+                ).T
+        else:
+            ret = (self.matrix @ v.T).T
+        ret[:, ~self.inside] = np.nan
+        return ret.reshape(self._lead_shape(value) + (len(self.z_ax), len(self.R_ax)))
+
+    def __call__(self, value):
+        """
+        Vertical integrals (..., nR) of fields (..., nr, ntheta).
+        """
+        if self.log:
+            ret = np.nan_to_num(self.remap(value))
+            return np.tensordot(ret, self.z_weights, axes=(-2, 0))
+        ret = (self.integ_matrix @ self._flatten(value).T).T
+        return ret.reshape(self._lead_shape(value) + (len(self.R_ax),))
+
+    def _flatten(self, value):
+        value = np.asarray(value)
+        if value.ndim > len(self.src_shape) and value.shape[-1] == 1:
+            value = value[..., 0]
+        return value.reshape(-1, int(np.prod(self.src_shape)))
+
+    def _lead_shape(self, value):
+        value = np.asarray(value)
+        if value.ndim > len(self.src_shape) and value.shape[-1] == 1:
+            value = value[..., 0]
+        return value.shape[: value.ndim - len(self.src_shape)]
 
 
 def draw_center_line():
@@ -641,15 +716,11 @@ def add_mass_estimate_plot(
 
         del jM, iM
 
-    def calc_M(xau, vkms, fac=1):
-        # calc xau*nc.au * (vkms*nc.kms)**2 / (nc.G*nc.Msun)
-        return 0.001127 * xau * vkms ** 2 * fac
-
     if mass_ip:
         ## M_ipeak
         xau_peak, vkms_peak = get_coord_ipeak(xau, vkms, Ipv )
         draw_cross_pointer(xau_peak, vkms_peak, color_def[1], lw=1.5, s=18, ls=":")
-        M_CR = calc_M(abs(xau_peak), vkms_peak/np.sin(np.deg2rad(incl)), fac=1)
+        M_CR = calc_mass(abs(xau_peak), vkms_peak/np.sin(np.deg2rad(incl)), fac=1)
         txt_Mip = rf"$M_{{\rm ipeak}}$={M_CR:.3f}"
 
         logger.info("Mass estimation with intensity peak:")
@@ -661,7 +732,7 @@ def add_mass_estimate_plot(
     if mass_vp:
         ## M_vpeak
         x_vmax, v_vmax = get_coord_vmax(xau, vkms, Ipv, f_crit)
-        M_CB = calc_M(abs(x_vmax), v_vmax/np.sin(np.deg2rad(incl)) , fac=1 / 2)
+        M_CB = calc_mass(abs(x_vmax), v_vmax/np.sin(np.deg2rad(incl)) , fac=1 / 2)
         draw_cross_pointer(x_vmax, v_vmax, color_def[0], lw=1.5, s=18, ls=":", fill=False)
         txt_Mvp = rf"$M_{{\rm vmax,\,{f_crit*100:.0f}\%}}$={M_CB:.3f}"
 
@@ -683,36 +754,6 @@ def add_mass_estimate_plot(
             bbox=dict(fc="white", ec="black", pad=5),
         )
 
-def get_coord_ipeak(xau, vkms, Ipv):
-    jmax, imax = Ipv.shape
-    i0 = imax // 2
-    j0 = jmax // 2
-    jpeak, ipeak = peak_local_max(Ipv[j0:, i0:], num_peaks=1)[0]
-    xau_peak = xau[i0+ipeak]
-    vkms_peak = vkms[j0+jpeak]
-
-    fun = interpolate.RectBivariateSpline(vkms, xau, Ipv)
-    fun_wrap = lambda x: 1/fun(x[0], x[1])[0,0]
-    res = optimize.minimize(fun_wrap, [vkms_peak, xau_peak], bounds=[(vkms_peak*0.5, vkms_peak*1.5), (xau_peak*0.5, xau_peak*1.5)] )
-    return res.x[1], res.x[0]
-
-def get_coord_vmax(xau, vkms, Ipv, f_crit):
-    x_vmax, I_vmax = np.array([
-            [get_maximum_position(xau, Iv), np.max(Iv)]
-            for Iv in Ipv.transpose(0, 1)
-        ]).T
-    v_crit = tools.find_roots(vkms, I_vmax, f_crit * np.max(Ipv))
-    if len(v_crit) == 0:
-        v_crit = vkms[0]
-    else:
-        v_crit = v_crit[-1]
-
-    x_crit = tools.find_roots(x_vmax, vkms, v_crit)[-1]
-    return x_crit, v_crit
-
-def get_maximum_position(x, y):
-    return find_local_peak_position(x, y, np.argmax(y))
-
 def find_local_peak_position(x, y, i):
     if 2 <= i <= len(x) - 3:
         grad_y = interpolate.InterpolatedUnivariateSpline(
@@ -731,9 +772,10 @@ def get_localpeak_positions(x, y, min_distance=3, threshold_abs=None):
     ]
     return np.array(maxis)
 
-def savefig(filename):
-    gpath.make_dirs(fig=gpath.fig_dir)
-    filepath = os.path.join(gpath.fig_dir, filename)
+def savefig(filename, context=None):
+    fig_dir = gpath.get_context(context).fig_dir
+    os.makedirs(fig_dir, exist_ok=True)
+    filepath = os.path.join(fig_dir, filename)
     print("saved ", filepath)
     plt.savefig(filepath)
     plt.clf()
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+
+from envos import tools
+from envos.pvcor import refine_peak
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Mass estimation from PV diagrams
+
+M_ipeak uses the position and velocity of the intensity peak (the
+centrifugal radius) and M_vmax the maximum velocity at which the
+intensity exceeds f_crit of the peak, at the position where that
+velocity is reached (the centrifugal barrier, hence the factor 1/2).
+See plot_tools.plot_pvdiagram.
+
+All functions take a PV map Ipv (nv, nx) or a stack of maps on the same
+axes (..., nv, nx); sub-pixel peaks are closed-form quadratic fits, so a
+whole stack is processed at once.
+"""
+
+
+def calc_mass(xau, vkms, fac=1):
+    # xau*nc.au * (vkms*nc.kms)**2 / (nc.G*nc.Msun)
+    return 0.001127 * xau * vkms ** 2 * fac
+
+
+def find_row_peaks(x, I):
+    """
+    Sub-pixel position of the maximum of every row of I (..., nx) along
+    a uniform axis x, from a parabola through the maximum pixel and its
+    neighbours, and the maximum value. The position is NaN when the
+    maximum is within two pixels of either end.
+    """
+    I = np.asarray(I)
+    n = I.shape[-1]
+    i = np.argmax(I, axis=-1)[..., np.newaxis]
+    y0 = np.take_along_axis(I, np.clip(i - 1, 0, n - 1), axis=-1)[..., 0]
+    y1 = np.take_along_axis(I, i, axis=-1)[..., 0]
+    y2 = np.take_along_axis(I, np.clip(i + 1, 0, n - 1), axis=-1)[..., 0]
+    i = i[..., 0]
+    curv = y0 - 2 * y1 + y2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        di = np.where(curv < 0, 0.5 * (y0 - y2) / curv, 0)
+    dx = x[1] - x[0]
+    xpeak = np.where((2 <= i) & (i <= n - 3), x[i] + di * dx, np.nan)
+    return xpeak, y1
+
+
+def get_coord_ipeak(xau, vkms, Ipv):
+    """
+    Position and velocity of the intensity peak in the quadrant
+    x > 0, v > 0, refined by a quadratic surface.
+    """
+    xau, vkms, Ipv = _to_ascending(xau, vkms, Ipv)
+    nv, nx = Ipv.shape[-2:]
+    j0, i0 = nv // 2, nx // 2
+    ims = Ipv.reshape(-1, nv, nx)
+    # Exclude the border pixels of the quadrant, as peak_local_max does
+    quad = ims[:, j0 + 1 : -1, i0 + 1 : -1]
+    jp, ip = np.unravel_index(
+        np.argmax(quad.reshape(len(ims), -1), axis=1), quad.shape[1:]
+    )
+    jp += j0 + 1
+    ip += i0 + 1
+    _, d_j, d_i = refine_peak(ims, jp, ip)
+    x = xau[ip] + d_i * (xau[1] - xau[0])
+    v = vkms[jp] + d_j * (vkms[1] - vkms[0])
+    shape = Ipv.shape[:-2]
+    return x.reshape(shape), v.reshape(shape)
+
+
+def get_coord_vmax(xau, vkms, Ipv, f_crit):
+    """
+    The highest velocity at which the maximum intensity along x is
+    f_crit of the peak, and the peak position at that velocity, both
+    linearly interpolated between the velocity channels.
+    """
+    xau, vkms, Ipv = _to_ascending(xau, vkms, Ipv)
+    nv, nx = Ipv.shape[-2:]
+    ims = Ipv.reshape(-1, nv, nx)
+    k = np.arange(len(ims))
+    x_vmax, I_vmax = find_row_peaks(xau, ims)
+
+    dI = I_vmax - f_crit * np.max(ims, axis=(1, 2))[:, np.newaxis]
+    cross = dI[:, :-1] * dI[:, 1:] <= 0
+    j = nv - 2 - np.argmax(cross[:, ::-1], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        v_crit = tools.x_cross_zero(vkms[j], vkms[j + 1], dI[k, j], dI[k, j + 1])
+    v_crit = np.where(np.any(cross, axis=1), v_crit, vkms[0])
+
+    j = np.clip(np.searchsorted(vkms, v_crit, side="left") - 1, 0, nv - 2)
+    j = np.where(vkms[j + 1] == v_crit, np.minimum(j + 1, nv - 2), j)
+    dv = vkms[j] - v_crit
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_crit = tools.x_cross_zero(
+            x_vmax[k, j], x_vmax[k, j + 1], dv, vkms[j + 1] - v_crit
+        )
+    shape = Ipv.shape[:-2]
+    return x_crit.reshape(shape), v_crit.reshape(shape)
+
+
+def _to_ascending(xau, vkms, Ipv):
+    # Axes reversed by PVmap.reverse_x/reverse_v are flipped back
+    xau, vkms, Ipv = np.asarray(xau), np.asarray(vkms), np.asarray(Ipv)
+    if xau[0] > xau[-1]:
+        xau, Ipv = xau[::-1], Ipv[..., ::-1]
+    if vkms[0] > vkms[-1]:
+        vkms, Ipv = vkms[::-1], Ipv[..., ::-1, :]
+    return xau, vkms, Ipv
+
+
+def calc_mass_estimates(PVs, incl=90, f_crit=0.1):
+    """
+    M_ipeak and M_vmax (Msun) of a list of PVmaps, with the coordinates
+    used, as a table. Maps on the same axes are processed as one batch.
+    """
+    groups = {}
+    for i, PV in enumerate(PVs):
+        key = (PV.vkms.tobytes(), PV.xau.tobytes())
+        groups.setdefault(key, []).append(i)
+
+    sini = np.sin(np.deg2rad(incl))
+    columns = ["x_ipeak", "v_ipeak", "M_ipeak", "x_vmax", "v_vmax", "M_vmax"]
+    table = pd.DataFrame(np.nan, index=range(len(PVs)), columns=columns)
+    for index in groups.values():
+        xau, vkms = PVs[index[0]].xau, PVs[index[0]].vkms
+        ims = np.array([PVs[i].Ipv for i in index])
+        x_ip, v_ip = get_coord_ipeak(xau, vkms, ims)
+        x_vm, v_vm = get_coord_vmax(xau, vkms, ims, f_crit)
+        table.loc[index, "x_ipeak"] = x_ip
+        table.loc[index, "v_ipeak"] = v_ip
+        table.loc[index, "M_ipeak"] = calc_mass(np.abs(x_ip), v_ip / sini)
+        table.loc[index, "x_vmax"] = x_vm
+        table.loc[index, "v_vmax"] = v_vm
+        table.loc[index, "M_vmax"] = calc_mass(np.abs(x_vm), v_vm / sini, fac=1 / 2)
+    return table
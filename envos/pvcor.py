@@ -7,7 +7,7 @@ import re
 # import myplot5 as myp
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import ndimage, optimize, interpolate
+from scipy import ndimage, optimize, interpolate, fft
 from . import nconst as nc
 
 # import tools
@@ -144,10 +144,111 @@ import copy
 #
 ########################################################################################
 
+class PreparedPV:
+    """
+    A reference PV map (e.g. an observation) prepared for comparisons
+    with many other PV maps.
+
+    example
+    ------------
+    ref = PreparedPV(PV_obs, threshold=0.1, range_xau=[-500, 500])
+    scores = [calc_PV_correlation(ref, PV) for PV in PV_models]
+
+    The reference is interpolated onto the common grid, clipped and
+    thresholded once, as in calc_PV_correlation and calc_correlation,
+    and its sums for ZNCC are kept. The bicubic spline of the compared
+    maps is separable, I = Mv @ Ipv @ Mx.T, and the matrices are cached
+    for every pair of axes, so a comparison costs two matrix products.
+    """
+
+    def __init__(
+        self, PV, threshold=0, range_xau=[], range_vkms=[], xau=None, vkms=None
+    ):
+        xau = PV.xau if xau is None else xau
+        vkms = PV.vkms if vkms is None else vkms
+        if range_xau:
+            xau = xau[(range_xau[0] < xau) & (xau < range_xau[1])]
+        if range_vkms:
+            vkms = vkms[(range_vkms[0] < vkms) & (vkms < range_vkms[1])]
+        self.xau = np.asarray(xau)
+        self.vkms = np.asarray(vkms)
+
+        I = interpolate.RectBivariateSpline(PV.vkms, PV.xau, PV.Ipv)(vkms, xau)
+        I = np.where(I > 0, I, 0)
+        self.I = np.where(I > threshold, I, 0)
+
+        self.N = self.I.size
+        self.sumA = np.sum(self.I)
+        self.sumAsq = np.sum(self.I ** 2)
+        self.normA = np.sqrt(self.N * self.sumAsq - self.sumA ** 2)
+        self._matrices = {}
+
+    def get_spline_matrices(self, PV):
+        key = (PV.vkms.tobytes(), PV.xau.tobytes())
+        if key not in self._matrices:
+            self._matrices[key] = (
+                spline_matrix(PV.vkms, self.vkms),
+                spline_matrix(PV.xau, self.xau),
+            )
+        return self._matrices[key]
+
+    def interpolate(self, PVs):
+        """
+        PV maps on the common grid, with negative values clipped.
+        PVs is a PVmap or a list of PVmaps with the same axes.
+        """
+        single = not isinstance(PVs, (list, tuple))
+        PVs = [PVs] if single else PVs
+        Mv, Mx = self.get_spline_matrices(PVs[0])
+        ims = Mv @ np.array([PV.Ipv for PV in PVs]) @ Mx.T
+        ims = np.where(ims > 0, ims, 0)
+        return ims[0] if single else ims
+
+    def calc_scores(self, ims, method="ZNCC"):
+        """
+        calc_ZNCC or calc_SSD of the reference against images on the
+        common grid; ims may be a stack (..., nv, nx).
+        """
+        axes = (-2, -1)
+        if method == "SSD":
+            return np.sum((ims - self.I) ** 2, axis=axes)
+        elif method != "ZNCC":
+            raise Exception("Unknown method type.")
+        sumB = np.sum(ims, axis=axes)
+        sumBsq = np.sum(ims ** 2, axis=axes)
+        sumAB = np.tensordot(ims, self.I, axes=(axes, (0, 1)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (
+                (self.N * sumAB - self.sumA * sumB)
+                / self.normA
+                / np.sqrt(self.N * sumBsq - sumB ** 2)
+            )
+
+    def correlate(self, PV, method="ZNCC"):
+        return float(self.calc_scores(self.interpolate(PV), method=method))
+
+
+def spline_matrix(x, x_new):
+    """
+    Matrix M such that M @ y is the interpolating cubic spline of y(x)
+    (as in RectBivariateSpline) evaluated at x_new.
+    """
+    n = len(x)
+    dummy = np.arange(n, dtype=float)
+    spl = interpolate.RectBivariateSpline(x, dummy, np.eye(n))
+    return spl(x_new, dummy)
+
+
 def calc_PV_correlation(
     PV1, PV2, method="ZNCC", threshold=0, with_noise=False,
     range_xau=[], range_vkms=[], xau=None, vkms=None,
 ):
+    """
+    PV1 may be a PreparedPV, which then sets threshold and the grid.
+    """
+    if isinstance(PV1, PreparedPV) and not with_noise:
+        return PV1.correlate(PV2, method=method)
+
     xau = PV1.xau if xau is None else xau
     vkms = PV1.vkms if vkms is None else vkms
     # trim
@@ -207,6 +308,141 @@ def calc_ZNCC(im1, im2):
     )
     return ZNCC_AB
 
+
+def calc_ZNCC_map(im1, im2, min_overlap=0.5):
+    """
+    ZNCC of im1 and im2 shifted by every integer offset, computed with FFTs.
+
+    im2 may be a stack of images (..., ny, nx) of the shape of im1. The
+    shifted image im2[j - dj, i - di] is zero outside the frame, and
+    each score is calc_ZNCC(im1, shifted im2). Returns the map
+    (..., 2ny-1, 2nx-1) and the shift axes dj, di. Shifts keeping less
+    than min_overlap of the total of im2 in the frame are set to NaN.
+    """
+    ny, nx = im1.shape
+    shape = [fft.next_fast_len(2 * n - 1) for n in (ny, nx)]
+
+    def correlate(a, B):
+        fa = fft.rfft2(a, s=shape)
+        fb = fft.rfft2(B[..., ::-1, ::-1], s=shape, axes=(-2, -1))
+        return fft.irfft2(fa * fb, s=shape, axes=(-2, -1))[..., : 2 * ny - 1, : 2 * nx - 1]
+
+    N = im1.size
+    sumA = np.sum(im1)
+    sumAsq = np.sum(im1 ** 2)
+    sumAB = correlate(im1, im2)
+    sumB = correlate(np.ones_like(im1), im2)
+    sumBsq = correlate(np.ones_like(im1), im2 ** 2)
+
+    total = np.sum(im2, axis=(-2, -1))[..., np.newaxis, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zncc = (
+            (N * sumAB - sumA * sumB)
+            / np.sqrt(N * sumAsq - sumA ** 2)
+            / np.sqrt(N * sumBsq - sumB ** 2)
+        )
+        zncc[~(sumB >= min_overlap * total)] = np.nan
+
+    dj = np.arange(-(ny - 1), ny)
+    di = np.arange(-(nx - 1), nx)
+    return zncc, dj, di
+
+
+def find_peak_subpixel(zncc, dj, di, max_shift=None):
+    """
+    Position and value of the maximum of a ZNCC map (see calc_ZNCC_map)
+    refined by a quadratic surface through the neighbouring pixels.
+    max_shift=(max_dj, max_di) limits the searched shifts.
+    Returns (score, dj, di), arrays for a stack of maps.
+    """
+    zncc = np.where(np.isnan(zncc), -np.inf, zncc)
+    if max_shift is not None:
+        outside = (np.abs(dj)[:, np.newaxis] > max_shift[0]) | (
+            np.abs(di)[np.newaxis, :] > max_shift[1]
+        )
+        zncc = np.where(outside, -np.inf, zncc)
+
+    nj, ni = zncc.shape[-2:]
+    flat = zncc.reshape(-1, nj, ni)
+    ipeak = np.argmax(flat.reshape(len(flat), -1), axis=1)
+    jp, ip = np.unravel_index(ipeak, (nj, ni))
+    score, d_j, d_i = refine_peak(flat, jp, ip)
+    score = np.where(np.isfinite(score), np.minimum(score, 1), np.nan)
+    shape = zncc.shape[:-2]
+    return (
+        score.reshape(shape),
+        (dj[jp] + d_j).reshape(shape),
+        (di[ip] + d_i).reshape(shape),
+    )
+
+
+def refine_peak(ims, jp, ip):
+    """
+    Sub-pixel maximum of images ims (n, nj, ni) around the pixels
+    (jp, ip) from a quadratic surface through the 3x3 neighbourhood.
+    Returns the value and the fractional offsets (d_j, d_i), which are
+    zero where the surface has no maximum within one pixel.
+    """
+    nj, ni = ims.shape[-2:]
+    k = np.arange(len(ims))
+    c0 = ims[k, jp, ip]
+
+    def c(a, b):
+        v = ims[k, np.clip(jp + a, 0, nj - 1), np.clip(ip + b, 0, ni - 1)]
+        return np.where(np.isfinite(v), v, c0)
+
+    gj = 0.5 * (c(1, 0) - c(-1, 0))
+    gi = 0.5 * (c(0, 1) - c(0, -1))
+    hjj = c(1, 0) + c(-1, 0) - 2 * c0
+    hii = c(0, 1) + c(0, -1) - 2 * c0
+    hji = 0.25 * (c(1, 1) - c(1, -1) - c(-1, 1) + c(-1, -1))
+    det = hjj * hii - hji ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        peak = (hjj < 0) & (det > 0)
+        d_j = np.where(peak, (-hii * gj + hji * gi) / det, 0)
+        d_i = np.where(peak, (-hjj * gi + hji * gj) / det, 0)
+    outside = (np.abs(d_j) > 1) | (np.abs(d_i) > 1)
+    d_j = np.where(outside, 0, d_j)
+    d_i = np.where(outside, 0, d_i)
+    value = np.where(np.isfinite(c0), c0 + 0.5 * (gj * d_j + gi * d_i), np.nan)
+    return value, d_j, d_i
+
+
+def calc_ZNCC_offset(im1, im2, max_shift=None, min_overlap=0.5):
+    """
+    Best ZNCC over shifts of im2 and the sub-pixel shift (score, dj, di).
+    """
+    zncc, dj, di = calc_ZNCC_map(im1, im2, min_overlap=min_overlap)
+    return find_peak_subpixel(zncc, dj, di, max_shift=max_shift)
+
+
+def calc_PV_correlation_offset(
+    PV1, PV2, threshold=0, range_xau=[], range_vkms=[], xau=None, vkms=None,
+    max_offset_xau=None, max_offset_vkms=None, min_overlap=0.5,
+):
+    """
+    ZNCC of calc_PV_correlation, maximized over position and velocity
+    offsets of PV2. Returns (score, offset_xau, offset_vkms): PV2 is best
+    aligned after PV2.offset_x(offset_xau) and PV2.offset_v(offset_vkms).
+    PV1 may be a PreparedPV.
+    """
+    if not isinstance(PV1, PreparedPV):
+        PV1 = PreparedPV(
+            PV1, threshold=threshold, range_xau=range_xau, range_vkms=range_vkms,
+            xau=xau, vkms=vkms,
+        )
+    im1 = PV1.I
+    im2 = PV1.interpolate(PV2)
+
+    dx = PV1.xau[1] - PV1.xau[0]
+    dv = PV1.vkms[1] - PV1.vkms[0]
+    max_shift = (
+        np.inf if max_offset_vkms is None else max_offset_vkms / abs(dv),
+        np.inf if max_offset_xau is None else max_offset_xau / abs(dx),
+    )
+    score, dj, di = calc_ZNCC_offset(im1, im2, max_shift=max_shift, min_overlap=min_overlap)
+    return float(score), float(di * dx), float(dj * dv)
+
 #########################################################################################
 # def main_est(tag=""):
 #    pvdl = make_pvdl_with_estimation_from_image()
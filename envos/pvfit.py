@@ -0,0 +1,211 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import interpolate, optimize
+
+from envos import tools, pvcor
+from envos.library import ObsLibrary
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Fitting an observed PV diagram with a library of model PV diagrams
+
+The observed PV map is prepared once (pvcor.PreparedPV): interpolated
+onto the common (vkms, xau) grid and thresholded. Library PV maps on the
+same axes share the spline matrices of PreparedPV.interpolate, so whole
+batches are interpolated and scored at once. Batches run in a process
+pool.
+
+With offset_search=True, the ZNCC of every library map is maximized
+over position and velocity offsets (pvcor.calc_ZNCC_offset), and the
+best offsets are added to the table.
+"""
+
+PARAM_EXCLUDE = (
+    "index", "dir", "status", "error", "PV", "model", "obsdata",
+    "thermal_decision", "nphot_used", "library_id", "id", "kind", "group",
+)
+
+
+class PVFitter:
+    """
+    example
+    ------------
+    library = envos.read_sweep_index("./sweep")       # or a list of dicts
+    fitter = PVFitter(PV_obs, method="ZNCC", range_xau=[-500, 500], n_proc=8)
+    table = fitter.fit(library)
+    best = fitter.interpolate_best(table, keys=["CR_au", "Ms_Msun"])
+
+    A library is an ObsLibrary, a DataFrame or a list of dicts with a
+    "PV" entry (a PVmap or the path of a pickled PVmap) and parameter
+    entries. The
+    returned table has the parameters, "score" and "rank" (1 = best) and
+    is sorted from the best fit.
+    """
+
+    def __init__(
+        self,
+        PV_obs,
+        method="ZNCC",
+        threshold=0,
+        range_xau=[],
+        range_vkms=[],
+        xau=None,
+        vkms=None,
+        n_proc=1,
+        batch_size=64,
+        offset_search=False,
+        max_offset_xau=None,
+        max_offset_vkms=None,
+        min_overlap=0.5,
+    ):
+        if method not in ("ZNCC", "SSD"):
+            raise Exception("Unknown method type.")
+        if offset_search and method != "ZNCC":
+            raise Exception("Offset search is available only for ZNCC.")
+        self.method = method
+        self.n_proc = n_proc
+        self.batch_size = batch_size
+        self.ref = pvcor.PreparedPV(
+            PV_obs,
+            threshold=threshold,
+            range_xau=range_xau,
+            range_vkms=range_vkms,
+            xau=xau,
+            vkms=vkms,
+        )
+        self.offset = None
+        if offset_search:
+            dx = self.ref.xau[1] - self.ref.xau[0]
+            dv = self.ref.vkms[1] - self.ref.vkms[0]
+            self.offset = {
+                "max_shift": (
+                    np.inf if max_offset_vkms is None else max_offset_vkms / abs(dv),
+                    np.inf if max_offset_xau is None else max_offset_xau / abs(dx),
+                ),
+                "min_overlap": min_overlap,
+                "dx": dx,
+                "dv": dv,
+            }
+
+    def fit(self, library):
+        table = to_table(library)
+        if len(table) == 0:
+            raise Exception("Empty PV library")
+
+        pvs = list(table["PV"])
+        batches = [
+            pvs[i : i + self.batch_size] for i in range(0, len(pvs), self.batch_size)
+        ]
+        logger.info(
+            f"Fitting {len(pvs)} library PV maps in {len(batches)} batches "
+            f"with {self.n_proc} processes ({self.method})"
+        )
+        n = len(batches)
+        args = ([self.ref] * n, batches, [self.method] * n, [self.offset] * n)
+        if self.n_proc <= 1:
+            results = list(map(_score_batch, *args))
+        else:
+            with ProcessPoolExecutor(self.n_proc) as executor:
+                results = list(executor.map(_score_batch, *args))
+
+        results = np.concatenate(results)
+        table = table.copy()
+        table["score"] = results[:, 0]
+        if self.offset is not None:
+            table["offset_xau"] = results[:, 1]
+            table["offset_vkms"] = results[:, 2]
+        ascending = self.method == "SSD"
+        table = table.sort_values("score", ascending=ascending, na_position="last")
+        table["rank"] = np.arange(1, len(table) + 1)
+        return table.reset_index(drop=True)
+
+    def interpolate_best(self, table, keys, log=True, n_local=None):
+        """
+        Best-fit parameters between the library points: the score is
+        interpolated over the parameters (log10 with log=True) with a
+        cubic RBF and optimized from the best library point, within the
+        range of the library. n_local limits the RBF to the best points.
+        """
+        table = table[np.isfinite(table["score"])]
+        if n_local is not None:
+            table = table.iloc[:n_local]
+        points = table[list(keys)].to_numpy(dtype=float)
+        if log:
+            points = np.log10(points)
+        sign = 1 if self.method == "SSD" else -1
+        values = sign * table["score"].to_numpy(dtype=float)
+
+        best = {k: table[k].iloc[0] for k in keys}
+        best["score"] = table["score"].iloc[0]
+        if len(table) <= len(keys) + 1:
+            logger.info("Too few library points to interpolate the best fit")
+            return best
+
+        rbf = interpolate.RBFInterpolator(points, values, kernel="cubic")
+        bounds = list(zip(points.min(axis=0), points.max(axis=0)))
+        res = optimize.minimize(
+            lambda p: rbf(p[np.newaxis])[0], points[0], bounds=bounds
+        )
+        x = 10 ** res.x if log else res.x
+        best = {k: float(v) for k, v in zip(keys, x)}
+        best["score"] = float(sign * res.fun)
+        return best
+
+
+def _score_batch(ref, pvs, method, offset=None):
+    """
+    Returns (score, offset_xau, offset_vkms) of every PV map; the offsets
+    are zero without the offset search.
+    """
+    groups = {}
+    for i, pv in enumerate(pvs):
+        if isinstance(pv, str):
+            pv = tools.read_pickle(pv)
+        key = (pv.vkms.tobytes(), pv.xau.tobytes())
+        groups.setdefault(key, []).append((i, pv))
+
+    results = np.zeros((len(pvs), 3))
+    for members in groups.values():
+        index = [i for i, _ in members]
+        ims = ref.interpolate([pv for _, pv in members])
+        if offset is None:
+            results[index, 0] = ref.calc_scores(ims, method)
+        else:
+            score, dj, di = pvcor.calc_ZNCC_offset(
+                ref.I,
+                ims,
+                max_shift=offset["max_shift"],
+                min_overlap=offset["min_overlap"],
+            )
+            results[index] = np.stack(
+                (score, di * offset["dx"], dj * offset["dv"]), axis=-1
+            )
+    return results
+
+
+def to_table(library):
+    """
+    A PV library (ObsLibrary, DataFrame or list of dicts) as a table of
+    the parameters and a "PV" column; also used by the emulator.
+    """
+    if isinstance(library, ObsLibrary):
+        table = library.table(kind="PV")
+        table["PV"] = [library.get(i) for i in table["id"]]
+        params = [c for c in table.columns if c not in PARAM_EXCLUDE]
+        return table[params + ["PV"]]
+    if isinstance(library, pd.DataFrame):
+        table = library
+        if "status" in table:
+            table = table[table["status"] == "done"]
+        if "PV" not in table:
+            raise Exception("The library table has no PV column")
+        table = table[table["PV"].notna()]
+        params = [
+            c for c in table.columns
+            if c not in PARAM_EXCLUDE and not c.startswith("time_")
+        ]
+        return table[params + ["PV"]].reset_index(drop=True)
+    return pd.DataFrame([dict(entry) for entry in library])
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+from scipy import integrate
+import envos.nconst as nc
+from envos import gpath
+from envos.grid import to_compact, expand_like
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Semi-analytic dust temperature
+
+Dust heated by a central star of luminosity L is in radiative equilibrium
+
+    T^4 kP(T) = L / (16 pi sigma r^2) * kP_heat ,
+
+where kP is the Planck-mean absorption opacity. In the optically thin
+limit the heating radiation has the stellar color, kP_heat = kP(T*).
+With attenuation, the stellar radiation is extinguished by exp(-tau*)
+along each radial ray, tau* = int rho_d kP(T*) dr, and the absorbed
+luminosity is re-emitted at the local dust temperature:
+
+    kP_heat = kP(T*) exp(-tau*) + kP(T) (1 - exp(-tau*)) .
+
+For tau* >> 1, T approaches the blackbody equilibrium temperature.
+The equation is solved by fixed-point iteration on the meridional plane
+for axisymmetric models.
+"""
+
+TEMP_TABLE = np.geomspace(1, 1e4, 300)
+
+
+def read_dustkappa(filepath):
+    """
+    Read a RADMC-3D dustkappa_*.inp file.
+    Returns wavelength [micron] and absorption opacity [cm^2 g^-1].
+    """
+    with open(filepath) as f:
+        lines = [l.split("#")[0].strip() for l in f]
+    values = " ".join(l for l in lines if l).split()
+    iformat = int(values[0])
+    nlam = int(values[1])
+    table = np.array(values[2:], dtype=float).reshape(nlam, iformat + 1)
+    return table[:, 0], table[:, 1]
+
+
+def planck_mean_opacity(lam_micron, kabs, T):
+    """
+    Planck-mean opacity over the wavelength range of the table.
+    """
+    lam = np.asarray(lam_micron) * 1e-4
+    order = np.argsort(lam)[::-1]
+    nu = nc.c / lam[order]
+    kap = np.asarray(kabs)[order]
+    T = np.atleast_1d(T)[:, np.newaxis]
+    x = np.minimum(nc.h * nu / (nc.kB * T), 700)
+    Bnu = nu ** 3 / np.expm1(x)
+    return integrate.trapezoid(kap * Bnu, nu, axis=1) / integrate.trapezoid(
+        Bnu, nu, axis=1
+    )
+
+
+def calc_radeq_temperature(
+    model,
+    Lstar_Lsun=1.0,
+    Rstar_Rsun=1.0,
+    opac="silicate",
+    f_dg=0.01,
+    attenuation=True,
+    storage_dir=None,
+    tol=1e-6,
+    maxiter=200,
+    context=None,
+):
+    """
+    Dust temperature of the model's density structure, with the same
+    stellar parameters and opacity table as RadmcController. The table
+    is read from storage_dir or the storage_dir of the context.
+    """
+    storage_dir = storage_dir or gpath.get_context(context).storage_dir
+    lam, kabs = read_dustkappa(os.path.join(storage_dir, f"dustkappa_{opac}.inp"))
+    log_kP = np.log(planck_mean_opacity(lam, kabs, TEMP_TABLE))
+    kP = lambda T: np.exp(np.interp(np.log(T), np.log(TEMP_TABLE), log_kP))
+
+    Tstar = Rstar_Rsun ** (-0.5) * Lstar_Lsun ** 0.25 * nc.Tsun
+    kP_star = kP(Tstar)
+
+    rhod = to_compact(model.rhogas) * f_dg
+    rr = model.rc_ax.reshape(-1, 1, 1)
+    Teq4 = Lstar_Lsun * nc.Lsun / (16 * np.pi * nc.sigma_SB * rr ** 2)
+
+    if attenuation:
+        dr = np.diff(model.ri_ax).reshape(-1, 1, 1)
+        dtau = rhod * kP_star * dr
+        tau = np.cumsum(dtau, axis=0) - 0.5 * dtau
+        w = np.exp(-tau)
+    else:
+        w = np.ones_like(rhod)
+
+    T = (Teq4 * np.ones_like(rhod)) ** 0.25
+    for i in range(maxiter):
+        T_new = (Teq4 * (w * kP_star / kP(T) + 1 - w)) ** 0.25
+        converged = np.max(np.abs(T_new / T - 1)) < tol
+        T = T_new
+        if converged:
+            break
+    else:
+        logger.warning(f"Temperature iteration did not converge in {maxiter} steps")
+
+    logger.info(f"Calculated radiative-equilibrium temperature in {i+1} iterations")
+    return expand_like(T, model.rhogas)
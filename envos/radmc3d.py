@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import json
+import time
 import numpy as np
 import pandas as pd
-import radmc3dPy
-import radmc3dPy.analyze as rmca
+from types import SimpleNamespace
 from envos import tools
 import envos.nconst as nc
 from envos import gpath
+from envos.grid import to_compact, expand_like, calc_cell_volume, is_axisymmetric, broadcast_phi
 from envos.log import set_logger
 
 logger = set_logger(__name__)
@@ -24,17 +26,18 @@ class RadmcController:
         run_dir: str = None,
         radmc_dir: str = None,
         storage_dir: str = None,
-        #
+        context=None,
     ):
+        self.context = gpath.get_context(context, config)
 
         if config is not None:
             self.config = config
-            run_dir = run_dir or config.run_dir
-            radmc_dir = radmc_dir or config.radmc_dir
-            storage_dir = storage_dir or config.storage_dir
 
             self.n_thread = config.n_thread
             self.nphot = config.nphot
+            self.nphot_mode = config.nphot_mode
+            self.nphot_tol = config.nphot_tol
+            self.nphot_max = config.nphot_max
             self.scattering_mode_max = config.scattering_mode_max
             self.mc_scat_maxtauabs = config.mc_scat_maxtauabs
             self.tgas_eq_tdust = config.tgas_eq_tdust
@@ -51,20 +54,22 @@ class RadmcController:
         self.set_dirs(run_dir, radmc_dir, storage_dir)
 
     def set_dirs(self, run_dir=None, radmc_dir=None, storage_dir=None):
-        self.run_dir = run_dir or gpath.run_dir  # global?
-        gpath.make_dirs(run=self.run_dir)
+        self.run_dir = run_dir or self.context.run_dir
+        os.makedirs(self.run_dir, exist_ok=True)
 
-        self.radmc_dir = radmc_dir or gpath.radmc_dir  # local
-        gpath.make_dirs(radmc=self.radmc_dir)
+        self.radmc_dir = radmc_dir or self.context.radmc_dir
+        os.makedirs(self.radmc_dir, exist_ok=True)
 
-        self.storage_dir = storage_dir or gpath.storage_dir
-        if self.storage_dir is not gpath.storage_dir:
-            gpath.make_dirs(storage=self.storage_dir)
+        self.storage_dir = storage_dir or self.context.storage_dir
+        os.makedirs(self.storage_dir, exist_ok=True)
 
     def set_input_params(
         self,
         n_thread: int = 1,
         nphot: int = 1e6,
+        nphot_mode: str = "fixed",
+        nphot_tol: float = 0.01,
+        nphot_max: int = 1e8,
         scattering_mode_max: int = 0,
         mc_scat_maxtauabs: float = 5.0,
         tgas_eq_tdust: bool = True,
@@ -80,6 +85,9 @@ class RadmcController:
     ):
         self.n_thread = n_thread
         self.nphot = nphot
+        self.nphot_mode = nphot_mode
+        self.nphot_tol = nphot_tol
+        self.nphot_max = nphot_max
         self.scattering_mode_max = scattering_mode_max
         self.mc_scat_maxtauabs = mc_scat_maxtauabs
         self.tgas_eq_tdust = tgas_eq_tdust
@@ -113,7 +121,7 @@ class RadmcController:
         self._rhog = rhog
         if np.max(rhog) == 0:
             raise Exception("Zero density")
-        rhod = rhog * self.f_dg
+        rhod = expand_like(to_compact(rhog) * self.f_dg, rhog)
         lam = [
             *np.geomspace(0.1, 7, 20, endpoint=False),
             *np.geomspace(7, 25, 100, endpoint=False),
@@ -180,14 +188,13 @@ class RadmcController:
             #"camera_spher_cavity_relres":0.01,
             #"camera_diagnostics_subpix": 1,
         }
-        self._save_input_file(
-            "radmc3d.inp", *[f"{k} = {v}" for k, v in param_dict.items()]
-        )
+        self._radmc3d_params = param_dict
+        self._save_radmc3d_inp()
 
         #    if self.temp_mode == "mctherm":
         # remove gas_temperature.inp and dust_temperature.inp
-        remove_file("gas_temperature.inp")
-        remove_file("dust_temperature.dat")
+        remove_file(os.path.join(self.radmc_dir, "gas_temperature.inp"))
+        remove_file(os.path.join(self.radmc_dir, "dust_temperature.dat"))
 
     #    elif self.temp_mode == "const":
     #        self._set_constant_temperature(self.T_const)
@@ -202,7 +209,10 @@ class RadmcController:
     ):
         self.set_mctherm_inpfiles()
         vr, vt, vp = self.model.vr, self.model.vt, self.model.vp
-        nmol = self._rhog / (2 * nc.amu / self.mfrac_H2) * self.molabun
+        nmol = expand_like(
+            to_compact(self._rhog) / (2 * nc.amu / self.mfrac_H2) * self.molabun,
+            self._rhog,
+        )
         # n_mol = np.where(rr < self.mol_rlim, n_mol, 0)
 
         # set molcular number density
@@ -231,6 +241,23 @@ class RadmcController:
         dname = os.path.dirname(f.name)
         logger.info(f"Saved {fname} in {dname}")
 
+    def _save_field_file(self, filename, header_lines, *fields):
+        """
+        Write header lines followed by cell values in Fortran order.
+        Fields are written one phi slice at a time, so that axisymmetric
+        (phi-broadcast) fields are expanded only while streaming to disk.
+        """
+        filepath = os.path.join(self.radmc_dir, filename)
+        nphi = np.shape(fields[0])[2]
+        with open(filepath, "w+") as f:
+            f.write("\n".join(header_lines) + "\n")
+            for k in range(nphi):
+                cols = np.stack(
+                    [fld[:, :, k].ravel(order="F") for fld in fields], axis=-1
+                )
+                np.savetxt(f, cols, fmt="%13.8e")
+        logger.info(f"Saved {filename} in {self.radmc_dir}")
+
     def _strfunc(self, line):
         if isinstance(line, str):
             return line
@@ -264,12 +291,8 @@ class RadmcController:
     #        self.set_temperature(T)
 
     def set_dust_density(self, rhod):
-        self._save_input_file(
-            "dust_density.inp",
-            "1",
-            f"{rhod.size:d}",
-            "1",
-            *rhod.ravel(order="F"),
+        self._save_field_file(
+            "dust_density.inp", ["1", f"{rhod.size:d}", "1"], rhod
         )
 
     def set_temperature(self, temp):
@@ -277,36 +300,21 @@ class RadmcController:
         Set gas & dust temperature
         """
         ntot = temp.size  # len(temp.ravel())
-        self._save_input_file(
-            "gas_temperature.inp",
-            "1",
-            f"{ntot:d}",
-            *temp.ravel(order="F"),
+        self._save_field_file(
+            "gas_temperature.inp", ["1", f"{ntot:d}"], temp
         )
-        self._save_input_file(
-            "dust_temperature.dat",
-            "1",
-            f"{ntot:d}",
-            "1",
-            *temp.ravel(order="F"),
+        self._save_field_file(
+            "dust_temperature.dat", ["1", f"{ntot:d}", "1"], temp
         )
 
     def set_numberdens(self, nmol):
-        self._save_input_file(
-            f"numberdens_{self.molname}.inp",
-            "1",
-            f"{nmol.size:d}",
-            *nmol.ravel(order="F"),
+        self._save_field_file(
+            f"numberdens_{self.molname}.inp", ["1", f"{nmol.size:d}"], nmol
         )
 
     def set_velocity(self, vr, vt, vp):
-        _zipped_vel = zip(
-            vr.ravel(order="F"),
-            vt.ravel(order="F"),
-            vp.ravel(order="F"),
-        )
-        self._save_input_file(
-            "gas_velocity.inp", "1", f"{vr.size:d}", *_zipped_vel
+        self._save_field_file(
+            "gas_velocity.inp", ["1", f"{vr.size:d}"], vr, vt, vp
         )
 
     def clean_radmc_dir(self):
@@ -324,6 +332,12 @@ class RadmcController:
         os.mkdir(self.radmc_dir)
         logger.info("Done")
 
+    def _save_radmc3d_inp(self, **changes):
+        params = {**self._radmc3d_params, **changes}
+        self._save_input_file(
+            "radmc3d.inp", *[f"{k} = {v}" for k, v in params.items()]
+        )
+
     def run_mctherm(self):
         logger.info("Executing RADMC3D with mctherm mode")
 
@@ -331,6 +345,17 @@ class RadmcController:
             msg = "radmc working directory not found: {self.radmc_dir}"
             raise FileNotFoundError(msg)
 
+        self.convergence = None
+        if self.nphot_mode == "converge":
+            self._run_mctherm_until_converged()
+        elif self.nphot_mode == "fixed":
+            self._exec_mctherm()
+        else:
+            raise Exception(f"Unknown nphot_mode: {self.nphot_mode}")
+
+        self.read_radmc_data()
+
+    def _exec_mctherm(self):
         tools.shell(
             f"radmc3d mctherm setthreads {self.n_thread}",
             cwd=self.radmc_dir,
@@ -338,10 +363,103 @@ class RadmcController:
             log_prefix="    ",
         )
 
-        cwd = os.getcwd()
-        os.chdir(self.radmc_dir)
-        self.rmcdata = rmca.readData(ispec=self.molname)  # radmc3dData()
-        os.chdir(cwd)
+    def _run_mctherm_until_converged(self):
+        """
+        Run mctherm as independent batches of nphot photons with different
+        random seeds and average their dust temperatures. Stops when the
+        running mean changes by less than nphot_tol (dust-mass-weighted
+        mean of |dT|/T) or when nphot_max photons have been used.
+        The cost-versus-noise curve is saved in mctherm_convergence.json.
+        """
+        md = self.model
+        mass = to_compact(self._rhog) * calc_cell_volume(md.ri_ax, md.ti_ax, md.pi_ax)
+        weight = mass.ravel(order="F") / np.sum(mass)
+
+        nbatch_max = max(2, int(self.nphot_max // self.nphot))
+        history = []
+        Tsum = Tsum2 = Tmean = None
+        t0 = time.perf_counter()
+        for i in range(nbatch_max):
+            self._save_radmc3d_inp(iseed=-(i + 1) * 1000 - 1)
+            self._exec_mctherm()
+            header, T = read_dust_temperature(self.radmc_dir)
+            Tsum = T if Tsum is None else Tsum + T
+            Tsum2 = T ** 2 if Tsum2 is None else Tsum2 + T ** 2
+            Tmean_prev, Tmean = Tmean, Tsum / (i + 1)
+
+            record = {
+                "nbatch": i + 1,
+                "nphot": int(self.nphot * (i + 1)),
+                "time": time.perf_counter() - t0,
+                "change": None,
+                "noise": None,
+            }
+            if i != 0:
+                nonzero = Tmean > 0
+                change = np.abs(Tmean - Tmean_prev)
+                # Squared standard error of the mean of i + 1 batches
+                se2 = (Tsum2 / (i + 1) - Tmean ** 2).clip(0) / i
+                rel = lambda x: np.sum(
+                    weight * np.divide(x, Tmean, out=np.zeros_like(x), where=nonzero)
+                ) / len(Tmean)
+                record["change"] = float(rel(change))
+                record["noise"] = float(rel(np.sqrt(se2)))
+            history.append(record)
+            logger.info(
+                f"mctherm batch {i+1}: nphot = {record['nphot']:.3g}, "
+                f"change = {record['change']}, noise = {record['noise']}"
+            )
+            if record["change"] is not None and record["change"] < self.nphot_tol:
+                break
+        else:
+            logger.warning(
+                f"mctherm did not converge to {self.nphot_tol} "
+                f"within nphot_max = {self.nphot_max:.3g}"
+            )
+
+        save_dust_temperature(self.radmc_dir, header, Tmean)
+        self._save_radmc3d_inp()
+        self.convergence = history
+        with open(os.path.join(self.radmc_dir, "mctherm_convergence.json"), "w") as f:
+            json.dump(history, f, indent=2)
+
+    def calc_gas_temperature(self, model):
+        """
+        Run mctherm for the model in radmc_dir and return its gas temperature.
+        """
+        self.clean_radmc_dir()
+        self.set_model(model)
+        self.set_mctherm_inpfiles()
+        self.run_mctherm()
+
+        rho = self.get_gas_density()
+        if not np.allclose(rho, model.rhogas, rtol=1e-07, atol=1e-20):
+            logger.error(
+                "Input value mismatches with that read by radmc3d: gas density"
+            )
+            raise Exception
+
+        Tgas = self.get_gas_temperature()
+        if is_axisymmetric(model.rhogas):
+            # Averaging over phi also reduces the Monte Carlo noise
+            Tgas = broadcast_phi(Tgas.mean(axis=2, keepdims=True), Tgas.shape[2])
+        return Tgas
+
+    def read_radmc_data(self):
+        """
+        Read the fields in radmc_dir by path; the working directory of the
+        process is not changed.
+        """
+        md = self.model
+        shape = (len(md.rc_ax), len(md.tc_ax), len(md.pc_ax))
+        path = lambda filename: os.path.join(self.radmc_dir, filename)
+        self.rmcdata = SimpleNamespace(
+            rhodust=read_field_file(path("dust_density.inp"), shape, nspec=True),
+            dusttemp=read_field_file(path("dust_temperature.dat"), shape, nspec=True),
+            gastemp=read_field_file(path("gas_temperature.inp"), shape),
+            gasvel=read_field_file(path("gas_velocity.inp"), shape, ncomp=3),
+            ndens_mol=read_field_file(path(f"numberdens_{self.molname}.inp"), shape),
+        )
 
     def get_dust_density(self):
         return self.get_value("rhodust")
@@ -383,6 +501,40 @@ class RadmcController:
 """
 
 
+def read_field_file(filepath, shape, nspec=False, ncomp=1):
+    """
+    Read an ascii RADMC-3D field file into an array shaped
+    (nr, ntheta, nphi, ncomp), ncomp being the number of dust species
+    (nspec=True) or of vector components. Returns an empty array if
+    the file does not exist.
+    """
+    if not os.path.isfile(filepath):
+        return np.array([])
+    data = np.fromfile(filepath, sep=" ")
+    if nspec:
+        ncomp = int(data[2])
+        values = data[3:].reshape(ncomp, *shape[::-1])
+        return values.transpose(3, 2, 1, 0)
+    values = data[2:].reshape(*shape[::-1], ncomp)
+    return values.transpose(2, 1, 0, 3)
+
+
+def read_dust_temperature(dpath):
+    """
+    Returns the header (iformat, ncell, nspec) and the temperatures
+    of dust_temperature.dat, shaped (nspec, ncell).
+    """
+    data = np.loadtxt(os.path.join(dpath, "dust_temperature.dat"))
+    header = data[:3].astype(int)
+    return header, data[3:].reshape(header[2], header[1])
+
+
+def save_dust_temperature(dpath, header, T):
+    with open(os.path.join(dpath, "dust_temperature.dat"), "w") as f:
+        f.write("\n".join(str(h) for h in header) + "\n")
+        np.savetxt(f, T.ravel(), fmt="%13.8e")
+
+
 def remove_file(file_path):
     if os.path.exists(file_path):
         os.remove(file_path)
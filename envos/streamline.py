@@ -1,27 +1,45 @@
 import os
 import numpy as np
 from dataclasses import dataclass, field
-from scipy import interpolate, integrate
+from types import SimpleNamespace
+from scipy import integrate
 from envos import log
-from envos.gpath import run_dir
+from envos import gpath
+from envos import models
+from envos.grid import FieldSampler
 import envos.nconst as nc
+from envos.nconst import G
 
 logger = log.set_logger(__name__)
 
 def calc_physical_values_along_streamlines(
     model, start_points, **kwargs
 ):
-    calc_streamlines_from_model(
+    return calc_streamlines_from_model(
         model, ["rhogas", "Tgas"], ["g cm^-3", "K"], start_points, **kwargs
     )
 
 
 
 def calc_streamlines_from_model(
-    model, name_list, unit_list, start_points, **kwargs
+    model, name_list, unit_list, start_points, analytic=True, **kwargs
 ):
+    """
+    With analytic=True, streamlines of UCM or simple ballistic models
+    (model.orbit set) are evaluated in closed form, and otherwise
+    integrated numerically.
+    """
     values = [(n, getattr(model, n), u) for n, u in zip(name_list, unit_list)]
-    calc_streamlines(
+    if analytic and getattr(model, "orbit", None) is not None:
+        # Options of the numerical integration (rtol, method, ...) are unused
+        keys = ("t_span", "t_eval", "nt", "filename", "dpath", "save", "columnar")
+        return calc_streamlines_analytic(
+            model,
+            start_points,
+            values=values,
+            **{k: v for k, v in kwargs.items() if k in keys},
+        )
+    return calc_streamlines(
         model.rc_ax,
         model.tc_ax,
         model.vr[:, :, 0],
@@ -47,6 +65,9 @@ def calc_streamlines(
     method="RK23",
     dpath=None,
     save=False,
+    columnar=False,
+    batch=False,
+    context=None,
 ):
     slc = StreamlineCalculator(
         r_ax,
@@ -60,11 +81,50 @@ def calc_streamlines(
         rtol=rtol,
         method=method,
     )
+    for name, value, unitname in values:
+        slc.add_value(name, value, unitname)
+    if batch:
+        slc.calc_streamlines_batched()
+    else:
+        slc.calc_streamlines()
+    if save:
+        save_data(
+            slc.streamlines,
+            filename=filename,
+            dpath=dpath,
+            columnar=columnar,
+            context=context,
+        )
+    return slc.streamlines
+
+
+def calc_streamlines_analytic(
+    model,
+    pos0list,
+    values=[],
+    t_span=(1, 1e30),
+    t_eval=None,
+    nt=500,
+    filename="stream",
+    dpath=None,
+    save=False,
+    columnar=False,
+    context=None,
+):
+    slc = AnalyticStreamlineCalculator(
+        model, pos0list, t_span=t_span, t_eval=t_eval, nt=nt
+    )
     for name, value, unitname in values:
         slc.add_value(name, value, unitname)
     slc.calc_streamlines()
     if save:
-        save_data(slc.streamlines, filename=filename, dpath=dpath)
+        save_data(
+            slc.streamlines,
+            filename=filename,
+            dpath=dpath,
+            columnar=columnar,
+            context=context,
+        )
     return slc.streamlines
 
 
@@ -101,12 +161,7 @@ class StreamlineCalculator:
     ):
         self.r_ax = r_ax
         self.t_ax = t_ax
-        self.vr_field = interpolate.RegularGridInterpolator(
-            (r_ax, t_ax), vr, bounds_error=False, fill_value=None
-        )
-        self.vt_field = interpolate.RegularGridInterpolator(
-            (r_ax, t_ax), vt, bounds_error=False, fill_value=None
-        )
+        self.v_field = FieldSampler(r_ax, t_ax, vr, vt)
         self.pos0list = pos0list
         self.t_eval = t_eval if t_eval is not None else np.geomspace(t_span[0], t_span[-1], nt)
         self.rtol = rtol
@@ -122,6 +177,38 @@ class StreamlineCalculator:
         for pos0 in self.pos0list:
             self.calc_streamline(pos0)
 
+    def calc_streamlines_batched(self, atol=1e-6):
+        """
+        Same as calc_streamlines, but all start points are integrated at
+        once by solve_ivp_batched.
+        """
+        pos0list = []
+        for pos0 in self.pos0list:
+            if pos0[0] > self.r_ax[-1]:
+                logger.info(
+                    f"Too large starting radius (r0 = {pos0[0]/nc.au:.2f} au). "
+                    + f"Use r0 = max(r_ax) = {self.r_ax[-1]/nc.au:.2f} au instead."
+                )
+                pos0 = [self.r_ax[-1], pos0[1]]
+            pos0list.append(pos0)
+
+        results = solve_ivp_batched(
+            self._func_batch,
+            self.t_eval,
+            np.array(pos0list, dtype=float),
+            method=self.method,
+            event=lambda pos: np.pi / 2 - pos[:, 1],
+            rtol=self.rtol,
+            atol=atol,
+        )
+        for res in results:
+            self.add_streamline(res)
+
+    def _func_batch(self, pos):
+        vr, vt = self.v_field(pos)
+        vt = np.where(np.pi / 2 < pos[:, 1], -vt, vt)
+        return np.stack((vr, vt / pos[:, 0]), axis=-1)
+
     def calc_streamline(self, pos0):
         if pos0[0] > self.r_ax[-1]:
             logger.info(
@@ -142,8 +229,7 @@ class StreamlineCalculator:
         self.add_streamline(res)
 
     def _func(self, t, pos):
-        vr = self.vr_field(pos)[0]
-        vt = self.vt_field(pos)[0]
+        vr, vt = self.v_field(pos)
         if np.isnan(pos[0]):
             raise Exception
         if  np.pi / 2 < pos[1]:
@@ -157,8 +243,7 @@ class StreamlineCalculator:
     def add_streamline(self, res):
         R = res.y[0] * np.sin(res.y[1])
         z = res.y[0] * np.cos(res.y[1])
-        vr = self.vr_field(res.y.T)
-        vt = self.vt_field(res.y.T)
+        vr, vt = self.v_field(res.y.T)
         vR = np.sin(res.y[1]) * vr + np.cos(res.y[1]) * vt
         vz = np.cos(res.y[1]) * vr - np.sin(res.y[1]) * vt
         sl = Streamline(res.y[:, 0], res.t, R, z, vR, vz)
@@ -168,19 +253,329 @@ class StreamlineCalculator:
         self.streamlines.append(sl)
 
     def _interpolate_along_streamline(self, value, points):
-        return interpolate.interpn(
-            (self.r_ax, self.t_ax),
-            value,
-            points.T,
-            bounds_error=False,
-            fill_value=None,
+        return self.v_field(points.T, value)
+
+
+class AnalyticStreamlineCalculator:
+    """
+    Streamlines of envelopes made of ballistic orbits around a point mass,
+    evaluated in closed form instead of integrating the velocity field.
+
+    model.orbit = "UCM":
+        Parabolic orbits labelled by mu0 = cos(theta0) (Ulrich 1976;
+        Cassen & Moosman 1981) with semi-latus rectum p = CR sin^2(theta0).
+        With the true anomaly nu and D = tan(nu/2),
+            r = p (1 + D^2) / 2 ,   cos(theta) = -mu0 cos(nu) ,
+            t = sqrt(p^3 / G Ms) (D + D^3 / 3) / 2 ,
+        and the orbit ends at the midplane (D = -1).
+    model.orbit = "Simple":
+        Radial infall at constant theta (SimpleBallisticInnerEnvelope),
+        which stops at the centrifugal barrier CB = CR / 2.
+
+    The result is the same as StreamlineCalculator with the midplane
+    event, but exact; the fields in add_value are sampled on the grid.
+    """
+
+    def __init__(
+        self,
+        model,
+        pos0list,
+        t_span=(1, 1e30),
+        t_eval=None,
+        nt=500,
+    ):
+        if model.orbit not in ("UCM", "Simple"):
+            raise Exception(f"Unknown orbit type: {model.orbit}")
+        self.orbit = model.orbit
+        self.GM = G * model.ppar.Ms
+        self.CR = model.ppar.CR
+        self.r_ax = model.rc_ax
+        self.sampler = FieldSampler(model.rc_ax, model.tc_ax)
+        self.pos0list = pos0list
+        self.t_eval = np.asarray(
+            t_eval if t_eval is not None else np.geomspace(t_span[0], t_span[-1], nt)
         )
+        self.streamlines = []
+        self.value_list = []
 
+    def add_value(self, name, value, unitname):
+        self.value_list.append([name, value, unitname])
+
+    def calc_streamlines(self):
+        r0, theta0 = np.array(self.pos0list, dtype=float).T
+        toolarge = r0 > self.r_ax[-1]
+        if np.any(toolarge):
+            logger.info(
+                f"Too large starting radius in {np.sum(toolarge)} start points. "
+                + f"Use r0 = max(r_ax) = {self.r_ax[-1]/nc.au:.2f} au instead."
+            )
+            r0 = np.where(toolarge, self.r_ax[-1], r0)
+
+        # The southern hemisphere mirrors the northern one
+        south = theta0 > np.pi / 2
+        mu = np.abs(np.cos(theta0))[:, np.newaxis]
+        r0 = r0[:, np.newaxis]
+        dt = (self.t_eval - self.t_eval[0])[np.newaxis, :]
+
+        # Points beyond the end of an orbit may overflow; they are dropped
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            if self.orbit == "UCM":
+                r, mu, vr, vt, valid = self._calc_ucm_orbits(r0, mu, dt)
+            else:
+                r, mu, vr, vt, valid = self._calc_simple_orbits(r0, mu, dt)
+
+        # A start point on the midplane ends there, as with the midplane event
+        valid[theta0 == np.pi / 2, 1:] = False
+        theta = np.arccos(np.where(south[:, np.newaxis], -mu, mu))
+        vt = np.where(south[:, np.newaxis], -vt, vt)
+        for i in range(len(r0)):
+            n = np.sum(np.cumprod(valid[i]))
+            self.add_streamline(r[i, :n], theta[i, :n], vr[i, :n], vt[i, :n])
+
+    def _calc_ucm_orbits(self, r0, mu, dt):
+        mu0 = _polish_mu0(models.solve_mu0(mu, self.CR / r0), mu, self.CR / r0)
+        sin0_2 = 1 - mu0 ** 2
+        radial = sin0_2 <= 0
+
+        # Parabolic orbits (Barker's equation)
+        p = np.where(radial, 1.0, self.CR * sin0_2)
+        ratio = np.divide(mu, mu0, out=np.zeros_like(mu), where=(mu0 > 0) & ~radial)
+        D0 = -np.sqrt((1 + ratio) / np.maximum(1 - ratio, 1e-300))
+        tau = D0 + D0 ** 3 / 3 + 2 * np.sqrt(self.GM / p ** 3) * dt
+        D = _solve_barker(tau)
+        r = 0.5 * p * (1 + D ** 2)
+        ratio = (D ** 2 - 1) / (D ** 2 + 1)
+        valid = D <= -1
+
+        # Free fall along the axis
+        r15 = r0 ** 1.5 - 1.5 * np.sqrt(2 * self.GM) * dt
+        r = np.where(radial, np.cbrt(np.maximum(r15, 0)) ** 2, r)
+        ratio = np.where(radial, 1.0, ratio)
+        valid = np.where(radial, r15 > 0, valid)
+        valid[:, 0] = True
+
+        mu = mu0 * ratio
+        sin = np.sqrt(1 - mu ** 2)
+        v0 = np.sqrt(self.GM / r)
+        vr = -v0 * np.sqrt(1 + ratio)
+        vt = v0 * np.divide(
+            mu0 - mu, sin, out=np.zeros_like(mu), where=sin > 0
+        ) * np.sqrt(1 + ratio)
+        return r, mu, vr, vt, valid
+
+    def _calc_simple_orbits(self, r0, mu, dt):
+        # t(r) = [2/3 u^(3/2) + 2 CB u^(1/2)] / sqrt(2 G Ms), u = r - CB
+        CB = self.CR / 2
+        s0 = np.sqrt(np.maximum(r0 - CB, 0))
+        X = 2 / 3 * s0 ** 3 + 2 * CB * s0 - np.sqrt(2 * self.GM) * dt
+        # s^3 + 3 CB s - 3/2 X = 0
+        a = 0.75 * np.maximum(X, 0)
+        P = np.cbrt(a + np.sqrt(a ** 2 + CB ** 3))
+        s = P - np.divide(CB, P, out=np.zeros_like(P), where=P > 0)
+        s -= (s ** 3 + 3 * CB * s - 2 * a) / np.maximum(3 * s ** 2 + 3 * CB, 1e-300)
+        r = np.where(r0 > CB, CB + s ** 2, r0)
+        vr = -np.sqrt(2 * self.GM / r) * np.sqrt(np.clip(1 - CB / r, 0, None))
+        mu = np.broadcast_to(mu, r.shape)
+        valid = np.ones(r.shape, dtype=bool)
+        return r, mu, vr, np.zeros_like(r), valid
+
+    def add_streamline(self, r, theta, vr, vt):
+        R = r * np.sin(theta)
+        z = r * np.cos(theta)
+        vR = np.sin(theta) * vr + np.cos(theta) * vt
+        vz = np.cos(theta) * vr - np.sin(theta) * vt
+        t = self.t_eval[: len(r)]
+        sl = Streamline(np.array([r[0], theta[0]]), t, R, z, vR, vz)
+        if self.value_list:
+            points = np.stack((r, theta), axis=-1)
+            vints = self.sampler(points, *[v for _, v, _ in self.value_list])
+            if len(self.value_list) == 1:
+                vints = [vints]
+            for (name, _, unitname), vint in zip(self.value_list, vints):
+                sl.add_value(name, vint, unitname)
+        self.streamlines.append(sl)
+
+
+def _polish_mu0(mu0, mu, zeta):
+    # solve_mu0 rounds the roots; refine them by Newton's method
+    for _ in range(3):
+        f = zeta * mu0 ** 3 + (1 - zeta) * mu0 - mu
+        df = 3 * zeta * mu0 ** 2 + 1 - zeta
+        step = np.divide(f, df, out=np.zeros_like(f), where=np.abs(df) > 1e-6)
+        mu0 = np.clip(mu0 - step, 0, 1)
+    return mu0
+
+
+def _solve_barker(tau):
+    """
+    Real root D of D + D^3/3 = tau.
+    """
+    a = 1.5 * tau
+    b = np.sqrt(a ** 2 + 1)
+    # (b + a)(b - a) = 1; take the larger factor to avoid cancellation
+    P = np.where(a >= 0, a + b, 1 / (b - a))
+    D = np.cbrt(P) - np.cbrt(1 / P)
+    return D - (D + D ** 3 / 3 - tau) / (1 + D ** 2)
+
+
+def solve_ivp_batched(
+    fun, t_eval, y0, method="RK45", event=None, rtol=1e-3, atol=1e-6
+):
+    """
+    Integrate dy/dt = fun(y) for many initial values at once.
+
+    fun  : vectorized right-hand side, (n, ndim) -> (n, ndim)
+    t_eval: output times; the integration runs from t_eval[0] to t_eval[-1]
+    y0   : initial values, (n, ndim)
+    event: vectorized function of y, (n, ndim) -> (n,); a trajectory
+           terminates where it changes sign (as a terminal event in solve_ivp)
+
+    Every trajectory has its own step size, controlled as in
+    scipy.integrate.solve_ivp with the explicit Runge-Kutta pairs "RK23"
+    and "RK45", and is evaluated at t_eval with the same dense output.
+    Returns a list of objects with `t` and `y` (ndim, nt) like the result
+    of solve_ivp.
+    """
+    solver = {"RK23": integrate.RK23, "RK45": integrate.RK45}[method]
+    A, B, C, E, P = solver.A, solver.B, solver.C, solver.E, solver.P
+    n_stages = solver.n_stages
+    exponent = -1 / (solver.error_estimator_order + 1)
+    safety, min_factor, max_factor = 0.9, 0.2, 10
+
+    def rmsnorm(x):
+        return np.sqrt(np.mean(x ** 2, axis=-1))
+
+    t_eval = np.asarray(t_eval, dtype=float)
+    t_end = t_eval[-1]
+    y = np.array(y0, dtype=float)
+    n, ndim = y.shape
+    t = np.full(n, t_eval[0])
+    f = fun(y)
+
+    # Initial step size (scipy.integrate._ivp.common.select_initial_step)
+    scale = atol + np.abs(y) * rtol
+    d0 = rmsnorm(y / scale)
+    d1 = rmsnorm(f / scale)
+    h0 = np.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01 * d0 / np.maximum(d1, 1e-300))
+    h0 = np.minimum(h0, t_end - t)
+    d2 = rmsnorm((fun(y + h0[:, None] * f) - f) / scale) / h0
+    h1 = np.where(
+        (d1 <= 1e-15) & (d2 <= 1e-15),
+        np.maximum(1e-6, h0 * 1e-3),
+        (0.01 / np.maximum(np.maximum(d1, d2), 1e-300)) ** (-exponent),
+    )
+    h_abs = np.minimum(np.minimum(100 * h0, h1), t_end - t)
+
+    g = event(y) if event is not None else None
+    ys_out = np.full((n, len(t_eval), ndim), np.nan)
+    i_eval = np.zeros(n, dtype=int)
+    n_eval = np.zeros(n, dtype=int)
+    rejected = np.zeros(n, dtype=bool)
+    active = np.ones(n, dtype=bool)
+    K = np.empty((n, n_stages + 1, ndim))
+
+    while np.any(active):
+        idx = np.flatnonzero(active)
+        t_i, y_i, f_i = t[idx], y[idx], f[idx]
+        t_new = np.where(h_abs[idx] < t_end - t_i, t_i + h_abs[idx], t_end)
+        h = t_new - t_i
+        h_col = h[:, None]
+
+        K_i = K[idx]
+        K_i[:, 0] = f_i
+        for s in range(1, n_stages):
+            dy = np.einsum("nsd,s->nd", K_i[:, :s], A[s, :s]) * h_col
+            K_i[:, s] = fun(y_i + dy)
+        y_new = y_i + h_col * np.einsum("nsd,s->nd", K_i[:, :-1], B)
+        f_new = fun(y_new)
+        K_i[:, -1] = f_new
+
+        scale = atol + np.maximum(np.abs(y_i), np.abs(y_new)) * rtol
+        err = rmsnorm(np.einsum("nsd,s->nd", K_i, E) * h_col / scale)
+        err = np.where(np.isfinite(err), err, np.inf)
+        accepted = err < 1
+
+        with np.errstate(divide="ignore"):
+            factor = np.minimum(max_factor, safety * err ** exponent)
+        factor = np.where(rejected[idx], np.minimum(1, factor), factor)
+        factor = np.where(accepted, factor, np.maximum(min_factor, factor))
+        h_abs[idx] = h * factor
+        rejected[idx] = ~accepted
+
+        # Trajectories whose step underflows are given up (solve_ivp fails)
+        min_step = 10 * np.abs(np.nextafter(t_i, np.inf) - t_i)
+        failed = ~accepted & (h_abs[idx] < min_step)
+        if np.any(failed):
+            logger.warning(f"{np.sum(failed)} trajectories failed: step size too small")
+            active[idx[failed]] = False
+
+        if not np.any(accepted):
+            continue
+        a = np.flatnonzero(accepted)
+        ia = idx[a]
+        K[ia] = K_i[a]
+        t_old, y_old, h_a = t_i[a], y_i[a], h[a]
+        t_new = t_new[a]
+        t_stop = t_new.copy()
+        Q = np.einsum("nsd,sk->ndk", K_i[a], P)
+
+        def dense(j, tt):
+            x = (tt - t_old[j]) / h_a[j]
+            p = np.cumprod(np.repeat(x[:, None], P.shape[1], axis=1), axis=1)
+            return y_old[j] + h_a[j, None] * np.einsum("ndk,nk->nd", Q[j], p)
+
+        finished = t_new >= t_end
+        if event is not None:
+            g_old, g_new = g[ia], event(y_new[a])
+            hit = ((g_old <= 0) & (g_new >= 0)) | ((g_old >= 0) & (g_new <= 0))
+            if np.any(hit):
+                j = np.flatnonzero(hit)
+                lo, hi = t_old[j], t_new[j]
+                g_lo = g_old[j]
+                for _ in range(60):
+                    mid = 0.5 * (lo + hi)
+                    same = np.sign(event(dense(j, mid))) == np.sign(g_lo)
+                    lo = np.where(same, mid, lo)
+                    hi = np.where(same, hi, mid)
+                t_stop[j] = hi
+                finished[j] = True
+            g[ia] = g_new
+
+        # Dense output at t_eval within (t_old, t_stop]
+        i_new = np.searchsorted(t_eval, t_stop, side="right")
+        count = i_new - i_eval[ia]
+        if np.any(count > 0):
+            j = np.repeat(np.arange(len(ia)), count)
+            k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            k += i_eval[ia][j]
+            ys_out[ia[j], k] = dense(j, t_eval[k])
+            i_eval[ia] = i_new
+            n_eval[ia] = i_new
+
+        t[ia] = t_new
+        y[ia] = y_new[a]
+        f[ia] = f_new[a]
+        active[ia[finished]] = False
+
+    return [
+        SimpleNamespace(t=t_eval[: n_eval[i]], y=ys_out[i, : n_eval[i]].T)
+        for i in range(n)
+    ]
+
+
+def save_data(streamlines, filename="stream", dpath=None, columnar=False, context=None):
+    """
+    Saves one text file per streamline, or all streamlines in one
+    columnar file with columnar=True (see save_streamlines), in dpath or
+    the run_dir of the context.
+    """
+    if columnar:
+        return save_streamlines(
+            streamlines, filename=filename, dpath=dpath, context=context
+        )
 
-def save_data(streamlines, filename="stream", dpath=None):
-    global run_dir
     if dpath is None:
-        dpath = run_dir
+        dpath = gpath.get_context(context).run_dir
     os.makedirs(dpath, exist_ok=True)
 
     for sl in streamlines:
@@ -191,7 +586,6 @@ def save_data(streamlines, filename="stream", dpath=None):
             header += f"{name} [{unitname}]"
             values.append(value[...,0])
 
-        print( sl.vR, sl.vz, *values )
         stream_data = np.stack(
             (sl.t, sl.R, sl.z, sl.vR, sl.vz, *values), axis=-1
         )
@@ -204,8 +598,77 @@ def save_data(streamlines, filename="stream", dpath=None):
         )
 
 
-def make_streamline_data(model, r0, theta0, t_eval, rtol=1e-4, method="RK23"):
-    slc = StreamlineCalculator2(model, t_eval=t_eval, rtol=rtol, method=method, save=True)
+"""
+Columnar streamline file
+
+All streamlines are saved in one npz file. The arrays of the streamlines
+are concatenated, and streamline i is the slice offsets[i]:offsets[i+1]:
+
+    offsets        : (n+1,) start indices of the streamlines
+    pos0           : (n, 2) start points (r, theta)
+    t, R, z, vR, vz: concatenated arrays of the streamlines
+    value_<name>   : concatenated sampled values
+    value_names, value_units: names and units of the sampled values
+"""
+
+
+def save_streamlines(
+    streamlines, filename="stream", dpath=None, compress=False, context=None
+):
+    if dpath is None:
+        dpath = gpath.get_context(context).run_dir
+    os.makedirs(dpath, exist_ok=True)
+    filepath = os.path.join(dpath, f"{filename}.npz")
+
+    lengths = [len(sl.t) for sl in streamlines]
+    data = {
+        "offsets": np.concatenate(([0], np.cumsum(lengths))).astype(np.int64),
+        "pos0": np.array([sl.pos0 for sl in streamlines], dtype=float).reshape(-1, 2),
+    }
+    for key in ("t", "R", "z", "vR", "vz"):
+        data[key] = np.concatenate([getattr(sl, key) for sl in streamlines])
+
+    values = streamlines[0].get_values() if streamlines else []
+    data["value_names"] = np.array([name for name, _, _ in values], dtype=str)
+    data["value_units"] = np.array([unit for _, _, unit in values], dtype=str)
+    for i, (name, _, _) in enumerate(values):
+        data[f"value_{name}"] = np.concatenate(
+            [np.asarray(sl.values[i][1]) for sl in streamlines]
+        )
+
+    (np.savez_compressed if compress else np.savez)(filepath, **data)
+    logger.info(f"Saved {len(streamlines)} streamlines: {filepath}")
+    return filepath
+
+
+def read_streamlines(filepath):
+    """
+    Returns the Streamline objects saved by save_streamlines. Their arrays
+    are views of the concatenated columns.
+    """
+    with np.load(filepath) as npz:
+        data = {k: npz[k] for k in npz.files}
+
+    offsets = data["offsets"]
+    streamlines = []
+    for i in range(len(offsets) - 1):
+        sl_range = slice(offsets[i], offsets[i + 1])
+        sl = Streamline(
+            data["pos0"][i],
+            *[data[key][sl_range] for key in ("t", "R", "z", "vR", "vz")],
+        )
+        for name, unit in zip(data["value_names"], data["value_units"]):
+            sl.add_value(str(name), data[f"value_{name}"][sl_range], str(unit))
+        streamlines.append(sl)
+    return streamlines
+
+
+def make_streamline_data(
+    model, r0, theta0, t_eval, rtol=1e-4, method="RK23", context=None
+):
+    slc = StreamlineCalculator2(
+        model, t_eval=t_eval, rtol=rtol, method=method, save=True, context=context
+    )
     slc.calc_streamline(r0, theta0)
     slc.save_data()
 
@@ -225,15 +688,13 @@ class StreamlineCalculator2:
         t_eval=np.geomspace(1, 1e30, 500),
         rtol=1e-8,
         method="RK45",
-        save=False
+        save=False,
+        context=None,
     ):
         self.r_ax = model.rc_ax
         self.t_ax = model.tc_ax
-        self.vr_field = interpolate.RegularGridInterpolator(
-            (self.r_ax, self.t_ax), model.vr[...,0], bounds_error=False, fill_value=None
-        )
-        self.vt_field = interpolate.RegularGridInterpolator(
-            (self.r_ax, self.t_ax), model.vt[...,0], bounds_error=False, fill_value=None
+        self.v_field = FieldSampler(
+            self.r_ax, self.t_ax, model.vr[..., 0], model.vt[..., 0]
         )
         self.t_eval = t_eval
         self.rtol = rtol
@@ -241,6 +702,7 @@ class StreamlineCalculator2:
         self.streamlines = []
         self._hit_midplane.terminal = True
         self.save = save
+        self.context = context
 
         self.value_list = []
         if hasattr(model, "rhogas"):
@@ -278,8 +740,7 @@ class StreamlineCalculator2:
         self.add_streamline(res)
 
     def _func(self, t, pos):
-        vr = self.vr_field(pos)[0]
-        vt = self.vt_field(pos)[0]
+        vr, vt = self.v_field(pos)
         if np.isnan(pos[0]):
             raise Exception
         if np.pi / 2 < pos[1]:
@@ -293,8 +754,7 @@ class StreamlineCalculator2:
     def add_streamline(self, res):
         R = res.y[0] * np.sin(res.y[1])
         z = res.y[0] * np.cos(res.y[1])
-        vr = self.vr_field(res.y.T)
-        vt = self.vt_field(res.y.T)
+        vr, vt = self.v_field(res.y.T)
         vR = np.sin(res.y[1]) * vr + np.cos(res.y[1]) * vt
         vz = np.cos(res.y[1]) * vr - np.sin(res.y[1]) * vt
         sl = Streamline(res.y[:, 0], res.t, R, z, vR, vz)
@@ -304,18 +764,16 @@ class StreamlineCalculator2:
         self.streamlines.append(sl)
 
     def _interpolate_along_streamline(self, value, points):
-        return interpolate.interpn(
-            (self.r_ax, self.t_ax),
-            value,
-            points.T,
-            bounds_error=False,
-            fill_value=None,
-        )
+        return self.v_field(points.T, value)
+
+    def save_data(self, filename="stream", dpath=None, columnar=False):
+        if columnar:
+            return save_streamlines(
+                self.streamlines, filename=filename, dpath=dpath, context=self.context
+            )
 
-    def save_data(self, filename="stream", dpath=None):
-        global run_dir
         if dpath is None:
-            dpath = run_dir
+            dpath = gpath.get_context(self.context).run_dir
         os.makedirs(dpath, exist_ok=True)
 
         for sl in self.streamlines:
@@ -0,0 +1,277 @@
+import os
+import json
+import time
+import itertools
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+
+from envos import tsc, gpath, tools
+from envos.grid import make_grid_from_config
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+GRID_KEYS = (
+    "ri_ax", "ti_ax", "pi_ax", "rau_in", "rau_out", "theta_in", "theta_out",
+    "phi_in", "phi_out", "nr", "ntheta", "nphi", "dr_to_r", "aspect_ratio",
+    "logr",
+)
+STAGES = ("kinematic", "thermal", "obs")
+INDEX_FILENAME = "index.jsonl"
+
+# Grid shared by all points run in this process (set by _init_worker)
+_shared_grid = None
+
+
+def make_param_list(params):
+    """
+    params is either a dict of lists, which is expanded into the full
+    parameter grid, or a list of dicts, which is used as it is.
+    """
+    if isinstance(params, dict):
+        keys = list(params.keys())
+        values = [np.atleast_1d(params[k]).tolist() for k in keys]
+        return [dict(zip(keys, vals)) for vals in itertools.product(*values)]
+    return [dict(p) for p in params]
+
+
+class SweepRunner:
+    """
+    Run the envos pipeline for many parameter sets.
+
+    example
+    ------------
+    sweep = SweepRunner(config, {"CR_au": [50, 100, 200], "incl": [60, 90]},
+                        sweep_dir="./sweep", n_proc=8)
+    table = sweep.run()
+
+    All points share one Grid, built from `config`, and the TSC table
+    loaded in the parent process. Each point runs in its own directory
+    (sweep_dir/point_XXXXX) with its own radmc directory, so points can
+    run concurrently in a process pool. Every finished point is appended
+    to sweep_dir/index.jsonl as soon as it returns; on resume, points
+    whose parameters have a finished record there are skipped. With `library` (an
+    ObsLibrary or its directory), the PV map of every finished point is
+    also added to the library, and its id is recorded as "library_id".
+    """
+
+    def __init__(
+        self,
+        config,
+        params,
+        sweep_dir="./sweep",
+        n_proc=1,
+        stages=STAGES,
+        pangle_deg=0,
+        save_model=True,
+        resume=True,
+        library=None,
+    ):
+        self.config = config
+        self.param_list = make_param_list(params)
+        self.sweep_dir = os.path.abspath(sweep_dir)
+        self.index_path = os.path.join(self.sweep_dir, INDEX_FILENAME)
+        self.n_proc = n_proc
+        self.stages = tuple(stages)
+        self.pangle_deg = pangle_deg
+        self.save_model = save_model
+        self.resume = resume
+        if isinstance(library, str):
+            from envos.library import ObsLibrary
+            library = ObsLibrary(library)
+        self.library = library
+
+        unknown = [s for s in self.stages if s not in STAGES]
+        if unknown:
+            raise Exception(f"Unknown stages: {unknown}")
+
+        swept_keys = set(k for p in self.param_list for k in p)
+        grid_keys = swept_keys.intersection(GRID_KEYS)
+        if grid_keys:
+            raise Exception(
+                f"Grid parameters cannot be swept with a shared grid: {grid_keys}"
+            )
+
+    def run(self):
+        os.makedirs(self.sweep_dir, exist_ok=True)
+        if self.resume:
+            tasks = self._get_remaining_tasks()
+        else:
+            tasks = list(enumerate(self.param_list))
+        logger.info(
+            f"Sweep: {len(self.param_list)} points, "
+            f"{len(self.param_list) - len(tasks)} already done, "
+            f"{len(tasks)} to run with {self.n_proc} processes"
+        )
+
+        grid = make_grid_from_config(self.config)
+        if self.config.outenv == "TSC":
+            self._preload_tsc_table()
+
+        common = (self.config, self.sweep_dir, self.stages, self.pangle_deg, self.save_model)
+
+        if self.n_proc <= 1:
+            _init_worker(grid)
+            for i, p in tasks:
+                self._append_index(_run_point(i, p, *common))
+        else:
+            with ProcessPoolExecutor(
+                self.n_proc, initializer=_init_worker, initargs=(grid,)
+            ) as executor:
+                futures = [
+                    executor.submit(_run_point, i, p, *common) for i, p in tasks
+                ]
+                for fut in as_completed(futures):
+                    self._append_index(fut.result())
+
+        return read_sweep_index(self.index_path)
+
+    def _preload_tsc_table(self):
+        storage_dir = gpath.get_context(config=self.config).storage_dir
+        path = os.path.join(storage_dir, tsc.FILENAME)
+        if os.path.isfile(path):
+            tsc.cache.get_table(path)
+
+    def _get_remaining_tasks(self):
+        """
+        (index, params) of the points without a finished record. Stored
+        records are matched on their parameters, not on their position in
+        param_list; a point that failed keeps its index and new points are
+        numbered after the indices in use.
+        """
+        records = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records[_params_key(record["params"])] = record
+        next_index = max((r["index"] for r in records.values()), default=-1) + 1
+        tasks = []
+        for p in self.param_list:
+            record = records.get(_params_key(p))
+            if record is None:
+                tasks.append((next_index, p))
+                next_index += 1
+            elif record["status"] != "done":
+                tasks.append((record["index"], p))
+        return tasks
+
+    def _append_index(self, record):
+        if self.library is not None and record["status"] == "done" and "PV" in record:
+            PV = tools.read_pickle(record["PV"])
+            record["library_id"] = self.library.add(PV, record["params"])
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(record, default=_json_default) + "\n")
+        logger.info(
+            f"Sweep point {record['index']} {record['status']}: {record['params']}"
+        )
+
+
+def _init_worker(grid):
+    global _shared_grid
+    _shared_grid = grid
+
+
+def _run_point(i, params, base_config, sweep_dir, stages, pangle_deg, save_model):
+    point_dir = os.path.join(sweep_dir, f"point_{i:05d}")
+    record = {"index": i, "params": params, "dir": point_dir, "status": "running"}
+
+    # The point's Config sets the global dirs and log file in
+    # __post_init__; restored so that the caller keeps its own
+    with gpath.keep_global_dirs():
+        _run_stages(record, params, base_config, stages, pangle_deg, save_model)
+    return record
+
+
+def _run_stages(record, params, base_config, stages, pangle_deg, save_model):
+    from envos.model_generator import ModelGenerator
+    from envos.obs import ObsSimulator
+
+    point_dir = record["dir"]
+    try:
+        changes = dict(
+            run_dir=point_dir,
+            radmc_dir=os.path.join(point_dir, "radmc"),
+            fig_dir=os.path.join(point_dir, "fig"),
+        )
+        if base_config.logfile is not None:
+            changes["logfile"] = os.path.join(point_dir, "log.dat")
+        config = base_config.replaced(**changes, **params)
+
+        t0 = time.perf_counter()
+        mg = ModelGenerator(config, grid=_shared_grid)
+        if "kinematic" in stages:
+            mg.calc_kinematic_structure()
+            record["time_kinematic"] = time.perf_counter() - t0
+
+        if "thermal" in stages:
+            t0 = time.perf_counter()
+            mg.calc_thermal_structure()
+            record["time_thermal"] = time.perf_counter() - t0
+            if hasattr(mg, "thermal_decision"):
+                record["thermal_decision"] = mg.thermal_decision
+            if getattr(mg, "mctherm_convergence", None) is not None:
+                record["nphot_used"] = mg.mctherm_convergence[-1]["nphot"]
+
+        model = mg.get_model()
+        if save_model:
+            model.save_pickle("model.pkl", filepath=os.path.join(point_dir, "model.pkl"))
+            record["model"] = os.path.join(point_dir, "model.pkl")
+
+        if "obs" in stages:
+            t0 = time.perf_counter()
+            osim = ObsSimulator(config)
+            osim.set_model(model)
+            odat = osim.observe_line()
+            PV = odat.get_PV_map(pangle_deg=pangle_deg)
+            record["obsdata"] = os.path.join(point_dir, "lineobs.pkl")
+            record["PV"] = os.path.join(point_dir, "PV.pkl")
+            odat.save_instance(filepath=record["obsdata"])
+            PV.save_instance(filepath=record["PV"])
+            record["time_obs"] = time.perf_counter() - t0
+
+        record["status"] = "done"
+
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+        logger.error(traceback.format_exc())
+
+
+def _params_key(params):
+    # The same key in any key order and for 100, 100.0 or np.float64(100)
+    return tuple(
+        sorted(
+            (k, float(v) if isinstance(v, (int, float, np.number)) else str(v))
+            for k, v in params.items()
+        )
+    )
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def read_sweep_index(path):
+    """
+    Read an index file written by SweepRunner as a DataFrame.
+    Swept parameters are expanded into columns. If a point appears
+    more than once (e.g. failed and then resumed), the last record is kept.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, INDEX_FILENAME)
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if len(records) == 0:
+        return pd.DataFrame()
+    table = pd.json_normalize(records)
+    table.columns = [c.replace("params.", "") for c in table.columns]
+    table = table.drop_duplicates("index", keep="last")
+    return table.sort_values("index").reset_index(drop=True)
@@ -0,0 +1,187 @@
+import os
+import json
+import numpy as np
+from scipy import ndimage
+
+from envos.grid import to_compact, expand_like, calc_cell_volume
+from envos.log import set_logger
+
+logger = set_logger(__name__)
+
+"""
+Warm-started thermal calculations
+
+A ThermalStore keeps the mctherm temperatures of previous models in a
+directory, indexed by their parameter vector:
+
+    <store_dir>/
+        index.jsonl        : one record per stored model
+        T_XXXXX.npz        : temperature and proxy temperature of that model
+
+For a new model, the temperatures of the nearest stored models (by
+relative parameter differences) are interpolated with inverse-distance weights and
+rescaled by the ratio of the semi-analytic (radeq) temperatures, which
+serve as a cheap proxy. The error of the estimate is judged from the
+proxy itself: how far the interpolated proxy temperatures are from the
+proxy temperature of the new model, mass-weighted over the model.
+
+    error <= tol                 : the estimate is used, mctherm is skipped
+    error <= correction_factor*tol : mctherm with nphot*correction_nphot_frac,
+                                   whose smoothed ratio to the estimate
+                                   corrects it
+    otherwise                    : full mctherm, stored for later models
+
+Only models with the same grid, opacity and model components are mixed.
+"""
+
+INDEX_FILENAME = "index.jsonl"
+PARAM_KEYS = (
+    "T", "CR_au", "Ms_Msun", "t_yr", "Omega", "jmid", "rexp_au",
+    "Mdot_smpy", "cavangle_deg", "f_dg", "Lstar_Lsun", "Rstar_Rsun",
+)
+
+
+class ThermalStore:
+    def __init__(
+        self,
+        store_dir,
+        keys=None,
+        tol=0.03,
+        correction_factor=3,
+        correction_nphot_frac=0.1,
+        n_neighbor=4,
+    ):
+        self.store_dir = os.path.abspath(store_dir)
+        self.index_path = os.path.join(self.store_dir, INDEX_FILENAME)
+        self.keys = tuple(keys) if keys is not None else PARAM_KEYS
+        self.tol = tol
+        self.correction_factor = correction_factor
+        self.correction_nphot_frac = correction_nphot_frac
+        self.n_neighbor = n_neighbor
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def get_params(self, config):
+        params = {}
+        for k in self.keys:
+            v = getattr(config, k)
+            if v is not None:
+                params[k] = float(v)
+        return params
+
+    def get_signature(self, config, model):
+        shape = tuple(np.shape(model.rhogas))
+        disk = getattr(config.disk, "__name__", config.disk)
+        return (
+            f"{shape}|{model.ri_ax[0]:.6e}|{model.ri_ax[-1]:.6e}|"
+            f"{config.opac}|{config.inenv}|{config.outenv}|{disk}"
+        )
+
+    def read_index(self):
+        if not os.path.isfile(self.index_path):
+            return []
+        with open(self.index_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def find_neighbors(self, params, signature):
+        records = [
+            r for r in self.read_index()
+            if r["signature"] == signature and r["params"].keys() == params.keys()
+        ]
+        if len(records) == 0:
+            return [], np.array([])
+        x = np.array([[params[k] for k in params]])
+        xs = np.array([[r["params"][k] for k in params] for r in records])
+        dist = calc_param_distance(x, xs)
+        order = np.argsort(dist)[: self.n_neighbor]
+        return [records[i] for i in order], dist[order]
+
+    def add(self, params, signature, T, Tproxy):
+        records = self.read_index()
+        ident = len(records)
+        filename = f"T_{ident:05d}_{os.getpid()}.npz"
+        np.savez(
+            os.path.join(self.store_dir, filename),
+            T=to_compact(T),
+            Tproxy=to_compact(Tproxy),
+        )
+        record = {"params": params, "signature": signature, "file": filename}
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def load(self, record):
+        with np.load(os.path.join(self.store_dir, record["file"])) as npz:
+            return npz["T"], npz["Tproxy"]
+
+    def estimate(self, model, neighbors, dist, Tproxy):
+        """
+        Returns the temperature estimate and its proxy error.
+        """
+        if dist[0] == 0:
+            weights = np.array([1.0] + [0.0] * (len(dist) - 1))
+        else:
+            weights = 1 / dist ** 2
+            weights /= np.sum(weights)
+
+        Tproxy = to_compact(Tproxy)
+        T_est = np.zeros_like(Tproxy)
+        Tproxy_interp = np.zeros_like(Tproxy)
+        for w, record in zip(weights, neighbors):
+            T_i, Tproxy_i = self.load(record)
+            T_est += w * T_i * Tproxy / Tproxy_i
+            Tproxy_interp += w * Tproxy_i
+
+        rho = to_compact(model.rhogas)
+        vol = calc_cell_volume(model.ri_ax, model.ti_ax, model.pi_ax)
+        if rho.shape[2] == 1:
+            vol = vol.sum(axis=2, keepdims=True)
+        mass = rho * vol
+        error = np.sum(mass * np.abs(Tproxy_interp / Tproxy - 1)) / np.sum(mass)
+        return T_est, error
+
+    def calc_temperature(self, mg):
+        """
+        Set the gas temperature of mg.model (mg: ModelGenerator).
+        Returns the decision made: "reuse", "correct" or "full".
+        """
+        config = mg.config
+        model = mg.model
+        params = self.get_params(config)
+        signature = self.get_signature(config, model)
+        Tproxy = mg.calc_radeq_temperature()
+        neighbors, dist = self.find_neighbors(params, signature)
+
+        if len(neighbors) != 0:
+            T_est, error = self.estimate(model, neighbors, dist, Tproxy)
+        else:
+            T_est, error = None, np.inf
+
+        if error <= self.tol:
+            decision = "reuse"
+            model.set_gas_temperature(expand_like(T_est, model.rhogas))
+
+        elif error <= self.correction_factor * self.tol:
+            decision = "correct"
+            mg.calc_thermal_structure_mctherm(
+                nphot=int(config.nphot * self.correction_nphot_frac)
+            )
+            ratio = to_compact(model.Tgas) / T_est
+            ratio = ndimage.uniform_filter(ratio, size=(3, 3, 1), mode="nearest")
+            model.set_gas_temperature(expand_like(T_est * ratio, model.rhogas))
+
+        else:
+            decision = "full"
+            mg.calc_thermal_structure_mctherm()
+            self.add(params, signature, model.Tgas, Tproxy)
+
+        logger.info(
+            f"Thermal store: {decision} (error estimate = {error:.3g}, "
+            f"tol = {self.tol}, neighbors = {[r['params'] for r in neighbors]})"
+        )
+        return decision
+
+
+def calc_param_distance(x, xs):
+    # Root-sum-square of relative differences; zero where both values are zero
+    scale = np.maximum(np.abs(x), np.abs(xs))
+    rel = np.divide(xs - x, scale, out=np.zeros_like(xs), where=scale != 0)
+    return np.sqrt(np.sum(rel ** 2, axis=1))
@@ -1,5 +1,7 @@
 import os
 import sys
+import hashlib
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from scipy import integrate, interpolate, optimize
@@ -456,9 +458,21 @@ Wrapper
 """
 
 
-def get_tsc(r, theta, t, cs, Omega, mode="read", filename=FILENAME):
+def get_tsc(
+    r, theta, t, cs, Omega, mode="read", filename=FILENAME, use_cache=True,
+    storage_dir=None,
+):
+    x = r / cs / t
+    tau = Omega * t
+    path = os.path.join(storage_dir or gpath.storage_dir, filename)
+
+    if mode == "read" and use_cache:
+        if os.path.isfile(path):
+            fields = cache.get_fields(path, x, theta, tau)
+            return _scale_fields(fields, cs, Omega)
+
     if mode == "read":
-        _sol = read_table(filename=filename)
+        _sol = read_table(path=path)
         if _sol is None:
             logger.info("Failed to load the table of TSC solution (probably just due to missing the file), and so solve TSC equations. After solving, the solution will be saved in the storage directory. From the next time, the table will be loaded to save computational costs.")
             mode = "solve"
@@ -466,17 +480,26 @@ def get_tsc(r, theta, t, cs, Omega, mode="read", filename=FILENAME):
     if mode == "solve":
         tscs = TscSolver()
         tscs.solve()
-        tscs.save_table(filename=filename)
+        tscs.save_table(path=path)
         _sol = tscs.get_solution()
 
-    x = r / cs / t
-    tau = Omega * t
-    sol_interp = _sol.make_interpolated_data(x)
+    interps = [make_function(_sol.x, v, fill_value=0) for v in _sol.variables()]
+    fields = calc_dimensionless_fields(x, theta, tau, interps, _sol.Delta_Q)
+    return _scale_fields(fields, cs, Omega)
+
+
+def calc_dimensionless_fields(x, theta, tau, interps, Delta_Q):
+    """
+    Evaluate the TSC solution with cs = 1 and Omega = 1.
+    Physical values are obtained by multiplying rho by Omega^2 and
+    velocities by cs (see _scale_fields).
+    """
+    sol_interp = TscData(x, *[f(x) for f in interps], Delta_Q)
     mgdata = sol_interp.make_meshgrid_data(theta)
     rho = calc_rho(
         mgdata.tt,
         tau,
-        Omega,
+        1.0,
         mgdata.Delta_Q,
         mgdata.alpha_0,
         mgdata.alpha_M,
@@ -487,7 +510,7 @@ def get_tsc(r, theta, t, cs, Omega, mode="read", filename=FILENAME):
         mgdata.xx,
         mgdata.tt,
         tau,
-        cs,
+        1.0,
         mgdata.Delta_Q,
         mgdata.V_0,
         mgdata.V_M,
@@ -496,9 +519,124 @@ def get_tsc(r, theta, t, cs, Omega, mode="read", filename=FILENAME):
         mgdata.m_0,
         mgdata.dV0dy,
     )
+    return {"rho": rho, "vr": vr, "vt": vt, "vp": vp, "Delta": mgdata.Delta_Q}
 
+
+def _scale_fields(fields, cs, Omega):
     # return {"vars":(rho, vr, vt, vp), "Delta":mgdata.Delta_Q}
-    return {"rho": rho, "vr": vr, "vt": vt, "vp": vp, "Delta": mgdata.Delta_Q}
+    return {
+        "rho": Omega ** 2 * fields["rho"],
+        "vr": cs * fields["vr"],
+        "vt": cs * fields["vt"],
+        "vp": cs * fields["vp"],
+        "Delta": fields["Delta"],
+    }
+
+
+"""
+Cache
+
+"""
+
+
+class TscCache:
+    """
+    Process-wide cache of TSC tables and evaluated fields.
+
+    Tables are keyed by (path, mtime) and hold the loaded TscData with its
+    interpolants, so that a table regenerated on disk is reloaded.
+    Evaluated fields are dimensionless (cs = Omega = 1) and keyed by the
+    table, the x = r/(cs t) and theta axes, and tau = Omega t.
+    Both stores are bounded with LRU eviction.
+    """
+
+    def __init__(self, maxsize_tables=4, maxsize_fields=64):
+        self.maxsize_tables = maxsize_tables
+        self.maxsize_fields = maxsize_fields
+        self._tables = OrderedDict()
+        self._fields = OrderedDict()
+        self.table_hits = 0
+        self.table_misses = 0
+        self.field_hits = 0
+        self.field_misses = 0
+        self.evictions = 0
+
+    def get_table(self, path):
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        if key in self._tables:
+            self.table_hits += 1
+            self._tables.move_to_end(key)
+            return key, self._tables[key]
+
+        self.table_misses += 1
+        logger.debug(f"Loading TSC table: {path}")
+        sol = pd.read_pickle(path)
+        interps = [make_function(sol.x, v, fill_value=0) for v in sol.variables()]
+        self._tables[key] = (sol, interps)
+        self._evict(self._tables, self.maxsize_tables)
+        return key, self._tables[key]
+
+    def get_fields(self, path, x, theta, tau):
+        table_key, (sol, interps) = self.get_table(path)
+        key = (table_key, _array_key(x), _array_key(theta), float(tau))
+        if key in self._fields:
+            self.field_hits += 1
+            self._fields.move_to_end(key)
+            return self._fields[key]
+
+        self.field_misses += 1
+        fields = calc_dimensionless_fields(x, theta, tau, interps, sol.Delta_Q)
+        for v in fields.values():
+            if isinstance(v, np.ndarray):
+                v.flags.writeable = False
+        self._fields[key] = fields
+        self._evict(self._fields, self.maxsize_fields)
+        return fields
+
+    def _evict(self, store, maxsize):
+        while len(store) > maxsize:
+            store.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "tables": len(self._tables),
+            "table_hits": self.table_hits,
+            "table_misses": self.table_misses,
+            "fields": len(self._fields),
+            "field_hits": self.field_hits,
+            "field_misses": self.field_misses,
+            "evictions": self.evictions,
+            "nbytes": sum(
+                v.nbytes
+                for f in self._fields.values()
+                for v in f.values()
+                if isinstance(v, np.ndarray)
+            ),
+        }
+
+    def clear(self):
+        self._tables.clear()
+        self._fields.clear()
+        self.table_hits = self.table_misses = 0
+        self.field_hits = self.field_misses = 0
+        self.evictions = 0
+
+
+def _array_key(a):
+    a = np.ascontiguousarray(a)
+    return (a.shape, hashlib.sha1(a.tobytes()).hexdigest())
+
+
+cache = TscCache()
+
+
+def get_cache_stats():
+    return cache.stats()
+
+
+def clear_cache():
+    cache.clear()
 
 
 def save_table(filename=FILENAME, tau=0.01, search_K=False, **kwargs):
@@ -1,6 +1,18 @@
 import envos
 import numpy as np
-data = np.loadtxt("run/stream_r2424_th80.txt", unpack=True)
+from envos import streamline
+
+# Streamline starting nearest to (r0, theta0) in a file of save_streamlines
+r0_au, theta0_deg = 2424, 80
+sls = streamline.read_streamlines("run/stream.npz")
+pos0 = np.array([sl.pos0 for sl in sls])
+dist = np.hypot(
+    np.log(pos0[:, 0] / (r0_au * envos.nc.au)), pos0[:, 1] - np.radians(theta0_deg)
+)
+sl = sls[np.argmin(dist)]
+data = np.array(
+    [sl.t, sl.R, sl.z, sl.vR, sl.vz, *[value for _, value, _ in sl.get_values()]]
+)
 print(data)
 data[0] /= envos.nc.year
 data[1] /= envos.nc.au
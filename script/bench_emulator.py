@@ -0,0 +1,50 @@
+# Validation of the PV emulator against held-out full simulations: a PV
+# library (ObsLibrary, e.g. filled by SweepRunner(library=...)) is split
+# into training and test maps; prints the training time, the prediction
+# time per map and the true vs estimated errors of the test predictions,
+# compared with the mean map and the nearest training map.
+import sys
+import time
+import numpy as np
+import envos
+from envos.emulator import PVEmulator
+
+library_dir = sys.argv[1] if len(sys.argv) > 1 else "./sweep_library"
+keys = sys.argv[2].split(",") if len(sys.argv) > 2 else ["CR_au", "Ms_Msun"]
+test_frac = 0.2
+
+lib = envos.ObsLibrary(library_dir)
+table = lib.table(kind="PV")
+table["PV"] = [lib.get(i) for i in table["id"]]
+rng = np.random.default_rng(0)
+is_test = rng.random(len(table)) < test_frac
+train, test = table[~is_test], table[is_test]
+print(f"{len(train)} training maps, {len(test)} test maps, parameters {keys}")
+
+t0 = time.perf_counter()
+emu = PVEmulator(keys).fit(train)
+print(f"training: {time.perf_counter() - t0:.2f} s, {len(emu.components)} components")
+
+t0 = time.perf_counter()
+n_rep = 100
+for _ in range(n_rep):
+    emu.predict({k: train[k].iloc[0] for k in keys})
+print(f"prediction: {(time.perf_counter() - t0) / n_rep * 1e3:.3f} ms per map")
+
+report = emu.validate(test)
+print(report.to_string())
+ratio = report["rms_error"] / report["est_error"]
+print(
+    f"rms error: median {np.median(report['rms_error']):.3g}, "
+    f"max {np.max(report['rms_error']):.3g}; "
+    f"true/estimated error: median {np.median(ratio):.2f}, max {np.max(ratio):.2f}; "
+    f"ZNCC: min {np.min(report['score']):.4f}"
+)
+# A GP collapsed to the mean map predicts no better than the nearest
+# library map
+print(
+    f"baselines: mean map {np.median(report['mean_error']):.3g}, "
+    f"nearest map {np.median(report['nn_error']):.3g}"
+)
+if np.median(report["rms_error"]) >= np.median(report["nn_error"]):
+    sys.exit("emulator is not better than the nearest library map")
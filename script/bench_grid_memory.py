@@ -0,0 +1,60 @@
+# Memory held by the grid coordinates and the cylindrical velocities for a
+# typical 3D model: fully materialized arrays (as Grid used to build them)
+# vs the lazy broadcast views of envos.grid.Grid and the on-demand vR/vz.
+import tracemalloc
+import numpy as np
+import envos
+
+config = envos.Config(
+    run_dir="./run_bench",
+    rau_in=10,
+    rau_out=1000,
+    nr=200,
+    ntheta=180,
+    nphi=64,
+    theta_out=np.pi,
+    T=10,
+    CR_au=100,
+    Ms_Msun=0.3,
+    inenv="UCM",
+    disk="exptail",
+)
+
+
+def eager_grid(grid):
+    rr, tt, pp = np.meshgrid(grid.rc_ax, grid.tc_ax, grid.pc_ax, indexing="ij")
+    return rr, tt, pp, rr * np.sin(tt), rr * np.cos(tt)
+
+
+def measure(func):
+    tracemalloc.start()
+    res = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, current, peak
+
+
+def show(label, current, peak):
+    print(f"{label:<34}: held {current/2**20:7.1f} MiB, peak {peak/2**20:7.1f} MiB")
+
+
+grid = envos.grid.make_grid_from_config(config)
+print(f"grid {grid.shape}, one full field = {np.prod(grid.shape)*8/2**20:.1f} MiB")
+
+ref, current, peak = measure(lambda: eager_grid(grid))
+show("eager rr, tt, pp, R, z", current, peak)
+del ref
+
+lazy, current, peak = measure(
+    lambda: [getattr(grid, k) for k in envos.grid.Grid.DERIVED]
+)
+show("lazy rr, tt, pp, R, z", current, peak)
+same = all(np.array_equal(a, b) for a, b in zip(eager_grid(grid), lazy))
+print(f"identical coordinates = {same}")
+
+mg = envos.ModelGenerator(config, grid=grid)
+mg.calc_kinematic_structure()
+model = mg.get_model()
+
+vcyl, current, peak = measure(lambda: (model.vR, model.vz))
+show("vR, vz computed on access", current, peak)
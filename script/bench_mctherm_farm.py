@@ -0,0 +1,47 @@
+# Throughput of McthermFarm for different splits of the cores between
+# `setthreads` per radmc3d run and the number of concurrent runs.
+# Requires the radmc3d executable.
+import os
+import numpy as np
+import envos
+from envos.mctherm_farm import McthermFarm
+
+n_core = os.cpu_count()
+n_model = 16
+
+config = envos.Config(
+    run_dir="./run_bench_farm",
+    rau_in=10,
+    rau_out=1000,
+    dr_to_r=0.05,
+    aspect_ratio=2,
+    nphi=1,
+    T=10,
+    Ms_Msun=0.3,
+    inenv="UCM",
+    disk="exptail",
+    opac="MRN20",
+    nphot=1e6,
+)
+
+models = []
+for CR_au in np.geomspace(30, 300, n_model):
+    mg = envos.ModelGenerator(config.replaced(CR_au=CR_au))
+    mg.calc_kinematic_structure()
+    models.append(mg.get_model())
+
+print(f"{n_model} models, {n_core} cores")
+threads = 1
+while threads <= n_core:
+    farm = McthermFarm(
+        config, n_core=n_core, threads_per_run=threads, farm_dir="./run_bench_farm/farm"
+    )
+    records = farm.run(models)
+    n_concurrent = max(1, min(n_model, n_core // threads))
+    per_run = np.mean([r["time"] for r in records])
+    print(
+        f"setthreads {threads:3d} x {n_concurrent:3d} concurrent: "
+        f"wall {farm.wall_time:8.1f} s, {n_model / farm.wall_time * 3600:8.1f} models/hour, "
+        f"mean run {per_run:7.1f} s"
+    )
+    threads *= 2
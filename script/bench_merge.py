@@ -0,0 +1,79 @@
+# Peak memory and time of merging envelope/disk components on a large
+# non-axisymmetric 3D grid: the previous full-array merge vs
+# model_generator.merge_components.
+import time
+import tracemalloc
+from types import SimpleNamespace
+import numpy as np
+import envos
+from envos.model_generator import merge_components
+
+nr, ntheta, nphi = 200, 180, 60
+rng = np.random.default_rng(0)
+r = np.geomspace(10, 1000, nr) * envos.nc.au
+theta = np.linspace(0, np.pi, ntheta)
+phi = np.linspace(0, 2 * np.pi, nphi)
+rr = np.meshgrid(r, theta, phi, indexing="ij")[0]
+
+
+def component(**kwargs):
+    fields = {k: rng.random(rr.shape) for k in ("rho", "vr", "vt", "vp")}
+    return SimpleNamespace(**fields, **kwargs)
+
+
+inenv = component()
+outenv = component(rin_lim=200 * envos.nc.au)
+disk = component()
+
+
+def merge_reference(rr, inenv, outenv, disk):
+    zeros = np.zeros_like(rr)
+    rho = np.copy(zeros)
+    vr = np.copy(zeros)
+    vt = np.copy(zeros)
+    vp = np.copy(zeros)
+    for m in (inenv,):
+        cond = rho < m.rho
+        rho[cond] = m.rho[cond]
+        vr[cond] = m.vr[cond]
+        vt[cond] = m.vt[cond]
+        vp[cond] = m.vp[cond]
+    fac = np.exp(-(0.3 * outenv.rin_lim / rr) ** 2)
+    rho += (outenv.rho - rho) * fac * np.where(rho != 0, 1, 0)
+    vr += (outenv.vr - vr) * fac
+    vt += (outenv.vt - vt) * fac
+    vp += (outenv.vp - vp) * fac
+    for m in (disk,):
+        cond = rho < m.rho
+        rho[cond] = m.rho[cond]
+        vr[cond] = m.vr[cond]
+        vt[cond] = m.vt[cond]
+        vp[cond] = m.vp[cond]
+    return rho, vr, vt, vp
+
+
+def measure(func):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    res = func()
+    dt = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return res, dt, peak
+
+
+nbytes_out = 4 * rr.nbytes
+print(f"grid {nr}x{ntheta}x{nphi}, output arrays = {nbytes_out/2**20:.0f} MiB")
+ref, dt, peak = measure(lambda: merge_reference(rr, inenv, outenv, disk))
+print(f"reference          : {dt:6.3f} s, peak {peak/2**20:7.1f} MiB")
+for n_thread in (1, 2, 4):
+    res, dt, peak = measure(
+        lambda: merge_components(
+            rr, inenv=inenv, outenv=outenv, disk=disk, n_thread=n_thread
+        )
+    )
+    same = all(np.array_equal(a, b) for a, b in zip(ref, res))
+    print(
+        f"merge_components({n_thread}): {dt:6.3f} s, peak {peak/2**20:7.1f} MiB,"
+        f" identical = {same}"
+    )
@@ -0,0 +1,33 @@
+# Compare the vectorized mu0 solver with the per-cell cubicsolver path
+# used before, both in accuracy and in speed.
+import time
+import numpy as np
+import envos
+from envos.models import CassenMoosmanInnerEnvelope, solve_mu0
+
+nr, ntheta, nphi = 200, 200, 30
+CR = 100 * envos.nc.au
+r = np.geomspace(10, 1000, nr) * envos.nc.au
+theta = np.linspace(0, np.pi, ntheta)
+phi = np.linspace(0, 2 * np.pi, nphi)
+rr, tt, pp = np.meshgrid(r, theta, phi, indexing="ij")
+mu = np.cos(tt)
+zeta = CR / rr
+
+t0 = time.perf_counter()
+csol = np.frompyfunc(CassenMoosmanInnerEnvelope._sol_with_cubic, 2, 1)
+mu0_scalar = csol(mu, zeta).astype(float)
+t_scalar = time.perf_counter() - t0
+
+t0 = time.perf_counter()
+mu0_vec = solve_mu0(mu, zeta)
+t_vec = time.perf_counter() - t0
+
+nan_match = np.array_equal(np.isnan(mu0_scalar), np.isnan(mu0_vec))
+finite = np.isfinite(mu0_scalar)
+maxdiff = np.max(np.abs(mu0_scalar[finite] - mu0_vec[finite]))
+print(f"cells            : {mu.size}")
+print(f"scalar path      : {t_scalar:.3f} s")
+print(f"vectorized path  : {t_vec:.3f} s  (x{t_scalar/t_vec:.0f})")
+print(f"same nan cells   : {nan_match}")
+print(f"max |difference| : {maxdiff:.3e}")
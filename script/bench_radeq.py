@@ -0,0 +1,56 @@
+# Calibration of the semi-analytic temperature (temp_mode="radeq") against
+# RADMC-3D mctherm: run time and the temperature ratio T_radeq / T_mctherm,
+# with and without the radial attenuation correction.
+# The mctherm part is skipped when the radmc3d executable is not found.
+import shutil
+import time
+import numpy as np
+import envos
+
+config = envos.Config(
+    run_dir="./run_bench_radeq",
+    rau_in=10,
+    rau_out=1000,
+    dr_to_r=0.05,
+    aspect_ratio=2,
+    nphi=1,
+    T=10,
+    CR_au=100,
+    Ms_Msun=0.3,
+    inenv="UCM",
+    disk="exptail",
+    opac="MRN20",
+    Lstar_Lsun=1.0,
+    nphot=1e6,
+    n_thread=4,
+)
+
+mg = envos.ModelGenerator(config)
+mg.calc_kinematic_structure()
+model = mg.get_model()
+
+res = {}
+for attenuation in (False, True):
+    mg.config = config.replaced(temp_mode="radeq", radeq_attenuation=attenuation)
+    t0 = time.perf_counter()
+    mg.calc_thermal_structure()
+    res[attenuation] = np.array(model.Tgas)
+    print(f"radeq attenuation={attenuation!s:<5}: {time.perf_counter() - t0:8.3f} s")
+
+if shutil.which("radmc3d") is None:
+    print("radmc3d not found: skipped the comparison with mctherm")
+else:
+    mg.config = config.replaced(temp_mode="mctherm")
+    t0 = time.perf_counter()
+    mg.calc_thermal_structure()
+    T_mc = np.array(model.Tgas)
+    print(f"mctherm nphot={config.nphot:.0e}     : {time.perf_counter() - t0:8.3f} s")
+
+    rr = model.rr[..., 0] / envos.nc.au
+    for attenuation, T in res.items():
+        ratio = (T / T_mc)[..., 0]
+        print(f"T_radeq/T_mctherm, attenuation={attenuation}")
+        for rlim in ((10, 30), (30, 100), (100, 300), (300, 1000)):
+            sel = (rlim[0] <= rr) & (rr < rlim[1])
+            q = np.percentile(ratio[sel], [5, 50, 95])
+            print(f"    r = {rlim[0]:4d}-{rlim[1]:4d} au: median {q[1]:.2f}, 5-95% {q[0]:.2f}-{q[2]:.2f}")
@@ -0,0 +1,55 @@
+# Per-point (solve_ivp for every start point) vs batched streamline
+# integration (StreamlineCalculator.calc_streamlines_batched).
+import time
+import numpy as np
+import envos
+from envos import streamline
+import envos.nconst as nc
+
+config = envos.Config(
+    run_dir="./run_bench_streamline",
+    rau_in=10,
+    rau_out=1000,
+    dr_to_r=0.05,
+    aspect_ratio=2,
+    nphi=1,
+    T=10,
+    CR_au=100,
+    Ms_Msun=0.3,
+    inenv="UCM",
+)
+mg = envos.ModelGenerator(config)
+mg.calc_kinematic_structure()
+model = mg.get_model()
+
+t_eval = np.arange(1e3, 1e6, 100) * nc.year
+for n_point in (10, 100, 400):
+    theta0 = np.radians(np.linspace(1, 89.9, n_point))
+    start_points = [(900 * nc.au, th) for th in theta0]
+    res = {}
+    for method in ("RK23", "RK45"):
+        for batch in (False, True):
+            t0 = time.perf_counter()
+            res[batch] = streamline.calc_streamlines(
+                model.rc_ax,
+                model.tc_ax,
+                model.vr[:, :, 0],
+                model.vt[:, :, 0],
+                start_points,
+                t_eval=t_eval,
+                method=method,
+                batch=batch,
+            )
+            res[batch, "time"] = time.perf_counter() - t0
+        rdiff = max(
+            np.max(np.hypot(a.R - b.R, a.z - b.z) / np.hypot(a.R, a.z))
+            for a, b in zip(res[False], res[True])
+            if len(a.t) == len(b.t)
+        )
+        nsame = sum(len(a.t) == len(b.t) for a, b in zip(res[False], res[True]))
+        print(
+            f"{n_point:4d} points {method}: per-point {res[False, 'time']:7.2f} s, "
+            f"batched {res[True, 'time']:6.2f} s "
+            f"(x{res[False, 'time'] / res[True, 'time']:.1f}), "
+            f"same length {nsame}/{n_point}, max relative position difference {rdiff:.1e}"
+        )